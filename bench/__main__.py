@@ -0,0 +1,73 @@
+# python -m bench <scenario|all> [options], prints one JSON result per scenario.
+# Results carry the commit they were taken on, append them to a file with --output to compare across commits.
+import argparse
+import asyncio
+import datetime
+import json
+import subprocess
+import sys
+
+from bench.fake_providers import FakeOpenAI, FakeStableDiffusion
+from bench.harness import Harness
+from bench.scenarios import SCENARIOS
+
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench")
+    parser.add_argument("scenario", choices=sorted(SCENARIOS) + ["all"])
+    parser.add_argument("--users", type=int, help="Override the scenario's number of users")
+    parser.add_argument("--clients", type=int, help="Override the scenario's number of concurrent clients")
+    parser.add_argument("--duration", type=float, help="Seconds to drive load for, for the polling scenarios")
+    parser.add_argument("--firestore-latency-ms", type=float, default=0, help="Added to every fake Firestore call")
+    parser.add_argument("--emulator", action="store_true",
+                        help="Use the Firestore emulator at FIRESTORE_EMULATOR_HOST instead of the in-memory fake")
+    parser.add_argument("--openai-latency", type=float, default=0.5, help="Seconds to the first token")
+    parser.add_argument("--sd-latency", type=float, default=1.0, help="Seconds for a Stable Diffusion call")
+    parser.add_argument("--sd-eta", type=float, default=5.0, help="Seconds until a queued image is done")
+    parser.add_argument("--output", help="Append the JSON result as one line to this file")
+    return parser.parse_args(argv)
+
+
+def run_scenario(args):
+    def harness_factory(openai_options=None, stable_diffusion_options=None):
+        # Scenarios pass provider options of their own, e.g. the faults to inject
+        return Harness(firestore_latency=args.firestore_latency_ms / 1000, emulator=args.emulator,
+                       openai=FakeOpenAI(latency=args.openai_latency, **(openai_options or {})),
+                       stable_diffusion=FakeStableDiffusion(latency=args.sd_latency, eta=args.sd_eta,
+                                                            **(stable_diffusion_options or {})))
+
+    scenario = SCENARIOS[args.scenario]
+    overrides = {name: getattr(args, name) for name in ("users", "clients", "duration")
+                 if getattr(args, name) is not None and name in scenario.__code__.co_varnames}
+    result = asyncio.run(scenario(harness_factory, **overrides))
+    return dict({"scenario": args.scenario, "commit": current_commit(),
+                 "timestamp": datetime.datetime.utcnow().isoformat()}, **result)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+    if args.scenario == "all":
+        # One process per scenario, the service keeps module level state that must not carry over
+        failed = [name for name in sorted(SCENARIOS)
+                  if subprocess.run([sys.executable, "-m", "bench", name] + argv[1:], check=False).returncode]
+        if failed:
+            sys.exit(f"Failed: {', '.join(failed)}")
+        return
+    result = run_scenario(args)
+    print(json.dumps(result, indent=2, default=str))
+    if args.output:
+        with open(args.output, "a") as output:
+            output.write(json.dumps(result, default=str) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,503 @@
+# In-memory stand-in for the parts of the Firestore client the service uses: documents, subcollections, simple
+# queries, batches, transactions and on_snapshot listeners. Optionally sleeps on every round-trip, blocking like
+# the real synchronous client does.
+import copy
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+
+from google.api_core import exceptions
+from google.cloud import firestore
+
+DESCENDING = firestore.Query.DESCENDING
+
+
+def get_field(data, field_path):
+    for name in field_path.split("."):
+        if not isinstance(data, dict) or name not in data:
+            return None
+        data = data[name]
+    return data
+
+
+def has_field(data, field_path):
+    for name in field_path.split("."):
+        if not isinstance(data, dict) or name not in data:
+            return False
+        data = data[name]
+    return True
+
+
+def apply_update(data, fields):
+    for field_path, value in fields.items():
+        *parents, name = field_path.split(".")
+        target = data
+        for parent in parents:
+            target = target.setdefault(parent, {})
+        if isinstance(value, firestore.Increment):
+            target[name] = (target.get(name) or 0) + value.value
+        elif value is firestore.DELETE_FIELD:
+            target.pop(name, None)
+        else:
+            target[name] = copy.deepcopy(value)
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self._data = data
+
+    @property
+    def id(self):
+        return self.reference.id
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+    def get(self, field_path):
+        return copy.deepcopy(get_field(self._data, field_path))
+
+
+class FakeWatch:
+    def __init__(self, db, callback, query=None, reference=None):
+        self._db = db
+        self.callback = callback
+        self.query = query
+        self.reference = reference
+        self.matched = {}
+
+    def unsubscribe(self):
+        self._db._unwatch(self)
+
+
+class FakeQuery:
+    def __init__(self, db, collection_path, filters=(), orders=(), limit=None, cursor=None, fields=None):
+        self._db = db
+        self._collection_path = collection_path
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._cursor = cursor
+        self._fields = fields
+
+    def _copy(self, **changes):
+        values = dict(filters=self._filters, orders=self._orders, limit=self._limit, cursor=self._cursor,
+                      fields=self._fields)
+        values.update(changes)
+        return FakeQuery(self._db, self._collection_path, **values)
+
+    def where(self, field_path, op_string, value):
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction=firestore.Query.ASCENDING):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, cursor):
+        return self._copy(cursor=cursor)
+
+    def select(self, field_paths):
+        return self._copy(fields=list(field_paths))
+
+    def _value(self, path, data, field_path):
+        return path if field_path == "__name__" else get_field(data, field_path)
+
+    def _matches(self, path, data):
+        if path.rsplit("/", 1)[0] != self._collection_path:
+            return False
+        for field_path, op_string, value in self._filters:
+            if not has_field(data, field_path):
+                return False
+            actual = get_field(data, field_path)
+            if op_string == "==" and not actual == value or op_string == "<=" and not actual <= value or \
+                    op_string == "<" and not actual < value or op_string == ">=" and not actual >= value or \
+                    op_string == ">" and not actual > value or op_string == "in" and actual not in value:
+                return False
+        # Documents without an ordered field are left out, as in Firestore
+        return all(field_path == "__name__" or has_field(data, field_path) for field_path, _ in self._orders)
+
+    def _after_cursor(self, path, data, cursor_values):
+        for (field_path, direction), cursor_value in zip(self._orders, cursor_values):
+            value = self._value(path, data, field_path)
+            if value == cursor_value:
+                continue
+            return (value < cursor_value) if direction == DESCENDING else (value > cursor_value)
+        return False
+
+    def _cursor_values(self):
+        if isinstance(self._cursor, FakeSnapshot):
+            return [self._value(self._cursor.reference.path, self._cursor._data, field_path)
+                    for field_path, _ in self._orders]
+        return [self._cursor.get(field_path) for field_path, _ in self._orders]
+
+    def _run(self):
+        with self._db._lock:
+            paths = self._db._collections.get(self._collection_path, ())
+            results = [(path, self._db._documents[path]) for path in paths
+                       if self._matches(path, self._db._documents[path])]
+        for field_path, direction in reversed(self._orders):
+            results.sort(key=lambda result: self._value(result[0], result[1], field_path),
+                         reverse=direction == DESCENDING)
+        if self._cursor is not None:
+            cursor_values = self._cursor_values()
+            results = [result for result in results if self._after_cursor(result[0], result[1], cursor_values)]
+        if self._limit is not None:
+            results = results[:self._limit]
+        snapshots = []
+        for path, data in results:
+            if self._fields is not None:
+                data = {field_path: get_field(data, field_path) for field_path in self._fields
+                        if has_field(data, field_path)}
+            snapshots.append(FakeSnapshot(FakeDocumentReference(self._db, path), copy.deepcopy(data)))
+        return snapshots
+
+    def stream(self, transaction=None):
+        self._db._round_trip(reads=1)
+        snapshots = self._run()
+        self._db.documents_read += len(snapshots)
+        self._db._received(snapshot._data for snapshot in snapshots)
+        if transaction is not None:
+            for snapshot in snapshots:
+                transaction._read(snapshot.reference.path)
+        return iter(snapshots)
+
+    def get(self, transaction=None):
+        return list(self.stream(transaction))
+
+    def on_snapshot(self, callback):
+        return self._db._watch(FakeWatch(self._db, callback, query=self))
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, db, path):
+        super().__init__(db, path)
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def document(self, document_id=None):
+        return FakeDocumentReference(self._db, f"{self.path}/{document_id or uuid.uuid4().hex}")
+
+
+class FakeDocumentReference:
+    def __init__(self, db, path):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def __eq__(self, other):
+        return isinstance(other, FakeDocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def collection(self, name):
+        return FakeCollectionReference(self._db, f"{self.path}/{name}")
+
+    def get(self, field_paths=None, transaction=None):
+        self._db._round_trip(reads=1)
+        with self._db._lock:
+            data = copy.deepcopy(self._db._documents.get(self.path))
+            if transaction is not None:
+                transaction._read(self.path)
+        if data is not None and field_paths is not None:
+            data = {field_path: get_field(data, field_path) for field_path in field_paths
+                    if has_field(data, field_path)}
+        self._db.documents_read += 1
+        self._db._received([data])
+        return FakeSnapshot(self, data)
+
+    def set(self, document_data, merge=False):
+        self._db._commit([("set", self, document_data, merge)])
+
+    def update(self, field_updates):
+        self._db._commit([("update", self, field_updates, False)])
+
+    def delete(self):
+        self._db._commit([("delete", self, None, False)])
+
+    def on_snapshot(self, callback):
+        return self._db._watch(FakeWatch(self._db, callback, reference=self))
+
+
+class FakeWriteBatch:
+    def __init__(self, db):
+        self._db = db
+        self._writes = []
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append(("set", reference, document_data, merge))
+
+    def update(self, reference, field_updates):
+        self._writes.append(("update", reference, field_updates, False))
+
+    def delete(self, reference):
+        self._writes.append(("delete", reference, None, False))
+
+    def commit(self):
+        writes, self._writes = self._writes, []
+        self._db._commit(writes)
+
+
+class FakeTransaction(FakeWriteBatch):
+    # Implements the hooks @firestore.transactional calls. Like Firestore it is optimistic: the commit is ABORTED
+    # if a document the transaction read was written since, and @transactional runs the function again.
+    _max_attempts = 5
+    _read_only = False
+
+    def __init__(self, db):
+        super().__init__(db)
+        self._id = None
+        # Path -> the document's version when the transaction first read it
+        self._read_versions = {}
+
+    def _read(self, path):
+        self._read_versions.setdefault(path, self._db._versions.get(path, 0))
+
+    def _clean_up(self):
+        self._writes = []
+        self._read_versions = {}
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self._id = uuid.uuid4().bytes
+
+    def _rollback(self):
+        self._clean_up()
+
+    def _commit(self):
+        writes, self._writes = self._writes, []
+        self._db._commit(writes, self._read_versions)
+        self._clean_up()
+        return []
+
+
+class FakeFirestore:
+    # With `bandwidth`, in bytes a second, the documents a read returns are sized, counted in `bytes_read` and take
+    # that long to arrive on top of `latency`
+    def __init__(self, latency=0.0, bandwidth=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.reads = 0
+        self.writes = 0
+        self.round_trips = 0
+        # Documents returned by gets and queries, what Firestore bills reads for
+        self.documents_read = 0
+        self.bytes_read = 0
+        self._documents = {}
+        # Path -> how many times the document was written, transactions check it on commit
+        self._versions = {}
+        # Collection path -> paths of its documents, so queries don't scan everything
+        self._collections = {}
+        self._watches = []
+        self._lock = threading.RLock()
+
+    def _round_trip(self, reads=0, writes=0):
+        self.round_trips += 1
+        self.reads += reads
+        self.writes += writes
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _received(self, documents):
+        if self.bandwidth is None:
+            return
+        # Roughly what the documents take on the wire, field names included
+        size = sum(len(json.dumps(data, default=str)) for data in documents if data is not None)
+        self.bytes_read += size
+        time.sleep(size / self.bandwidth)
+
+    def collection(self, name):
+        return FakeCollectionReference(self, name)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def transaction(self, **kwargs):
+        return FakeTransaction(self)
+
+    def _commit(self, writes, read_versions=None):
+        if not writes:
+            return
+        self._round_trip(writes=len(writes))
+        with self._lock:
+            self._apply(writes, read_versions)
+            watches = list(self._watches)
+        self._notify_all(watches, {reference.path for _, reference, _, _ in writes})
+
+    def _apply(self, writes, read_versions):
+        # Called with the lock held
+        for path, version in (read_versions or {}).items():
+            if self._versions.get(path, 0) != version:
+                raise exceptions.Aborted(f"Transaction lock timeout, {path} was written since it was read")
+        for operation, reference, data, merge in writes:
+            if operation == "update" and reference.path not in self._documents:
+                raise exceptions.NotFound(f"No document to update: {reference.path}")
+        for operation, reference, data, merge in writes:
+            collection_path = reference.path.rsplit("/", 1)[0]
+            self._versions[reference.path] = self._versions.get(reference.path, 0) + 1
+            if operation == "delete":
+                self._documents.pop(reference.path, None)
+                self._collections.get(collection_path, set()).discard(reference.path)
+                continue
+            self._collections.setdefault(collection_path, set()).add(reference.path)
+            if operation == "update" or merge:
+                document = self._documents.setdefault(reference.path, {})
+                apply_update(document, data)
+            else:
+                document = {}
+                apply_update(document, {name: value for name, value in data.items()})
+                self._documents[reference.path] = document
+
+    def _notify_all(self, watches, changed):
+        for watch in watches:
+            self._notify(watch, changed)
+
+    def _watch(self, watch):
+        with self._lock:
+            self._watches.append(watch)
+        self._notify(watch, None)
+        return watch
+
+    def _unwatch(self, watch):
+        with self._lock:
+            if watch in self._watches:
+                self._watches.remove(watch)
+
+    def _notify(self, watch, changed):
+        # Listeners get called on the writer's thread rather than a separate one, callers hand off either way
+        if watch.reference is not None:
+            if changed is None or watch.reference.path in changed:
+                watch.callback([watch.reference.get()], [], time.time())
+            return
+        if changed is not None and not any(path.rsplit("/", 1)[0] == watch.query._collection_path
+                                           for path in changed):
+            return
+        if changed is not None and watch.query._limit is None and watch.query._fields is None:
+            self._notify_changed(watch, changed)
+            return
+        current = {snapshot.reference.path: snapshot for snapshot in watch.query._run()}
+        changes = []
+        for path, snapshot in current.items():
+            if path not in watch.matched:
+                changes.append(SimpleNamespace(type=SimpleNamespace(name="ADDED"), document=snapshot))
+            elif changed is not None and path in changed:
+                changes.append(SimpleNamespace(type=SimpleNamespace(name="MODIFIED"), document=snapshot))
+        for path in watch.matched:
+            if path not in current:
+                changes.append(SimpleNamespace(type=SimpleNamespace(name="REMOVED"), document=watch.matched[path]))
+        watch.matched = current
+        if changes or changed is None:
+            watch.callback(list(current.values()), changes, time.time())
+
+    def _notify_changed(self, watch, changed):
+        # Without a limit only the written documents can enter or leave the results, the rest of the collection
+        # isn't queried again on every commit
+        changes = []
+        for path in changed:
+            with self._lock:
+                data = copy.deepcopy(self._documents.get(path))
+            if data is not None and watch.query._matches(path, data):
+                snapshot = FakeSnapshot(FakeDocumentReference(self, path), data)
+                change_type = "MODIFIED" if path in watch.matched else "ADDED"
+                watch.matched[path] = snapshot
+                changes.append(SimpleNamespace(type=SimpleNamespace(name=change_type), document=snapshot))
+            elif path in watch.matched:
+                changes.append(SimpleNamespace(type=SimpleNamespace(name="REMOVED"), document=watch.matched.pop(path)))
+        if changes:
+            watch.callback(list(watch.matched.values()), changes, time.time())
+
+
+class SharedFakeFirestore(FakeFirestore):
+    # The fake shared by several processes through a SQLite file, for tests of workers in separate processes.
+    # Every committed document is appended to a log that each process replays into its own copy before a read or
+    # a commit, commits take the file's write lock, so transactions conflict across processes as in Firestore.
+    # Listeners hear of other processes' writes within `poll_interval`.
+    def __init__(self, path, latency=0.0, poll_interval=0.01):
+        super().__init__(latency)
+        self.poll_interval = poll_interval
+        self._connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS changes (sequence INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                 "path TEXT NOT NULL, document TEXT, version INTEGER NOT NULL)")
+        self._replayed = 0
+        # Written by other processes and not told to the listeners here yet
+        self._unnotified = set()
+        self._poller = None
+        self._closed = False
+
+    def _sync(self):
+        # Called with the lock held, catches up with what other processes wrote
+        rows = self._connection.execute("SELECT sequence, path, document, version FROM changes WHERE sequence > ? "
+                                        "ORDER BY sequence", (self._replayed,)).fetchall()
+        for sequence, path, document, version in rows:
+            collection_path = path.rsplit("/", 1)[0]
+            if document is None:
+                self._documents.pop(path, None)
+                self._collections.get(collection_path, set()).discard(path)
+            else:
+                self._documents[path] = json.loads(document)
+                self._collections.setdefault(collection_path, set()).add(path)
+            self._versions[path] = version
+            self._replayed = sequence
+            self._unnotified.add(path)
+
+    def _round_trip(self, reads=0, writes=0):
+        super()._round_trip(reads, writes)
+        with self._lock:
+            self._sync()
+
+    def _commit(self, writes, read_versions=None):
+        if not writes:
+            return
+        self._round_trip(writes=len(writes))
+        changed = {reference.path for _, reference, _, _ in writes}
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._sync()
+                self._apply(writes, read_versions)
+                for path in changed:
+                    document = self._documents.get(path)
+                    cursor = self._connection.execute(
+                        "INSERT INTO changes (path, document, version) VALUES (?, ?, ?)",
+                        (path, None if document is None else json.dumps(document, default=str), self._versions[path]))
+                    self._replayed = cursor.lastrowid
+                self._connection.execute("COMMIT")
+            except BaseException:
+                # _apply checks everything before it changes anything
+                self._connection.execute("ROLLBACK")
+                raise
+            watches = list(self._watches)
+        self._notify_all(watches, changed)
+
+    def _watch(self, watch):
+        with self._lock:
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll, name="shared-fake-firestore", daemon=True)
+                self._poller.start()
+        return super()._watch(watch)
+
+    def _poll(self):
+        while not self._closed:
+            time.sleep(self.poll_interval)
+            with self._lock:
+                self._sync()
+                changed, self._unnotified = self._unnotified, set()
+                watches = list(self._watches)
+            if changed:
+                self._notify_all(watches, changed)
+
+    def close(self):
+        self._closed = True
+        if self._poller is not None:
+            self._poller.join()
+        self._connection.close()
@@ -0,0 +1,257 @@
+# Local stand-ins for the OpenAI completions API and the Stable Diffusion API, with configurable latency and
+# injected faults (5xx, 429 and malformed responses) for benchmarks and fault testing.
+import asyncio
+import itertools
+import random
+import socket
+import struct
+import time
+import zlib
+
+import aiohttp
+import orjson
+from aiohttp import web
+
+WORDS = ("the", "little", "fox", "moon", "sleepy", "owl", "forest", "quietly", "dreamed", "of", "stars", "and",
+         "a", "warm", "blanket", "under", "silver", "sky")
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def solid_png(size=64, rgb=(40, 40, 90)):
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    row = b"\x00" + bytes(rgb) * size
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)) + \
+        chunk(b"IDAT", zlib.compress(row * size)) + chunk(b"IEND", b"")
+
+
+def jittered(seconds):
+    return seconds * random.uniform(0.5, 1.5)
+
+
+class Quota:
+    # A limit a minute, replenished continuously the way OpenAI enforces its limits rather than reset every minute
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.remaining = per_minute
+        self._updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.remaining = min(self.per_minute, self.remaining + (now - self._updated) * self.per_minute / 60)
+        self._updated = now
+
+    def wait_time(self, amount):
+        return max(0.0, (amount - self.remaining) * 60 / self.per_minute)
+
+
+class FakeProvider:
+    def __init__(self, latency, failure_rate=0.0, rate_limit_rate=0.0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.requests = 0
+        self.faults = 0
+        # Time spent answering API calls, streamed responses until their last byte
+        self.busy_seconds = 0.0
+        self.base_url = None
+        self._runner = None
+
+    def fault(self):
+        roll = random.random()
+        if roll < self.failure_rate:
+            self.faults += 1
+            return web.json_response({"error": {"message": "Injected failure", "type": "server_error"}}, status=500)
+        if roll < self.failure_rate + self.rate_limit_rate:
+            self.faults += 1
+            return web.json_response({"error": {"message": "Injected rate limit", "type": "requests"}}, status=429,
+                                     headers={"Retry-After": "1"})
+        return None
+
+    def routes(self, app):
+        raise NotImplementedError
+
+    @web.middleware
+    async def timed(self, request, handler):
+        if request.method != "POST":
+            return await handler(request)
+        started = time.monotonic()
+        try:
+            return await handler(request)
+        finally:
+            self.busy_seconds += time.monotonic() - started
+
+    async def start(self):
+        app = web.Application(middlewares=[self.timed])
+        self.routes(app)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        port = free_port()
+        await web.TCPSite(self._runner, "127.0.0.1", port).start()
+        self.base_url = f"http://127.0.0.1:{port}"
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def stats(self):
+        return {"requests": self.requests, "faults": self.faults, "busy_seconds": self.busy_seconds}
+
+
+class FakeOpenAI(FakeProvider):
+    # POST /v1/completions, streamed or not, the first token after `latency` and the rest every `token_delay`.
+    # Prompts containing `poison_marker` always fail, like a story the provider can never complete. With
+    # `requests_per_minute` or `tokens_per_minute`, calls over the limit are answered 429 like OpenAI does, tokens
+    # counted as the prompt's plus max_tokens, and every response says what is left in x-ratelimit-remaining-*.
+    def __init__(self, latency=0.5, token_delay=0.002, failure_rate=0.0, rate_limit_rate=0.0, poison_marker=None,
+                 requests_per_minute=None, tokens_per_minute=None):
+        super().__init__(latency, failure_rate, rate_limit_rate)
+        self.token_delay = token_delay
+        self.poison_marker = poison_marker
+        self.poisoned = 0
+        self.quotas = {name: Quota(per_minute) for name, per_minute in
+                       (("requests", requests_per_minute), ("tokens", tokens_per_minute)) if per_minute}
+        self.over_limit = 0
+
+    def spend(self, requests=0, tokens=0):
+        # What other clients of the same account used
+        for name, amount in (("requests", requests), ("tokens", tokens)):
+            if name in self.quotas:
+                self.quotas[name].refill()
+                self.quotas[name].remaining -= amount
+
+    def quota_headers(self):
+        return {f"x-ratelimit-remaining-{name}": str(max(0, int(quota.remaining)))
+                for name, quota in self.quotas.items()}
+
+    def admit(self, body):
+        # None when the call fits in the limits, else the 429 to answer
+        amounts = {"requests": 1, "tokens": len(body.get("prompt", "")) // 4 + int(body.get("max_tokens") or 16)}
+        for quota in self.quotas.values():
+            quota.refill()
+        wait = max((quota.wait_time(amounts[name]) for name, quota in self.quotas.items()), default=0)
+        if wait > 0:
+            self.over_limit += 1
+            return web.json_response({"error": {"message": "Rate limit reached", "type": "requests"}}, status=429,
+                                     headers=dict(self.quota_headers(), **{"Retry-After": f"{wait:.3f}"}))
+        for name, quota in self.quotas.items():
+            quota.remaining -= amounts[name]
+        return None
+
+    def routes(self, app):
+        app.router.add_post("/v1/completions", self.completions)
+
+    def completion(self, model, text, finish_reason):
+        return {"id": "cmpl-bench", "object": "text_completion", "created": int(time.time()), "model": model,
+                "choices": [{"text": text, "index": 0, "logprobs": None, "finish_reason": finish_reason}]}
+
+    def stats(self):
+        return dict(super().stats(), poisoned=self.poisoned, over_limit=self.over_limit)
+
+    async def completions(self, request):
+        self.requests += 1
+        body = await request.json()
+        over_limit = self.admit(body)
+        if over_limit is not None:
+            return over_limit
+        fault = self.fault()
+        await asyncio.sleep(jittered(self.latency))
+        if fault is not None:
+            return fault
+        if self.poison_marker and self.poison_marker in str(body.get("prompt", "")):
+            self.poisoned += 1
+            return web.json_response({"error": {"message": "Injected poison", "type": "invalid_request_error"}},
+                                     status=400)
+        words = [" " + random.choice(WORDS) for _ in range(int(body.get("max_tokens") or 16))]
+        if not body.get("stream"):
+            response = self.completion(body.get("model"), "".join(words), "length")
+            response["usage"] = {"prompt_tokens": len(body.get("prompt", "")) // 4, "completion_tokens": len(words)}
+            return web.json_response(response, headers=self.quota_headers())
+        stream = web.StreamResponse(headers=dict(self.quota_headers(), **{"Content-Type": "text/event-stream"}))
+        await stream.prepare(request)
+        for word in words:
+            await stream.write(b"data: " + orjson.dumps(self.completion(body.get("model"), word, None)) + b"\n\n")
+            await asyncio.sleep(self.token_delay)
+        await stream.write(b"data: [DONE]\n\n")
+        await stream.write_eof()
+        return stream
+
+
+class FakeStableDiffusion(FakeProvider):
+    # POST /v3/dreambooth answers with an image or, for `processing_rate` of jobs, a queued job that finishes after
+    # `eta` seconds, fetched with POST /v4/dreambooth/fetch/{id} or delivered to the webhook. Images are served
+    # from GET /images/{id}.png.
+    def __init__(self, latency=1.0, processing_rate=0.5, eta=5.0, failure_rate=0.0, rate_limit_rate=0.0,
+                 malformed_rate=0.0):
+        super().__init__(latency, failure_rate, rate_limit_rate)
+        self.processing_rate = processing_rate
+        self.eta = eta
+        self.malformed_rate = malformed_rate
+        self.jobs = {}
+        self.webhooks_sent = 0
+        self._job_ids = itertools.count(1)
+        self._image = solid_png()
+        self._webhook_tasks = set()
+
+    def routes(self, app):
+        app.router.add_post("/v3/dreambooth", self.generate)
+        app.router.add_post("/v4/dreambooth/fetch/{job_id}", self.fetch)
+        app.router.add_get("/images/{name}", self.image)
+
+    def image_url(self, job_id):
+        return f"{self.base_url}/images/{job_id}.png"
+
+    async def generate(self, request):
+        self.requests += 1
+        body = await request.json()
+        fault = self.fault()
+        await asyncio.sleep(jittered(self.latency))
+        if fault is not None:
+            return fault
+        if random.random() < self.malformed_rate:
+            self.faults += 1
+            return web.json_response({"status": "error", "output": None, "message": "Injected bad response"})
+        job_id = next(self._job_ids)
+        if random.random() >= self.processing_rate:
+            return web.json_response({"status": "success", "output": [self.image_url(job_id)], "id": job_id})
+        self.jobs[job_id] = time.time() + self.eta
+        if body.get("webhook"):
+            task = asyncio.create_task(self.call_webhook(body["webhook"], body.get("track_id"), job_id))
+            self._webhook_tasks.add(task)
+            task.add_done_callback(self._webhook_tasks.discard)
+        return web.json_response({"status": "processing", "eta": self.eta, "id": job_id, "output": None})
+
+    async def call_webhook(self, url, track_id, job_id):
+        await asyncio.sleep(self.eta)
+        async with aiohttp.ClientSession() as session:
+            async with session.post(url, json={"status": "success", "track_id": track_id, "id": job_id,
+                                               "output": [self.image_url(job_id)]}) as response:
+                await response.read()
+        self.webhooks_sent += 1
+
+    async def fetch(self, request):
+        self.requests += 1
+        fault = self.fault()
+        await asyncio.sleep(jittered(self.latency) / 4)
+        if fault is not None:
+            return fault
+        job_id = int(request.match_info["job_id"])
+        ready_at = self.jobs.get(job_id)
+        if ready_at is None:
+            return web.json_response({"status": "failed", "message": "Unknown job"})
+        if time.time() < ready_at:
+            return web.json_response({"status": "processing", "eta": ready_at - time.time()})
+        return web.json_response({"status": "success", "output": [self.image_url(job_id)]})
+
+    async def image(self, request):
+        return web.Response(body=self._image, content_type="image/png")
+
+    def stats(self):
+        return dict(super().stats(), jobs=len(self.jobs), webhooks_sent=self.webhooks_sent)
@@ -0,0 +1,204 @@
+# Boots the API with its workers in this process against an in-memory Firestore (or the emulator), the fake
+# providers and a local token signer, and records what a scenario's clients see.
+import asyncio
+import collections
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+import aiohttp
+import jwt
+
+from bench.fake_firestore import FakeFirestore
+from bench.fake_providers import FakeOpenAI, FakeStableDiffusion, free_port
+
+
+class LocalTokenSigner:
+    # Signs ID tokens with a local key, verify() stands in for firebase_admin.auth.verify_id_token. With RS256 a
+    # verification costs what checking a Firebase ID token's signature does.
+    def __init__(self, ttl=3600, algorithm="HS256"):
+        self.ttl = ttl
+        self.algorithm = algorithm
+        if algorithm == "RS256":
+            from cryptography.hazmat.primitives.asymmetric import rsa
+
+            self.signing_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+            self.verifying_key = self.signing_key.public_key()
+        else:
+            self.signing_key = self.verifying_key = uuid.uuid4().hex
+
+    def sign(self, user_id):
+        return jwt.encode({"uid": user_id, "sub": user_id, "exp": int(time.time()) + self.ttl}, self.signing_key,
+                          algorithm=self.algorithm)
+
+    def verify(self, token):
+        return jwt.decode(token, self.verifying_key, algorithms=[self.algorithm])
+
+
+def percentiles(samples, scale=1.0):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+
+    def pick(quantile):
+        return ordered[min(len(ordered) - 1, int(quantile * len(ordered)))] * scale
+
+    return {"p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99), "max": ordered[-1] * scale,
+            "mean": sum(ordered) / len(ordered) * scale}
+
+
+class ServerError(Exception):
+    # A 5xx from the service, the run stops there rather than reporting numbers for a broken build
+    pass
+
+
+class Harness:
+    def __init__(self, firestore_latency=0.0, emulator=False, openai=None, stable_diffusion=None, env=None,
+                 signer=None):
+        self.firestore_latency = firestore_latency
+        self.emulator = emulator
+        self.openai = openai or FakeOpenAI()
+        self.stable_diffusion = stable_diffusion or FakeStableDiffusion()
+        self.env = env or {}
+        self.signer = signer or LocalTokenSigner()
+        self.db = None
+        self.session = None
+        self.port = None
+        self.ready_at = {}
+        self.dead_lettered = set()
+        self.latencies = []
+        self.status_codes = collections.Counter()
+        self.errors = 0
+        # Response headers and bodies as sent, compressed or not
+        self.bytes_received = 0
+        self.failure = None
+        self._tokens = {}
+        self._server = None
+        self._serve = None
+        self._image_dir = None
+
+    def configure_environment(self):
+        # Read by src.config when it is first imported, so this runs before anything from src is
+        self._image_dir = tempfile.mkdtemp(prefix="goodnight-bench-")
+        os.environ.update({
+            "OPENAI_API_BASE": f"{self.openai.base_url}/v1",
+            "STABLE_DIFFUSION_API_BASE": self.stable_diffusion.base_url,
+            "PUBLIC_BASE_URL": f"http://127.0.0.1:{self.port}",
+            "STABLE_DIFFUSION_WEBHOOK_SECRET": "bench",
+            "IMAGE_STORE_PATH": self._image_dir,
+            "PREGENERATION_ENABLED": "False",
+            "RUN_WORKERS": "True"
+        })
+        # Provider limits are the fakes' to enforce, the service's own limiter should not be what is measured
+        for name, value in (("OPENAI_REQUESTS_PER_MINUTE", "1000000"), ("OPENAI_TOKENS_PER_MINUTE", "1000000000"),
+                            ("STABLE_DIFFUSION_REQUESTS_PER_MINUTE", "1000000"), ("DAILY_PROVIDER_BUDGET", "1e9")):
+            os.environ.setdefault(name, value)
+        os.environ.update(self.env)
+
+    async def start(self, seed=None):
+        await self.openai.start()
+        await self.stable_diffusion.start()
+        self.port = free_port()
+        self.configure_environment()
+
+        import uvicorn
+        from src import main
+        from src.events import story_events
+        from src.token_cache import token_cache
+        from src.worker import initialize_firestore
+
+        self.db = initialize_firestore() if self.emulator else FakeFirestore(self.firestore_latency)
+        if seed is not None:
+            # Before startup, the workers' first recovery scan finds the seeded backlog
+            seed(self.db)
+        main.initialize_firestore = lambda: self.db
+        token_cache._verify = self.signer.verify
+        story_events.add_listener(self.on_story_change)
+
+        self._server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=self.port,
+                                                     log_level="warning", lifespan="on"))
+        self._serve = asyncio.create_task(self._server.serve())
+        while not self._server.started:
+            if self._serve.done():
+                self._serve.result()
+            await asyncio.sleep(0.01)
+        self.session = aiohttp.ClientSession(f"http://127.0.0.1:{self.port}",
+                                             connector=aiohttp.TCPConnector(limit=0))
+        return self
+
+    async def stop(self):
+        if self.session is not None:
+            await self.session.close()
+        if self._server is not None:
+            self._server.should_exit = True
+            await self._serve
+        current = asyncio.current_task()
+        background = [task for task in asyncio.all_tasks() if task is not current]
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        await self.openai.stop()
+        await self.stable_diffusion.stop()
+        if self._image_dir is not None:
+            shutil.rmtree(self._image_dir, ignore_errors=True)
+
+    def on_story_change(self, user_id, story):
+        if story["status"] == "StoryReady":
+            self.ready_at.setdefault((user_id, story["story_id"]), time.monotonic())
+        elif story["status"] == "DeadLetter":
+            self.dead_lettered.add((user_id, story["story_id"]))
+
+    def token(self, user_id):
+        token = self._tokens.get(user_id)
+        if token is None:
+            token = self._tokens[user_id] = self.signer.sign(user_id)
+        return token
+
+    async def request(self, method, path, user_id=None, headers=None, **kwargs):
+        headers = dict(headers or {})
+        if user_id is not None:
+            headers["Authorization"] = f"Bearer {self.token(user_id)}"
+        started = time.perf_counter()
+        try:
+            async with self.session.request(method, path, headers=headers, **kwargs) as response:
+                body = await response.read()
+                status = response.status
+                response_headers = response.headers
+                self.bytes_received += sum(len(name) + len(value) + 4 for name, value in response.raw_headers) + \
+                    (response.content_length if response.content_length is not None else len(body))
+        except aiohttp.ClientError:
+            self.errors += 1
+            self.status_codes["error"] += 1
+            return None, None, None
+        self.latencies.append(time.perf_counter() - started)
+        self.status_codes[status] += 1
+        if status >= 500:
+            self.errors += 1
+            self.failure = ServerError(f"{method} {path} answered {status}: {body[:500].decode(errors='replace')}")
+            raise self.failure
+        return status, body, response_headers
+
+    async def wait_until_ready(self, keys, timeout):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and not all(key in self.ready_at for key in keys):
+            # Clients polling in the background hit it first
+            if self.failure is not None:
+                raise self.failure
+            await asyncio.sleep(0.05)
+        return sum(1 for key in keys if key in self.ready_at)
+
+    def report(self, duration):
+        return {
+            "requests": len(self.latencies),
+            "errors": self.errors,
+            "bytes_received": self.bytes_received,
+            "duration_s": duration,
+            "throughput_rps": len(self.latencies) / duration if duration else 0,
+            "latency_ms": percentiles(self.latencies, 1000),
+            "status_codes": {str(status): count for status, count in sorted(self.status_codes.items(), key=str)},
+            "firestore": {"reads": self.db.reads, "writes": self.db.writes,
+                          "round_trips": self.db.round_trips} if isinstance(self.db, FakeFirestore) else None,
+            "providers": {"openai": self.openai.stats(), "stable_diffusion": self.stable_diffusion.stats()}
+        }
@@ -0,0 +1,89 @@
+# Overhead of the metrics middleware, histograms and spans compared to a typical request.
+# Run with: python -m bench.observability --requests 20000 --request-ms 5
+import argparse
+import asyncio
+import json
+import time
+
+from src.main import MetricsMiddleware
+from src.metrics import Histogram, timed
+from src.tracing import Span, span
+
+
+class FakeApp:
+    # Stands in for Starlette: routes the request to an endpoint and sends a small JSON body
+    def __init__(self):
+        self.routes = [type("Route", (), {"endpoint": self.endpoint, "path": "/story/status/"})()]
+
+    async def endpoint(self):
+        return b'{"story_id":1,"status":"StoryReady","version":3}'
+
+    async def __call__(self, scope, receive, send):
+        scope["endpoint"] = self.endpoint
+        body = await self.endpoint()
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": body})
+
+
+async def drive(app, requests):
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def send(message):
+        pass
+
+    fake_app = app.app if isinstance(app, MetricsMiddleware) else app
+    started = time.perf_counter()
+    for _ in range(requests):
+        scope = {"type": "http", "method": "GET", "path": "/story/status/", "app": fake_app}
+        await app(scope, receive, send)
+    return (time.perf_counter() - started) / requests
+
+
+def per_call(function, calls):
+    started = time.perf_counter()
+    for _ in range(calls):
+        function()
+    return (time.perf_counter() - started) / calls
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--request-ms", type=float, default=5, help="Typical request latency to compare against")
+    args = parser.parse_args()
+
+    bare = FakeApp()
+    baseline = asyncio.run(drive(bare, args.requests))
+    instrumented = asyncio.run(drive(MetricsMiddleware(FakeApp()), args.requests))
+    middleware_overhead = max(instrumented - baseline, 0)
+
+    histogram = Histogram()
+
+    def timed_block():
+        with timed(histogram):
+            pass
+
+    def disabled_span():
+        with span("bench", "user", 1):
+            pass
+
+    def enabled_span():
+        with Span("bench", "0" * 32, None, {}):
+            pass
+
+    # A story request touches the middleware once, plus a few timed blocks and spans on the way
+    per_request = middleware_overhead + 4 * per_call(timed_block, args.requests) + \
+        4 * per_call(disabled_span, args.requests)
+    print(json.dumps({
+        "middleware_overhead_us": middleware_overhead * 1e6,
+        "timed_block_us": per_call(timed_block, args.requests) * 1e6,
+        "span_disabled_us": per_call(disabled_span, args.requests) * 1e6,
+        "span_enabled_us": per_call(enabled_span, args.requests) * 1e6,
+        "overhead_percent_of_request": per_request / (args.request_ms / 1000) * 100,
+        "under_budget": per_request / (args.request_ms / 1000) < 0.02
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
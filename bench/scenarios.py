@@ -0,0 +1,255 @@
+# Repeatable load scenarios. Each seeds the database, boots the harness and drives clients against it, returning
+# a JSON-ready result. Random choices are seeded so two runs of a scenario do the same work.
+import asyncio
+import collections
+import datetime
+import random
+import time
+
+import orjson
+
+DAY = 24 * 60 * 60
+STORY_PROMPT = "Write a adventure short story featuring Mia with a starting and ending."
+POISON_MARKER = "POISON"
+
+
+def seed_user(writes, db, user_id, stories, latest_status="StoryReady", latest_read=False, last_generated=None,
+              story_request_due=None, prompt=STORY_PROMPT):
+    from src.functions.work_queue import STORY_REQUEST_QUEUE, queue_ref
+    from src.models import Story, StoryStatus, UserDbObject, UserSubscriptionObject
+
+    now = datetime.datetime.utcnow().timestamp()
+    last_generated = now - DAY / 2 if last_generated is None else last_generated
+    user = UserDbObject(
+        name=f"Reader {user_id}",
+        email=f"{user_id}@example.com",
+        profile_picture="",
+        user_id=user_id,
+        last_story_generated_timestamp=last_generated,
+        subscription=UserSubscriptionObject(start_date_timestamp=int(now - DAY),
+                                            end_date_timestamp=int(now + 30 * DAY),
+                                            finished_free_story=True, isActive=True),
+        config={"main_character_name": "Mia", "age_group": "children", "genre": "adventure"},
+        story_count=stories
+    ).dict()
+    user.update({"story_version": stories, "latest_story_id": stories - 1, "latest_story_status": latest_status,
+                 "latest_story_available_timestamp": 0})
+    user_ref = db.collection("users").document(user_id)
+    writes.set(user_ref, user)
+    for story_id in range(stories):
+        latest = story_id == stories - 1
+        status = StoryStatus(latest_status) if latest else StoryStatus.StoryReady
+        story = Story(
+            prompt=prompt,
+            generated_story="" if status == StoryStatus.PendingTextGeneration else "Once upon a time. " * 40,
+            generated_summary="" if status == StoryStatus.PendingTextGeneration else "Mia and the moon",
+            status=status,
+            read_status="read" if not latest or latest_read else "unread",
+            story_id=story_id,
+            timestamp=int(last_generated - (stories - 1 - story_id) * DAY)
+        ).dict()
+        writes.set(user_ref.collection("stories").document(str(story_id)), story)
+        entry = {"user_id": user_id, "story_id": story_id, "updated_at": now}
+        if latest and status != StoryStatus.StoryReady:
+            writes.set(queue_ref(db, user_id, story_id), dict(entry, status=status, run_at=0))
+        elif latest and story_request_due is not None:
+            writes.set(queue_ref(db, user_id, story_id), dict(entry, status=STORY_REQUEST_QUEUE,
+                                                              run_at=story_request_due))
+
+
+def seed(users, **options):
+    def seed_users(db):
+        from src.functions.write_coalescer import WriteCoalescer
+
+        writes = WriteCoalescer(db)
+        for index, user_id in enumerate(users):
+            user_options = {name: value(index) if callable(value) else value for name, value in options.items()}
+            seed_user(writes, db, user_id, **user_options)
+        writes.commit()
+
+    return seed_users
+
+
+async def run_clients(clients, duration, client):
+    # `client(number, deadline)` loops until the deadline, all of them start together
+    deadline = time.monotonic() + duration
+    await asyncio.gather(*(client(number, deadline) for number in range(clients)))
+
+
+async def polling_storm(harness_factory, users=500, clients=2000, duration=20, poll_interval=2.0):
+    # Thousands of readers polling /story/ for a story that has not changed, first sending back the ETag they were
+    # given and then never, to compare what the server spends and sends with and without 304s. CPU time is this
+    # process's, clients included, who do the same work either way.
+    from bench.harness import percentiles
+
+    user_ids = [f"poll-{index}" for index in range(users)]
+    harness = await harness_factory().start(seed(user_ids, stories=1))
+    rng = random.Random(1)
+    etags = {}
+
+    def poll_client(send_etags):
+        async def client(number, deadline):
+            # Spread over the interval like real clients would be
+            await asyncio.sleep(rng.uniform(0, poll_interval))
+            while time.monotonic() < deadline:
+                user_id = rng.choice(user_ids)
+                headers = {"If-None-Match": etags[user_id]} if send_etags and user_id in etags else {}
+                status, _, response_headers = await harness.request("GET", "/story/", user_id, headers)
+                if status in (200, 304) and response_headers.get("ETag"):
+                    etags[user_id] = response_headers["ETag"]
+                await asyncio.sleep(poll_interval)
+        return client
+
+    async def phase(send_etags):
+        requests, bytes_received, statuses = len(harness.latencies), harness.bytes_received, \
+            collections.Counter(harness.status_codes)
+        cpu_started, started = time.process_time(), time.monotonic()
+        await run_clients(clients, duration, poll_client(send_etags))
+        elapsed, cpu = time.monotonic() - started, time.process_time() - cpu_started
+        latencies = harness.latencies[requests:]
+        return {"requests": len(latencies), "throughput_rps": len(latencies) / elapsed,
+                "latency_ms": percentiles(latencies, 1000),
+                "status_codes": {str(status): count - statuses[status]
+                                 for status, count in harness.status_codes.items() if count > statuses[status]},
+                "bytes_per_request": (harness.bytes_received - bytes_received) / max(len(latencies), 1),
+                "cpu_s": cpu, "cpu_ms_per_request": cpu * 1000 / max(len(latencies), 1)}
+
+    async def connect(number):
+        # Every client connected and every user's ETag known before anything is measured
+        await harness.request("GET", "/story/", user_ids[number % users])
+
+    try:
+        started = time.monotonic()
+        await asyncio.gather(*(connect(number) for number in range(max(clients, users))))
+        with_etags = await phase(send_etags=True)
+        without_etags = await phase(send_etags=False)
+        return dict(harness.report(time.monotonic() - started), parameters={
+            "users": users, "clients": clients, "duration": duration, "poll_interval": poll_interval},
+            with_etags=with_etags, without_etags=without_etags,
+            bytes_saved=1 - with_etags["bytes_per_request"] / without_etags["bytes_per_request"],
+            cpu_saved=1 - with_etags["cpu_ms_per_request"] / without_etags["cpu_ms_per_request"])
+    finally:
+        await harness.stop()
+
+
+async def new_story_burst(harness_factory, users=200, clients=50, timeout=300):
+    # Every user becomes due for their next story at once while they poll /story/status/ for it
+    now = datetime.datetime.utcnow().timestamp()
+    user_ids = [f"burst-{index}" for index in range(users)]
+    harness = await harness_factory().start(seed(user_ids, stories=1, latest_read=True, last_generated=now - 2 * DAY,
+                                                 story_request_due=now - 60))
+    rng = random.Random(2)
+    expected = [(user_id, 1) for user_id in user_ids]
+
+    async def client(number, deadline):
+        while time.monotonic() < deadline and len(harness.ready_at) < len(expected):
+            await harness.request("GET", "/story/status/", rng.choice(user_ids))
+            await asyncio.sleep(0.5)
+
+    try:
+        started = time.monotonic()
+        polling = asyncio.create_task(run_clients(clients, timeout, client))
+        ready = await harness.wait_until_ready(expected, timeout)
+        duration = time.monotonic() - started
+        polling.cancel()
+        return dict(harness.report(duration), parameters={"users": users, "clients": clients, "timeout": timeout},
+                    stories_ready=ready, stories_expected=len(expected),
+                    time_to_ready_s=time_to_ready(harness, expected, started))
+    finally:
+        await harness.stop()
+
+
+async def backlog_drain(harness_factory, users=500, timeout=600):
+    # The workers come back after downtime to stories stuck in every pending status
+    statuses = ("PendingTextGeneration", "PendingImageGeneration")
+    user_ids = [f"backlog-{index}" for index in range(users)]
+    harness = await harness_factory().start(seed(user_ids, stories=2,
+                                                 latest_status=lambda index: statuses[index % len(statuses)]))
+    expected = [(user_id, 1) for user_id in user_ids]
+    try:
+        started = time.monotonic()
+        ready = await harness.wait_until_ready(expected, timeout)
+        duration = time.monotonic() - started
+        return dict(harness.report(duration), parameters={"users": users, "timeout": timeout},
+                    stories_ready=ready, stories_expected=len(expected),
+                    drain_throughput_stories_per_s=ready / duration if duration else 0,
+                    time_to_ready_s=time_to_ready(harness, expected, started))
+    finally:
+        await harness.stop()
+
+
+async def poisoned_backlog(harness_factory, users=200, poisoned=10, failure_rate=0.05, malformed_rate=0.05,
+                           timeout=600):
+    # A backlog where the text provider always fails a few stories and every provider fails some calls at random.
+    # The healthy stories should all finish at full speed while the poisoned ones end up dead-lettered.
+    user_ids = [f"poison-{index}" for index in range(users)]
+    harness = await harness_factory(
+        openai_options={"failure_rate": failure_rate, "poison_marker": POISON_MARKER},
+        stable_diffusion_options={"failure_rate": failure_rate, "malformed_rate": malformed_rate}
+    ).start(seed(user_ids, stories=1, latest_status="PendingTextGeneration",
+                 prompt=lambda index: f"{POISON_MARKER} {STORY_PROMPT}" if index < poisoned else STORY_PROMPT))
+    expected = [(user_id, 0) for user_id in user_ids[poisoned:]]
+    poisoned_keys = [(user_id, 0) for user_id in user_ids[:poisoned]]
+    try:
+        started = time.monotonic()
+        ready = await harness.wait_until_ready(expected, timeout)
+        drained = time.monotonic() - started
+        deadline = started + timeout
+        while time.monotonic() < deadline and not all(key in harness.dead_lettered for key in poisoned_keys):
+            await asyncio.sleep(0.05)
+        duration = time.monotonic() - started
+        return dict(harness.report(duration), parameters={
+            "users": users, "poisoned": poisoned, "failure_rate": failure_rate, "malformed_rate": malformed_rate,
+            "timeout": timeout},
+            stories_ready=ready, stories_expected=len(expected),
+            dead_lettered=sum(1 for key in poisoned_keys if key in harness.dead_lettered),
+            healthy_dead_lettered=sum(1 for key in expected if key in harness.dead_lettered),
+            drain_throughput_stories_per_s=ready / drained if drained else 0,
+            time_to_dead_letter_s=duration,
+            time_to_ready_s=time_to_ready(harness, expected, started))
+    finally:
+        await harness.stop()
+
+
+async def large_histories(harness_factory, users=20, stories=500, clients=20, duration=20, page_size=50):
+    # Readers with long histories paging through /stories/ and opening their latest story
+    user_ids = [f"history-{index}" for index in range(users)]
+    harness = await harness_factory().start(seed(user_ids, stories=stories))
+    rng = random.Random(4)
+
+    async def client(number, deadline):
+        while time.monotonic() < deadline:
+            user_id = rng.choice(user_ids)
+            cursor = None
+            for _ in range(rng.randint(1, 5)):
+                params = {"limit": page_size} if cursor is None else {"limit": page_size, "cursor": cursor}
+                status, body, _ = await harness.request("GET", "/stories/", user_id, params=params)
+                if status != 200:
+                    break
+                cursor = orjson.loads(body)["next_cursor"]
+                if cursor is None:
+                    break
+            await harness.request("GET", "/story/", user_id)
+
+    try:
+        started = time.monotonic()
+        await run_clients(clients, duration, client)
+        return dict(harness.report(time.monotonic() - started), parameters={
+            "users": users, "stories": stories, "clients": clients, "duration": duration, "page_size": page_size})
+    finally:
+        await harness.stop()
+
+
+def time_to_ready(harness, expected, started):
+    from bench.harness import percentiles
+
+    return percentiles([harness.ready_at[key] - started for key in expected if key in harness.ready_at])
+
+
+SCENARIOS = {
+    "polling_storm": polling_storm,
+    "new_story_burst": new_story_burst,
+    "backlog_drain": backlog_drain,
+    "poisoned_backlog": poisoned_backlog,
+    "large_histories": large_histories
+}
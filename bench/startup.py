@@ -0,0 +1,105 @@
+# Cold import time and resident memory of each role, every run in a fresh interpreter.
+# Run with: python -m bench.startup --runs 5 [--output results.jsonl]
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Module each role imports, and the environment it runs with
+ROLES = {
+    "api": ("src.main", {"RUN_WORKERS": "False"}),
+    "worker": ("src.worker", {}),
+    "combined": ("src.main", {"RUN_WORKERS": "True"})
+}
+# Should only load once they are used, never at import. The Firestore client, and requests with google-auth under it,
+# are not among them: their transactional decorators and field sentinels are used at import throughout src.
+LAZY_MODULES = ("openai", "firebase_admin", "PIL")
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+imported = time.perf_counter() - started
+rss_kb = 0
+try:
+    with open("/proc/self/status") as status:
+        rss_kb = next(int(line.split()[1]) for line in status if line.startswith("VmRSS:"))
+except OSError:
+    import resource
+    rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // (1024 if sys.platform == "darwin" else 1)
+print(json.dumps({{"import_s": imported, "rss_mb": rss_kb / 1024, "modules": len(sys.modules),
+                  "loaded": [name for name in {lazy!r} if name in sys.modules]}}))
+"""
+
+
+def probe(module, env, importtime=False):
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + \
+        ["-c", PROBE.format(module=module, lazy=LAZY_MODULES)]
+    completed = subprocess.run(command, capture_output=True, text=True, check=True, cwd=ROOT,
+                               env=dict(os.environ, **env))
+    return json.loads(completed.stdout.strip().splitlines()[-1]), completed.stderr
+
+
+def slowest_imports(importtime_log, count):
+    # Packages by the cumulative time of their first import, from the -X importtime log
+    packages = {}
+    for line in importtime_log.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        name = name.strip()
+        if cumulative.strip().isdigit() and "." not in name:
+            packages[name] = max(packages.get(name, 0), int(cumulative))
+    ranked = sorted(packages.items(), key=lambda package: -package[1])[:count]
+    return {name: microseconds / 1e6 for name, microseconds in ranked}
+
+
+def measure(role, runs):
+    module, env = ROLES[role]
+    samples = [probe(module, env)[0] for _ in range(runs)]
+    _, importtime_log = probe(module, env, importtime=True)
+    return {
+        "import_s": {"median": statistics.median(sample["import_s"] for sample in samples),
+                     "min": min(sample["import_s"] for sample in samples)},
+        "rss_mb": statistics.median(sample["rss_mb"] for sample in samples),
+        "modules": samples[-1]["modules"],
+        "lazy_modules_loaded": samples[-1]["loaded"],
+        "slowest_imports_s": slowest_imports(importtime_log, 10)
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.startup")
+    # Checked below, argparse checks a nargs="*" default against `choices` as a whole and rejects it
+    parser.add_argument("roles", nargs="*", metavar="{api,combined,worker}", help="Roles to measure, all by default")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters per role, the median is reported")
+    parser.add_argument("--output", help="Append the JSON result as one line to this file")
+    args = parser.parse_args(argv)
+    unknown = [role for role in args.roles if role not in ROLES]
+    if unknown:
+        parser.error(f"unknown roles: {', '.join(unknown)} (choose from {', '.join(sorted(ROLES))})")
+    args.roles = args.roles or sorted(ROLES)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    from bench.__main__ import current_commit
+
+    result = {"scenario": "startup", "commit": current_commit(), "timestamp": datetime.datetime.utcnow().isoformat(),
+              "parameters": {"runs": args.runs},
+              "roles": {role: measure(role, args.runs) for role in args.roles}}
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "a") as output:
+            output.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
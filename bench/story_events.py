@@ -0,0 +1,98 @@
+# Memory per idle /story/events/ connection and how long a story change takes to reach every one of them, published
+# in this process or relayed from another one through the Firestore listener. Each connection is a task iterating
+# story_event_stream, as StreamingResponse runs it.
+# Run with: python -m bench.story_events --connections 10000 [--output results.jsonl]
+import argparse
+import asyncio
+import datetime
+import json
+import time
+import tracemalloc
+
+from bench.fake_firestore import FakeFirestore
+from bench.harness import percentiles
+from bench.scenarios import seed
+
+
+async def fan_out(connections, relayed):
+    from src.events import InProcessEventBackend, StoryEventHub, relay_story_changes, story_event_stream
+    from src.functions.story_store import user_story_fields
+
+    hub = StoryEventHub(InProcessEventBackend())
+    loop = asyncio.get_running_loop()
+    hub.bind(loop)
+    user_ids = [f"events-{index}" for index in range(connections)]
+    db = FakeFirestore()
+    watch = None
+    if relayed:
+        seed(user_ids, stories=1, latest_status="PendingImageGeneration")(db)
+        watch = relay_story_changes(db, hub)
+    received = {}
+
+    async def connection(user_id):
+        async for message in story_event_stream(user_id, hub=hub):
+            if message.startswith("event: story"):
+                received[user_id] = time.perf_counter()
+
+    # Everything a connection holds while idle: its task, the stream generator, its queue and heartbeat timer
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tasks = [asyncio.create_task(connection(user_id)) for user_id in user_ids]
+    while hub.backend.subscriber_count() < connections:
+        await asyncio.sleep(0.01)
+    memory_per_connection = (tracemalloc.get_traced_memory()[0] - before) / connections
+    tracemalloc.stop()
+
+    def commit_story_changes():
+        # On a thread, as workers commit, one story reaching StoryReady per user
+        published = {}
+        for user_id in user_ids:
+            story = {"story_id": 0, "status": "StoryReady"}
+            published[user_id] = time.perf_counter()
+            if relayed:
+                # Written by a worker in another process, only the listener hears of it here
+                db.collection("users").document(user_id).update(user_story_fields(story))
+            else:
+                hub.publish_story_change(user_id, story)
+        return published
+
+    try:
+        started = time.perf_counter()
+        published = await asyncio.to_thread(commit_story_changes)
+        deadline = time.monotonic() + 60
+        while len(received) < connections and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        duration = time.perf_counter() - started
+    finally:
+        if watch is not None:
+            watch.unsubscribe()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return {"relayed": relayed, "connections": connections, "received": len(received),
+            "memory_per_connection_bytes": memory_per_connection,
+            "fan_out_latency_ms": percentiles([received[user_id] - published[user_id] for user_id in received],
+                                              1000),
+            "all_received_s": duration}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.story_events")
+    parser.add_argument("--connections", type=int, default=10000, help="Idle connections, one user each")
+    parser.add_argument("--output", help="Append the JSON result as one line to this file")
+    args = parser.parse_args(argv)
+
+    from bench.__main__ import current_commit
+
+    result = {"scenario": "story_events", "commit": current_commit(),
+              "timestamp": datetime.datetime.utcnow().isoformat(), "parameters": {"connections": args.connections},
+              "in_process": asyncio.run(fan_out(args.connections, relayed=False)),
+              "relayed": asyncio.run(fan_out(args.connections, relayed=True))}
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "a") as output:
+            output.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+# Bytes read and latency of the story endpoints for one user with a long history, with stories in an array on the
+# user document as before and as documents under users/{uid}/stories now. Both run against the fake Firestore,
+# with a round-trip latency and a bandwidth so that what a read returns costs time too.
+# Run with: python -m bench.story_layout --stories 200 [--output results.jsonl]
+import argparse
+import datetime
+import json
+import statistics
+import time
+
+from bench.fake_firestore import FakeFirestore
+from bench.scenarios import seed
+
+USER_ID = "history-0"
+
+
+def array_layout(db, source):
+    # The user document as it was before the stories moved out, every story inline
+    user = source.collection("users").document(USER_ID).get().to_dict()
+    stories = [story.to_dict() for story in source.collection("users").document(USER_ID).collection("stories")
+               .order_by("story_id").stream()]
+    db.collection("users").document(USER_ID).set(dict(user, stories=stories))
+
+
+def array_operations(db):
+    # What the endpoints did with the array, all of them start from the whole user document
+    user_ref = db.collection("users").document(USER_ID)
+
+    def get_user():
+        user_ref.get().to_dict()
+
+    def latest_story():
+        stories = user_ref.get().to_dict()["stories"]
+        return [story for story in stories if story["status"] == "StoryReady"][-1]
+
+    def list_stories():
+        return user_ref.get().to_dict()["stories"]
+
+    def read_story():
+        stories = user_ref.get().to_dict()["stories"]
+        stories[-1]["read_status"] = "read"
+        user_ref.update({"stories": stories})
+
+    return {"get_user": get_user, "latest_story": latest_story, "list_stories": list_stories,
+            "read_story": read_story}
+
+
+def document_operations(db):
+    from src.functions.story_store import find_latest_story, list_stories, mark_story_read
+    from src.models import StoryStatus
+
+    user_ref = db.collection("users").document(USER_ID)
+    story_id = user_ref.get().to_dict()["story_count"] - 1
+
+    def get_user():
+        user_ref.get().to_dict()
+
+    def latest_story():
+        # The user document first, as /story/ checks the user exists
+        user_ref.get()
+        return find_latest_story(db, USER_ID, StoryStatus.StoryReady,
+                                 available_at=datetime.datetime.utcnow().timestamp())
+
+    def first_page():
+        return list_stories(db, USER_ID)
+
+    def read_story():
+        mark_story_read(db, USER_ID, story_id)
+
+    return {"get_user": get_user, "latest_story": latest_story, "list_stories": first_page,
+            "read_story": read_story}
+
+
+def measure(operations, db, runs):
+    results = {}
+    for name, operation in operations.items():
+        bytes_read, reads = db.bytes_read, db.reads
+        latencies = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            operation()
+            latencies.append(time.perf_counter() - started)
+        results[name] = {"bytes_read": (db.bytes_read - bytes_read) / runs, "reads": (db.reads - reads) / runs,
+                         "p50_ms": statistics.median(latencies) * 1000, "max_ms": max(latencies) * 1000}
+    return results
+
+
+def compare(stories, runs, latency_ms, bandwidth_mb):
+    bandwidth = bandwidth_mb * 1024 * 1024
+    after = FakeFirestore(latency_ms / 1000, bandwidth)
+    seed([USER_ID], stories=stories)(after)
+    before = FakeFirestore(latency_ms / 1000, bandwidth)
+    array_layout(before, after)
+    after.bytes_read = before.bytes_read = 0
+    return {"before": measure(array_operations(before), before, runs),
+            "after": measure(document_operations(after), after, runs)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.story_layout")
+    parser.add_argument("--stories", type=int, default=200, help="Stories in the user's history")
+    parser.add_argument("--runs", type=int, default=20, help="Calls per endpoint, the median is reported")
+    parser.add_argument("--latency-ms", type=float, default=5, help="Firestore round-trip")
+    parser.add_argument("--bandwidth-mb", type=float, default=10, help="Megabytes a second a read's documents arrive at")
+    parser.add_argument("--output", help="Append the JSON result as one line to this file")
+    args = parser.parse_args(argv)
+
+    from bench.__main__ import current_commit
+
+    result = dict({"scenario": "story_layout", "commit": current_commit(),
+                   "timestamp": datetime.datetime.utcnow().isoformat(),
+                   "parameters": {"stories": args.stories, "runs": args.runs, "latency_ms": args.latency_ms,
+                                  "bandwidth_mb": args.bandwidth_mb}},
+                  **compare(args.stories, args.runs, args.latency_ms, args.bandwidth_mb))
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "a") as output:
+            output.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# Requests per second on /story/ with the verified-token cache on and off. Tokens are signed RS256 with a locally
+# generated key, so a verification costs what checking a Firebase ID token's signature does. Each mode runs in a
+# fresh interpreter, the service keeps module level state.
+# Run with: python -m bench.token_cache --users 200 --clients 50 --duration 10 [--output results.jsonl]
+import argparse
+import asyncio
+import datetime
+import json
+import subprocess
+import sys
+import time
+
+from bench.harness import Harness, LocalTokenSigner
+from bench.scenarios import run_clients, seed
+
+
+async def measure(cached, users, clients, duration):
+    harness = Harness(signer=LocalTokenSigner(algorithm="RS256"))
+    user_ids = [f"token-{index}" for index in range(users)]
+    await harness.start(seed(user_ids, stories=1))
+
+    from src.token_cache import token_cache
+
+    if not cached:
+        async def verify_every_request(token):
+            return (await asyncio.to_thread(token_cache._verify, token))["uid"]
+
+        # Every request verifies its token's signature, as before the cache
+        token_cache.get_user_id = verify_every_request
+
+    async def client(number, deadline):
+        index = number
+        while time.monotonic() < deadline:
+            status, _, _ = await harness.request("GET", "/story/", user_ids[index % users])
+            assert status == 200, status
+            index += clients
+
+    try:
+        started = time.monotonic()
+        await run_clients(clients, duration, client)
+        report = harness.report(time.monotonic() - started)
+    finally:
+        await harness.stop()
+    return {"cached": cached, "throughput_rps": report["throughput_rps"], "latency_ms": report["latency_ms"],
+            "requests": report["requests"], "token_cache": token_cache.stats() if cached else None}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.token_cache")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10, help="Seconds to drive load for, per mode")
+    parser.add_argument("--mode", choices=("on", "off"), help="Run only this mode, in this process")
+    parser.add_argument("--output", help="Append the JSON result as one line to this file")
+    args = parser.parse_args(argv)
+    if args.mode:
+        print(json.dumps(asyncio.run(measure(args.mode == "on", args.users, args.clients, args.duration))))
+        return
+
+    from bench.__main__ import current_commit
+
+    modes = {}
+    for mode in ("off", "on"):
+        completed = subprocess.run([sys.executable, "-m", "bench.token_cache", "--mode", mode, "--users",
+                                    str(args.users), "--clients", str(args.clients), "--duration",
+                                    str(args.duration)], capture_output=True, text=True, check=True)
+        modes[mode] = json.loads(completed.stdout.strip().splitlines()[-1])
+    result = {"scenario": "token_cache", "commit": current_commit(),
+              "timestamp": datetime.datetime.utcnow().isoformat(),
+              "parameters": {"users": args.users, "clients": args.clients, "duration": args.duration},
+              "cache_off": modes["off"], "cache_on": modes["on"],
+              "speedup": modes["on"]["throughput_rps"] / modes["off"]["throughput_rps"]}
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "a") as output:
+            output.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
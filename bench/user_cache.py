@@ -0,0 +1,118 @@
+# Simulated polling population against a fake Firestore with network latency, with and without the user cache.
+# Run with: python -m bench.user_cache --users 5000 --poll-interval 5 --minutes 10
+import argparse
+import json
+import random
+import statistics
+import time
+
+from src.user_cache import UserDocumentCache
+
+
+class FakeSnapshot:
+    def __init__(self, doc):
+        self._doc = doc
+
+    def to_dict(self):
+        return dict(self._doc) if self._doc is not None else None
+
+
+class FakeDocument:
+    def __init__(self, db, user_id):
+        self._db = db
+        self._user_id = user_id
+
+    def get(self, field_paths=None):
+        self._db.reads += 1
+        self._db.pending_latency += self._db.read_latency()
+        return FakeSnapshot(self._db.docs.get(self._user_id))
+
+
+class FakeFirestore:
+    def __init__(self, users, latency_ms):
+        self.docs = {f"user-{index}": {"user_id": f"user-{index}", "story_version": 0, "latest_story_id": 0,
+                                       "latest_story_status": "StoryReady", "read_hours": [21.0] * 14}
+                     for index in range(users)}
+        # Called like relay_story_changes does, with every changed user document
+        self.relay = None
+        self.latency_ms = latency_ms
+        self.reads = 0
+        self.pending_latency = 0
+
+    def read_latency(self):
+        # Long tailed like a real round-trip
+        return random.lognormvariate(0, 0.5) * self.latency_ms / 1000
+
+    def collection(self, name):
+        return self
+
+    def document(self, user_id):
+        return FakeDocument(self, user_id)
+
+    def write(self, user_id):
+        self.docs[user_id] = dict(self.docs[user_id], story_version=self.docs[user_id]["story_version"] + 1)
+        if self.relay is not None:
+            # Firestore bills each change a listener hears of as a read
+            self.reads += 1
+            self.relay(user_id, dict(self.docs[user_id]))
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def simulate(users, poll_interval, minutes, changes_per_user_per_hour, latency_ms, cache_bytes, ttl, cached):
+    db = FakeFirestore(users, latency_ms)
+    # Simulated time, the polls of all users spread evenly over each interval
+    clock = Clock()
+    cache = UserDocumentCache(cache_bytes, ttl, clock) if cached else None
+    if cached:
+        db.relay = cache.refresh
+    latencies = []
+    polls = int(minutes * 60 / poll_interval) * users
+    change_probability = changes_per_user_per_hour * poll_interval / 3600
+    for _ in range(polls):
+        clock.now += poll_interval / users
+        user_id = f"user-{random.randrange(users)}"
+        if random.random() < change_probability:
+            db.write(user_id)
+        db.pending_latency = 0
+        started = time.perf_counter()
+        if cached:
+            cache.get(db, user_id)
+        else:
+            db.document(user_id).get()
+        latencies.append(time.perf_counter() - started + db.pending_latency)
+    quantiles = statistics.quantiles(latencies, n=100)
+    result = {
+        "cached": cached,
+        "firestore_reads_per_minute": db.reads / minutes,
+        "p50_ms": quantiles[49] * 1000,
+        "p99_ms": quantiles[98] * 1000
+    }
+    if cached:
+        result["cache"] = cache.stats()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--poll-interval", type=float, default=5, help="Seconds between polls of each user")
+    parser.add_argument("--minutes", type=float, default=5)
+    parser.add_argument("--changes-per-hour", type=float, default=4, help="Story changes per user per hour")
+    parser.add_argument("--latency-ms", type=float, default=25, help="Median Firestore round-trip")
+    parser.add_argument("--cache-bytes", type=int, default=32 * 1024 * 1024)
+    parser.add_argument("--ttl", type=float, default=60, help="Seconds a cached user is served without a read")
+    args = parser.parse_args()
+    results = [simulate(args.users, args.poll_interval, args.minutes, args.changes_per_hour, args.latency_ms,
+                        args.cache_bytes, args.ttl, cached) for cached in (False, True)]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
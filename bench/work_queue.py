@@ -0,0 +1,66 @@
+# What finding pending work costs as the user base grows and the pending work doesn't: the same number of stories
+# waiting in each stage among N users and among 10N. The workers' scans read the work queue, the full scan of the
+# users collection is what they did before it existed. Reads and round-trips are what Firestore bills and waits on,
+# the durations also include the fake filtering a whole collection in Python where Firestore uses an index.
+# Run with: python -m bench.work_queue --users 1000 --pending 100 [--output results.jsonl]
+import argparse
+import datetime
+import json
+import time
+
+from bench.fake_firestore import FakeFirestore
+from bench.scenarios import seed
+
+PENDING_STATUSES = ("PendingTextGeneration", "PendingImageGeneration")
+
+
+def measure_scan(db, scan):
+    documents_read, round_trips = db.documents_read, db.round_trips
+    started = time.perf_counter()
+    found = scan()
+    return {"found": found, "documents_read": db.documents_read - documents_read,
+            "round_trips": db.round_trips - round_trips, "duration_ms": (time.perf_counter() - started) * 1000}
+
+
+def scan_costs(users, pending, latency_ms=0.0):
+    from src.functions.work_queue import STORY_REQUEST_QUEUE, fetch_pending_work, iterate_pending_work
+
+    db = FakeFirestore(latency_ms / 1000)
+    user_ids = [f"scan-{index}" for index in range(users)]
+    # Everyone else has read their latest story, and is due for the next one tomorrow
+    seed(user_ids[pending:], stories=1, latest_read=True,
+         story_request_due=datetime.datetime.utcnow().timestamp() + 86400)(db)
+    seed(user_ids[:pending], stories=1,
+         latest_status=lambda index: PENDING_STATUSES[index % len(PENDING_STATUSES)])(db)
+    now = datetime.datetime.utcnow().timestamp()
+    result = {status: measure_scan(db, lambda: len(list(iterate_pending_work(db, status))))
+              for status in PENDING_STATUSES}
+    result[STORY_REQUEST_QUEUE] = measure_scan(db, lambda: len(fetch_pending_work(db, STORY_REQUEST_QUEUE,
+                                                                                  due_before=now)))
+    result["full_users_scan"] = measure_scan(db, lambda: sum(1 for _ in db.collection("users").stream()))
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.work_queue")
+    parser.add_argument("--users", type=int, default=1000, help="Users in the smaller run, the larger has 10x")
+    parser.add_argument("--pending", type=int, default=100, help="Stories waiting in the pipeline stages")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Added to every fake Firestore round-trip")
+    parser.add_argument("--output", help="Append the JSON result as one line to this file")
+    args = parser.parse_args(argv)
+
+    from bench.__main__ import current_commit
+
+    result = {"scenario": "work_queue", "commit": current_commit(),
+              "timestamp": datetime.datetime.utcnow().isoformat(),
+              "parameters": {"users": args.users, "pending": args.pending, "latency_ms": args.latency_ms},
+              "users": {str(users): scan_costs(users, args.pending, args.latency_ms)
+                        for users in (args.users, 10 * args.users)}}
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "a") as output:
+            output.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+# API server entry point: python -m src.api [--host HOST] [--port PORT] [--workers N] [--with-workers]
+# Runs only the HTTP API unless --with-workers is given, the workers run on their own with python -m src.worker.
+# The images workers store are served from here, mount the same volume at IMAGE_STORE_PATH in both or every API
+# process downloads each image once more.
+import argparse
+import os
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.api")
+    parser.add_argument("--host", default=os.getenv("HTTP_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("HTTP_PORT", 8000)))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", 1)),
+                        help="Server processes, each with its own caches")
+    parser.add_argument("--with-workers", action="store_true",
+                        help="Also run the story pipeline in the API process(es), as RUN_WORKERS=True does")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Read by src.config when the app is imported, so it is set before anything from src is
+    os.environ["RUN_WORKERS"] = "True" if args.with_workers else "False"
+
+    import uvicorn
+
+    uvicorn.run("src.main:app", host=args.host, port=args.port, workers=args.workers, lifespan="on")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,79 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', 'RANDOM-VALS')
 STABLE_DIFFUSION_API_KEY = os.getenv('STABLE_DIFFUSION_API_KEY', 'RANDOM-VALS')
 SKIP_STARTUP = os.getenv('SKIP_STARTUP', 'False')
 
+# Provider and database endpoints, overridable to point at local stand-ins
+OPENAI_API_BASE = os.getenv('OPENAI_API_BASE', 'https://api.openai.com/v1')
+STABLE_DIFFUSION_API_BASE = os.getenv('STABLE_DIFFUSION_API_BASE', 'https://stablediffusionapi.com/api')
+FIREBASE_CREDENTIALS = os.getenv('FIREBASE_CREDENTIALS', 'goodnight-ai-firebase-service-account-key.json')
+FIRESTORE_EMULATOR_HOST = os.getenv('FIRESTORE_EMULATOR_HOST', '')
+FIREBASE_PROJECT_ID = os.getenv('FIREBASE_PROJECT_ID', 'demo-goodnight-ai')
+
 # OpenAI SETTINGS
 OPENAI_TEMPERATURE = 0.9,
 OPENAI_MAX_TOKENS = 400
+
+# Provider HTTP client and worker concurrency
+HTTP_CONNECTION_LIMIT = int(os.getenv('HTTP_CONNECTION_LIMIT', 100))
+HTTP_CONNECTION_LIMIT_PER_HOST = int(os.getenv('HTTP_CONNECTION_LIMIT_PER_HOST', 20))
+HTTP_KEEPALIVE_TIMEOUT = int(os.getenv('HTTP_KEEPALIVE_TIMEOUT', 30))
+HTTP_CONNECT_TIMEOUT = int(os.getenv('HTTP_CONNECT_TIMEOUT', 10))
+HTTP_TOTAL_TIMEOUT = int(os.getenv('HTTP_TOTAL_TIMEOUT', 120))
+GENERATION_CONCURRENCY = int(os.getenv('GENERATION_CONCURRENCY', 5))
+
+# Verified Firebase ID token cache
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 10000))
+TOKEN_CACHE_MAX_TTL = int(os.getenv('TOKEN_CACHE_MAX_TTL', 3600))
+SIGNING_CERT_REFRESH_INTERVAL = int(os.getenv('SIGNING_CERT_REFRESH_INTERVAL', 30 * 60))
+
+# Story event stream
+SSE_HEARTBEAT_INTERVAL = int(os.getenv('SSE_HEARTBEAT_INTERVAL', 15))
+SSE_QUEUE_SIZE = int(os.getenv('SSE_QUEUE_SIZE', 32))
+
+# Generation result cache, off unless enabled
+GENERATION_CACHE_ENABLED = os.getenv('GENERATION_CACHE_ENABLED', 'False') == 'True'
+GENERATION_CACHE_PATH = os.getenv('GENERATION_CACHE_PATH', 'generation_cache.sqlite3')
+GENERATION_CACHE_VARIANTS = int(os.getenv('GENERATION_CACHE_VARIANTS', 5))
+GENERATION_CACHE_TTL = int(os.getenv('GENERATION_CACHE_TTL', 7 * 24 * 60 * 60))
+GENERATION_CACHE_BYTES = int(os.getenv('GENERATION_CACHE_BYTES', 16 * 1024 * 1024))
+
+# Pre-generation of the next story during off-peak hours (UTC), e.g. "1-6"
+PREGENERATION_ENABLED = os.getenv('PREGENERATION_ENABLED', 'True') == 'True'
+PREGENERATION_OFF_PEAK_HOURS = os.getenv('PREGENERATION_OFF_PEAK_HOURS', '1-6')
+PREGENERATION_HORIZON = int(os.getenv('PREGENERATION_HORIZON', 24 * 60 * 60))
+PREGENERATION_CONCURRENCY = int(os.getenv('PREGENERATION_CONCURRENCY', 20))
+PREGENERATION_RATE_PER_MINUTE = int(os.getenv('PREGENERATION_RATE_PER_MINUTE', 10))
+
+# Stable Diffusion completion webhook, off unless both are set
+PUBLIC_BASE_URL = os.getenv('PUBLIC_BASE_URL', '')
+STABLE_DIFFUSION_WEBHOOK_SECRET = os.getenv('STABLE_DIFFUSION_WEBHOOK_SECRET', '')
+IMAGE_WEBHOOK_GRACE = int(os.getenv('IMAGE_WEBHOOK_GRACE', 120))
+
+# Work leases, so several processes can run the workers without doing the same story twice
+RUN_WORKERS = os.getenv('RUN_WORKERS', 'True') == 'True'
+WORKER_ID = os.getenv('WORKER_ID', '')
+LEASE_DURATION = int(os.getenv('LEASE_DURATION', 60))
+
+# Finished images are downloaded once and served from here
+IMAGE_STORE_PATH = os.getenv('IMAGE_STORE_PATH', 'image_store')
+IMAGE_THUMBNAIL_SIZE = int(os.getenv('IMAGE_THUMBNAIL_SIZE', 128))
+
+# Provider rate limits and spend budget, adjusted down automatically on 429s
+OPENAI_REQUESTS_PER_MINUTE = int(os.getenv('OPENAI_REQUESTS_PER_MINUTE', 3500))
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv('OPENAI_TOKENS_PER_MINUTE', 90000))
+OPENAI_COST_PER_1K_TOKENS = float(os.getenv('OPENAI_COST_PER_1K_TOKENS', 0.002))
+STABLE_DIFFUSION_REQUESTS_PER_MINUTE = int(os.getenv('STABLE_DIFFUSION_REQUESTS_PER_MINUTE', 60))
+STABLE_DIFFUSION_COST_PER_IMAGE = float(os.getenv('STABLE_DIFFUSION_COST_PER_IMAGE', 0.01))
+DAILY_PROVIDER_BUDGET = float(os.getenv('DAILY_PROVIDER_BUDGET', 50))
+# The budget is shared by every process through Firestore, each one adds its spend this often
+PROVIDER_SPEND_SYNC_INTERVAL = int(os.getenv('PROVIDER_SPEND_SYNC_INTERVAL', 30))
+
+# In-process cache of user documents, story changes replace entries straight away, anything else after the TTL
+USER_CACHE_BYTES = int(os.getenv('USER_CACHE_BYTES', 32 * 1024 * 1024))
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 60))
+
+# Observability, spans are logged as JSON lines when enabled, admin endpoints are off without a token
+TRACING_ENABLED = os.getenv('TRACING_ENABLED', 'False') == 'True'
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+PROFILER_INTERVAL = float(os.getenv('PROFILER_INTERVAL', 0.01))
+# Port a worker-only process serves /metrics on, 0 to turn it off
+WORKER_METRICS_PORT = int(os.getenv('WORKER_METRICS_PORT', 0))
@@ -0,0 +1,185 @@
+import asyncio
+import threading
+import time
+from collections import defaultdict
+
+import orjson
+
+from src.config import SSE_HEARTBEAT_INTERVAL, SSE_QUEUE_SIZE
+
+HEARTBEAT = object()
+# Margin for the clocks of the processes writing story changes being behind this one's
+RELAY_CLOCK_SKEW = 60
+
+
+class InProcessEventBackend:
+    # Delivers events to subscribers in this process only. Another backend (Redis, Firestore listeners, ...)
+    # only needs publish/subscribe/unsubscribe to fan events out between processes.
+    def __init__(self, queue_size=SSE_QUEUE_SIZE):
+        self._queue_size = queue_size
+        self._subscribers = defaultdict(set)
+        # user_id -> the last event published to them, the same change can be heard of more than once
+        self._last_event = {}
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id):
+        self._loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self._queue_size)
+        with self._lock:
+            self._subscribers[user_id].add(queue)
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        with self._lock:
+            queues = self._subscribers.get(user_id)
+            if queues is not None:
+                queues.discard(queue)
+                if not queues:
+                    del self._subscribers[user_id]
+                    self._last_event.pop(user_id, None)
+
+    def has_subscribers(self, user_id):
+        with self._lock:
+            return user_id in self._subscribers
+
+    def publish(self, user_id, event):
+        with self._lock:
+            queues = list(self._subscribers.get(user_id, ()))
+            if not queues or self._last_event.get(user_id) == event:
+                return
+            self._last_event[user_id] = event
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        for queue in queues:
+            if running_loop is self._loop:
+                offer(queue, event)
+            elif self._loop is not None:
+                # Published from another thread, hand over to the loop the subscribers live on
+                self._loop.call_soon_threadsafe(offer, queue, event)
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(queues) for queues in self._subscribers.values())
+
+
+def offer(queue, event):
+    # A subscriber that stopped reading loses events rather than holding up everyone else
+    try:
+        queue.put_nowait(event)
+    except asyncio.QueueFull:
+        pass
+
+
+class StoryEventHub:
+    def __init__(self, backend=None):
+        self.backend = backend or InProcessEventBackend()
+        self._listeners = []
+        self._relay_listeners = []
+        self._loop = None
+        # Set while relay_story_changes delivers every process's changes to the subscribers here
+        self.relayed = False
+
+    def bind(self, loop):
+        # Changes committed on a worker thread are published on this loop, listeners only ever run on it
+        self._loop = loop
+
+    def add_listener(self, listener):
+        # Called with (user_id, story) for every change in this process, for in-process bookkeeping
+        self._listeners.append(listener)
+
+    def add_relay_listener(self, listener):
+        # Called with (user_id, user document) for every story change relay_story_changes hears of, from the
+        # listener's thread
+        self._relay_listeners.append(listener)
+
+    def publish_story_change(self, user_id, story):
+        if self._loop is not None and not is_running_on(self._loop):
+            self._loop.call_soon_threadsafe(self._publish, user_id, story)
+            return
+        self._publish(user_id, story)
+
+    def _publish(self, user_id, story):
+        # Pre-generated stories stay invisible to the reader until they are available
+        if not self.relayed and story.get("available_timestamp", 0) <= time.time():
+            self.backend.publish(user_id, {
+                "story_id": story["story_id"],
+                "status": story["status"]
+            })
+        for listener in self._listeners:
+            listener(user_id, story)
+
+    def relay(self, user_id, user):
+        # A user document as written by touch_user_stories, in whichever process made the change
+        for listener in self._relay_listeners:
+            listener(user_id, user)
+        if user.get("latest_story_id") is None or not self.backend.has_subscribers(user_id):
+            return
+        if user.get("latest_story_available_timestamp", 0) <= time.time():
+            self.backend.publish(user_id, {
+                "story_id": user["latest_story_id"],
+                "status": user["latest_story_status"]
+            })
+
+    def subscribe(self, user_id):
+        return self.backend.subscribe(user_id)
+
+    def unsubscribe(self, user_id, queue):
+        self.backend.unsubscribe(user_id, queue)
+
+
+def is_running_on(loop):
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+
+story_events = StoryEventHub()
+
+
+def relay_story_changes(firestore_db, hub=story_events):
+    # Workers may run in other processes than the API serving /story/events/. One listener per process on the
+    # users whose latest story changed since it started hears of every change, wherever it was made, in commit
+    # order. While it runs it is the only way changes reach subscribers. Returns the watch to unsubscribe.
+    started = {"initial": True}
+
+    def on_snapshot(snapshots, changes, read_time):
+        # What happened before a subscriber connected is in its first event already
+        if started.pop("initial", False):
+            return
+        for change in changes:
+            if change.type.name != "REMOVED":
+                hub.relay(change.document.id, change.document.to_dict())
+
+    query = firestore_db.collection("users").where("latest_story_changed_at", ">", time.time() - RELAY_CLOCK_SKEW)
+    watch = query.on_snapshot(on_snapshot)
+    hub.relayed = True
+    return watch
+
+
+def format_sse(event):
+    return f"event: story\ndata: {orjson.dumps(event).decode()}\n\n"
+
+
+async def story_event_stream(user_id, initial_event=None, heartbeat_interval=SSE_HEARTBEAT_INTERVAL,
+                             hub=story_events):
+    # An idle connection is just a queue and a timer handle, nothing wakes up until an event or heartbeat is due
+    loop = asyncio.get_running_loop()
+    queue = hub.subscribe(user_id)
+    try:
+        yield "retry: 5000\n\n"
+        if initial_event is not None:
+            yield format_sse(initial_event)
+        while True:
+            heartbeat = loop.call_later(heartbeat_interval, offer, queue, HEARTBEAT)
+            event = await queue.get()
+            heartbeat.cancel()
+            if event is HEARTBEAT:
+                yield ": keep-alive\n\n"
+            else:
+                yield format_sse(event)
+    finally:
+        hub.unsubscribe(user_id, queue)
@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import json
+import random
+import sqlite3
+import threading
+import time
+
+from cachetools import LRUCache
+
+from src.config import (GENERATION_CACHE_BYTES, GENERATION_CACHE_ENABLED, GENERATION_CACHE_PATH,
+                        GENERATION_CACHE_TTL, GENERATION_CACHE_VARIANTS)
+from src.metrics import registry
+
+# List and tuples per pool and per variant, on top of the serialized values
+POOL_OVERHEAD = 256
+VARIANT_OVERHEAD = 128
+
+
+def normalize_prompt(prompt):
+    return " ".join(prompt.split())
+
+
+def pool_size(variants):
+    # Variants are (value, created_at, serialized length)
+    return POOL_OVERHEAD + sum(size + VARIANT_OVERHEAD for _, _, size in variants)
+
+
+class GenerationCache:
+    # Keeps up to `variants` results per prompt and model settings. Until the pool is full every request still
+    # calls the provider and adds its result, after that requests pick a random variant and skip the call.
+    # Pools are kept in memory least recently used first, bounded to `max_bytes` of serialized values.
+    def __init__(self, path=GENERATION_CACHE_PATH, variants=GENERATION_CACHE_VARIANTS, ttl=GENERATION_CACHE_TTL,
+                 max_bytes=GENERATION_CACHE_BYTES, enabled=GENERATION_CACHE_ENABLED, timer=time.time):
+        self.enabled = enabled
+        self.variants = variants
+        self.ttl = ttl
+        self._path = path
+        self._timer = timer
+        self._memory = LRUCache(maxsize=max_bytes, getsizeof=pool_size)
+        self._connection = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+        # Average provider latency per kind, what a hit is counted as saving
+        self._latency = {}
+
+    def make_key(self, kind, prompt, **params):
+        raw = json.dumps({"kind": kind, "prompt": normalize_prompt(prompt), "params": params}, sort_keys=True)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def _db(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self._path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS variants (key TEXT NOT NULL, value TEXT NOT NULL, created_at REAL NOT NULL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS variants_key ON variants (key)")
+        return self._connection
+
+    def _remember(self, key, variants):
+        # A pool larger than the whole cache is only kept in SQLite
+        if pool_size(variants) <= self._memory.maxsize:
+            self._memory[key] = variants
+        else:
+            self._memory.pop(key, None)
+
+    def _fresh(self, key):
+        # Called with the lock held
+        variants = self._memory.get(key)
+        if variants is None:
+            rows = self._db().execute(
+                "SELECT value, created_at FROM variants WHERE key = ? AND created_at > ? ORDER BY created_at LIMIT ?",
+                (key, self._timer() - self.ttl, self.variants)).fetchall()
+            variants = [(json.loads(value), created_at, len(value)) for value, created_at in rows]
+            self._remember(key, variants)
+        fresh = [variant for variant in variants if variant[1] > self._timer() - self.ttl]
+        if len(fresh) != len(variants):
+            self._remember(key, fresh)
+        return fresh
+
+    def _load(self, key):
+        with self._lock:
+            return self._fresh(key)
+
+    def _store(self, key, value):
+        # Checked and added under one lock, so concurrent misses for the same key never grow the pool past
+        # `variants`. Returns whether the value was added.
+        created_at = self._timer()
+        encoded = json.dumps(value)
+        with self._lock:
+            variants = self._fresh(key)
+            if len(variants) >= self.variants:
+                return False
+            db = self._db()
+            db.execute("DELETE FROM variants WHERE key = ? AND created_at <= ?", (key, created_at - self.ttl))
+            db.execute("INSERT INTO variants (key, value, created_at) VALUES (?, ?, ?)", (key, encoded, created_at))
+            db.commit()
+            self._remember(key, variants + [(value, created_at, len(encoded))])
+            return True
+
+    async def lookup(self, kind, key):
+        if not self.enabled:
+            return None
+        variants = await asyncio.to_thread(self._load, key)
+        if len(variants) < self.variants:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.seconds_saved += self._latency.get(kind, 0)
+        return random.choice(variants)[0]
+
+    async def store(self, kind, key, value, latency=None):
+        if not self.enabled:
+            return
+        if latency is not None:
+            average = self._latency.get(kind)
+            self._latency[kind] = latency if average is None else average * 0.9 + latency * 0.1
+        await asyncio.to_thread(self._store, key, value)
+
+    async def get_or_generate(self, kind, key, generate):
+        cached = await self.lookup(kind, key)
+        if cached is not None:
+            return cached
+        started = time.monotonic()
+        value = await generate()
+        await self.store(kind, key, value, time.monotonic() - started)
+        return value
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0,
+            "seconds_saved": self.seconds_saved,
+            "keys_in_memory": len(self._memory),
+            "bytes_in_memory": self._memory.currsize
+        }
+
+
+generation_cache = GenerationCache()
+registry.stats("generation_cache", generation_cache.stats)
@@ -0,0 +1,53 @@
+import contextlib
+import contextvars
+
+import aiohttp
+
+from src.config import (HTTP_CONNECT_TIMEOUT, HTTP_CONNECTION_LIMIT, HTTP_CONNECTION_LIMIT_PER_HOST,
+                        HTTP_KEEPALIVE_TIMEOUT, HTTP_TOTAL_TIMEOUT)
+
+# One pooled session shared by every provider call so connections are kept alive between requests
+_session = None
+# Called with the headers of every response received by the current task, see response_headers_to
+_headers_listener = contextvars.ContextVar("headers_listener", default=None)
+
+
+async def _on_request_end(session, context, params):
+    listener = _headers_listener.get()
+    if listener is not None:
+        listener(params.response.headers)
+
+
+@contextlib.contextmanager
+def response_headers_to(listener):
+    # For SDKs that send their requests on the shared session but don't hand back the response headers
+    token = _headers_listener.set(listener)
+    try:
+        yield
+    finally:
+        _headers_listener.reset(token)
+
+
+def get_http_session():
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_CONNECTION_LIMIT,
+            limit_per_host=HTTP_CONNECTION_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT
+        )
+        trace = aiohttp.TraceConfig()
+        trace.on_request_end.append(_on_request_end)
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            trace_configs=[trace],
+            timeout=aiohttp.ClientTimeout(total=HTTP_TOTAL_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        )
+    return _session
+
+
+async def close_http_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
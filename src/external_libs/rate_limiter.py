@@ -0,0 +1,244 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+import time
+
+from src.config import (DAILY_PROVIDER_BUDGET, OPENAI_COST_PER_1K_TOKENS, OPENAI_REQUESTS_PER_MINUTE,
+                        OPENAI_TOKENS_PER_MINUTE, STABLE_DIFFUSION_COST_PER_IMAGE,
+                        STABLE_DIFFUSION_REQUESTS_PER_MINUTE)
+from src.metrics import registry
+
+# Lower goes first: a reader waiting on the stream, then the normal pipeline, then pre-generation
+PRIORITY_INTERACTIVE = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_PREGENERATED = 2
+
+RATE_LIMIT_RETRIES = 3
+# How far a 429 cuts the rate, and how much of the configured rate each success wins back
+RATE_DECREASE_FACTOR = 0.5
+RATE_INCREASE_STEP = 0.05
+MIN_RATE_FRACTION = 0.05
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after=None):
+        super().__init__("Rate limited by provider")
+        self.retry_after = retry_after
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, per_minute, timer):
+        self.per_minute = per_minute
+        self.rate = per_minute
+        self.tokens = per_minute
+        self._timer = timer
+        self._updated = timer()
+
+    def _refill(self):
+        now = self._timer()
+        self.tokens = min(self.rate, self.tokens + (now - self._updated) * self.rate / 60)
+        self._updated = now
+
+    def wait_time(self, amount):
+        self._refill()
+        # Asking for more than a minute's worth would never succeed, let it through once the bucket is full
+        amount = min(amount, self.rate)
+        return 0 if self.tokens >= amount else (amount - self.tokens) * 60 / self.rate
+
+    def take(self, amount):
+        self._refill()
+        self.tokens -= min(amount, self.rate)
+
+    def limit_to(self, remaining):
+        # What the provider says is left, refilled from now on rather than from the last refill
+        self._refill()
+        self.tokens = min(self.tokens, remaining)
+
+
+class ProviderLimiter:
+    # Requests/min and tokens/min buckets for one provider and model, a priority queue of waiters in front of
+    # them and a share of the daily spend budget. The rate backs off on 429s and creeps back up on success.
+    def __init__(self, name, requests_per_minute, tokens_per_minute=None, cost_per_request=0.0,
+                 cost_per_1k_tokens=0.0, daily_budget=DAILY_PROVIDER_BUDGET, timer=time.monotonic):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute, timer)
+        self.tokens = TokenBucket(tokens_per_minute, timer) if tokens_per_minute else None
+        self.cost_per_request = cost_per_request
+        self.cost_per_1k_tokens = cost_per_1k_tokens
+        self.daily_budget = daily_budget
+        self._timer = timer
+        self._waiters = []
+        self._counter = itertools.count()
+        self._changed = asyncio.Event()
+        self._paused_until = 0
+        self._spend_day = None
+        # Spent today by every process as of the last sync, plus what this one spent since
+        self.spent_today = 0.0
+        self._unsynced_spend = 0.0
+        self.admitted = 0
+        self.rejected = 0
+        self.rate_limited = 0
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    def estimate_cost(self, tokens=0):
+        return self.cost_per_request + tokens / 1000 * self.cost_per_1k_tokens
+
+    def _roll_day(self):
+        today = datetime.datetime.utcnow().date()
+        if self._spend_day != today:
+            self._spend_day = today
+            self.spent_today = 0.0
+            self._unsynced_spend = 0.0
+
+    def _check_budget(self, cost):
+        self._roll_day()
+        if self.daily_budget is not None and self.spent_today + cost > self.daily_budget:
+            self.rejected += 1
+            raise BudgetExceeded(f"Daily budget of {self.daily_budget} reached for {self.name}")
+
+    def _wait_time(self, tokens):
+        wait = max(self._paused_until - self._timer(), self.requests.wait_time(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(tokens))
+        return wait
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def acquire(self, tokens=0, priority=PRIORITY_DEFAULT, cost=None):
+        cost = self.estimate_cost(tokens) if cost is None else cost
+        # Nothing queues that could not be paid for now, and nothing is let through that can't be once admitted:
+        # the calls ahead of it in the queue may have spent what was left
+        self._check_budget(cost)
+        waiter = (priority, next(self._counter))
+        heapq.heappush(self._waiters, waiter)
+        try:
+            while True:
+                changed = self._changed
+                wait = self._wait_time(tokens) if self._waiters[0] == waiter else None
+                if wait is not None and wait <= 0:
+                    heapq.heappop(self._waiters)
+                    self._check_budget(cost)
+                    self.requests.take(1)
+                    if self.tokens is not None:
+                        self.tokens.take(tokens)
+                    self._charge(cost)
+                    self.admitted += 1
+                    return
+                try:
+                    await asyncio.wait_for(changed.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                heapq.heapify(self._waiters)
+            self._notify()
+
+    def _charge(self, cost):
+        self.spent_today += cost
+        self._unsynced_spend += cost
+
+    def take_unsynced_spend(self):
+        # (day, amount) spent here since the last sync, for run_provider_spend_sync to add to the shared total
+        self._roll_day()
+        spent, self._unsynced_spend = self._unsynced_spend, 0.0
+        return self._spend_day, spent
+
+    def return_unsynced_spend(self, day, spent):
+        # The sync failed, it is added on the next one
+        if day == self._spend_day:
+            self._unsynced_spend += spent
+
+    def record_synced_spend(self, day, total):
+        # `total` is what every process spent on `day`, this one's spend since it was read is added back
+        if day == self._spend_day:
+            self.spent_today = total + self._unsynced_spend
+
+    def record_success(self):
+        for bucket in (self.requests, self.tokens):
+            if bucket is not None and bucket.rate < bucket.per_minute:
+                bucket.rate = min(bucket.per_minute, bucket.rate + bucket.per_minute * RATE_INCREASE_STEP)
+
+    def record_rate_limited(self, retry_after=None):
+        self.rate_limited += 1
+        for bucket in (self.requests, self.tokens):
+            if bucket is not None:
+                bucket.rate = max(bucket.per_minute * MIN_RATE_FRACTION, bucket.rate * RATE_DECREASE_FACTOR)
+                bucket.tokens = min(bucket.tokens, 0)
+        if retry_after:
+            self._paused_until = max(self._paused_until, self._timer() + retry_after)
+        self._notify()
+
+    def record_headers(self, headers):
+        # Providers that say how long until the limit resets get exactly that pause
+        retry_after = headers.get("retry-after")
+        if retry_after is not None:
+            try:
+                self._paused_until = max(self._paused_until, self._timer() + float(retry_after))
+            except ValueError:
+                pass
+        # What is left of the provider's limits, spent by other processes too
+        for bucket, header in ((self.requests, "x-ratelimit-remaining-requests"),
+                               (self.tokens, "x-ratelimit-remaining-tokens")):
+            remaining = headers.get(header)
+            if bucket is not None and remaining is not None and remaining.isdigit():
+                bucket.limit_to(int(remaining))
+
+    async def run(self, call, tokens=0, priority=PRIORITY_DEFAULT, cost=None, retries=RATE_LIMIT_RETRIES):
+        # Admits `call`, retrying it when the provider still answers 429. A 429 is not billed: the call is paid
+        # for once, and given back if the provider never took it.
+        cost = self.estimate_cost(tokens) if cost is None else cost
+        for attempt in range(retries + 1):
+            try:
+                await self.acquire(tokens, priority, cost if attempt == 0 else 0)
+            except BudgetExceeded:
+                # Other processes spent the rest of the budget while this one was backing off
+                if attempt:
+                    self._charge(-cost)
+                raise
+            try:
+                result = await call()
+            except RateLimited as limited:
+                self.record_rate_limited(limited.retry_after)
+                if attempt == retries:
+                    self._charge(-cost)
+                    raise
+                continue
+            self.record_success()
+            return result
+
+    def stats(self):
+        return {
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "rate_limited": self.rate_limited,
+            "requests_per_minute": self.requests.rate,
+            "tokens_per_minute": self.tokens.rate if self.tokens is not None else None,
+            "estimated_cost_today": self.spent_today
+        }
+
+
+def story_priority(story, now, interactive=False):
+    if interactive:
+        return PRIORITY_INTERACTIVE
+    return PRIORITY_PREGENERATED if story.get("available_timestamp", 0) > now else PRIORITY_DEFAULT
+
+
+openai_limiter = ProviderLimiter("openai", OPENAI_REQUESTS_PER_MINUTE, OPENAI_TOKENS_PER_MINUTE,
+                                 cost_per_1k_tokens=OPENAI_COST_PER_1K_TOKENS)
+# Fetches share the request limit but are free, the image is paid for when it is generated
+stable_diffusion_limiter = ProviderLimiter("stable_diffusion", STABLE_DIFFUSION_REQUESTS_PER_MINUTE,
+                                           cost_per_request=STABLE_DIFFUSION_COST_PER_IMAGE)
+registry.stats("openai_limiter", openai_limiter.stats)
+registry.stats("stable_diffusion_limiter", stable_diffusion_limiter.stats)
@@ -1,18 +1,84 @@
-import openai
+import time
 
-from src.config import OPENAI_API_KEY
+from src.config import OPENAI_API_BASE, OPENAI_API_KEY
+from src.external_libs.generation_cache import generation_cache
+from src.external_libs.http_client import get_http_session, response_headers_to
+from src.external_libs.rate_limiter import PRIORITY_DEFAULT, RateLimited, openai_limiter
+from src.metrics import provider_latency, timed
+from src.tracing import span
 
-openai.api_key = OPENAI_API_KEY
+OPENAI_MODEL = "gpt-3.5-turbo"
 
 
-def generate_text(prompt, temperature=0.9, max_tokens=5):
-    response = openai.Completion.create(
-        model="gpt-3.5-turbo",
-        prompt=prompt,
-        temperature=temperature,
-        max_tokens=max_tokens,
-        top_p=1,
-        frequency_penalty=0,
-        presence_penalty=0,
-    )
-    return response.choices[0].text
+def load_openai():
+    # The SDK and what it brings with it are loaded on first use instead of at startup
+    import openai
+
+    openai.api_key = OPENAI_API_KEY
+    openai.api_base = OPENAI_API_BASE
+    return openai
+
+
+def estimate_tokens(prompt, max_tokens):
+    # Roughly four characters a token for English text, plus everything the completion may return
+    return len(prompt) // 4 + max_tokens
+
+
+async def _create_completion(prompt, temperature, max_tokens, stream=False, priority=PRIORITY_DEFAULT):
+    async def create():
+        openai = load_openai()
+        # Route the openai client through the shared pooled session
+        openai.aiosession.set(get_http_session())
+        try:
+            # The SDK drops the headers of successful responses, the rate limit headers are read off the session
+            with response_headers_to(openai_limiter.record_headers):
+                return await openai.Completion.acreate(
+                    model=OPENAI_MODEL,
+                    prompt=prompt,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    top_p=1,
+                    frequency_penalty=0,
+                    presence_penalty=0,
+                    stream=stream,
+                )
+        except openai.error.RateLimitError as error:
+            retry_after = (error.headers or {}).get("retry-after")
+            raise RateLimited(float(retry_after) if retry_after else None)
+
+    with span("openai.completion", model=OPENAI_MODEL, stream=stream, priority=priority):
+        if stream:
+            # Returns at the first chunk, stream_text times the call through to the last one
+            return await openai_limiter.run(create, estimate_tokens(prompt, max_tokens), priority)
+        with timed(provider_latency.labels(provider="openai", call="completion")):
+            return await openai_limiter.run(create, estimate_tokens(prompt, max_tokens), priority)
+
+
+async def generate_text(prompt, temperature=0.9, max_tokens=5, priority=PRIORITY_DEFAULT):
+    async def generate():
+        response = await _create_completion(prompt, temperature, max_tokens, priority=priority)
+        return response.choices[0].text
+
+    key = generation_cache.make_key("text", prompt, model=OPENAI_MODEL, temperature=temperature,
+                                    max_tokens=max_tokens)
+    return await generation_cache.get_or_generate("text", key, generate)
+
+
+async def stream_text(prompt, temperature=0.9, max_tokens=5, priority=PRIORITY_DEFAULT):
+    # Same completion as generate_text, yielding text pieces as the provider sends them
+    key = generation_cache.make_key("text", prompt, model=OPENAI_MODEL, temperature=temperature,
+                                    max_tokens=max_tokens)
+    cached = await generation_cache.lookup("text", key)
+    if cached is not None:
+        yield cached
+        return
+    started = time.monotonic()
+    chunks = []
+    with timed(provider_latency.labels(provider="openai", call="stream")):
+        async for chunk in await _create_completion(prompt, temperature, max_tokens, stream=True,
+                                                    priority=priority):
+            text = chunk.choices[0].text
+            if text:
+                chunks.append(text)
+                yield text
+    await generation_cache.store("text", key, "".join(chunks), time.monotonic() - started)
@@ -0,0 +1,91 @@
+import datetime
+import random
+
+from src.models import StoryStatus
+from src.functions.story_store import get_story, update_story
+from src.functions.work_queue import (STORY_REQUEST_QUEUE, enqueue_story, iterate_pending_work, queue_ref,
+                                      resync_story_queue)
+from src.functions.write_coalescer import WriteCoalescer
+
+# A story that fails this many times in a row moves to StoryStatus.DeadLetter instead of being retried again
+ITEM_MAX_ATTEMPTS = 5
+ITEM_RETRY_BASE = 5
+ITEM_RETRY_MAX = 600
+ERROR_MESSAGE_LIMIT = 500
+
+
+def retry_delay(attempts):
+    # Exponential backoff with full jitter, so a bad batch does not come back all at once
+    return random.uniform(ITEM_RETRY_BASE, min(ITEM_RETRY_BASE * 2 ** attempts, ITEM_RETRY_MAX))
+
+
+def error_message(error):
+    return f"{type(error).__name__}: {error}"[:ERROR_MESSAGE_LIMIT]
+
+
+def dead_letter_story(firestore_db, user_id, story_id, status, error):
+    # The story keeps its work so far, its queue entry stays under the DeadLetter status for inspection
+    writes = WriteCoalescer(firestore_db)
+    story = update_story(firestore_db, user_id, story_id, status, {
+        "status": StoryStatus.DeadLetter,
+        "error": error,
+        "failed_status": status
+    }, writes)
+    if story is not None:
+        writes.update(queue_ref(firestore_db, user_id, story_id), {"failed_status": status, "last_error": error})
+    writes.commit()
+    return story
+
+
+def defer_story_request(firestore_db, entry, error):
+    # Story requests have no lease, a failed one is pushed back on its queue entry, or dead-lettered there
+    attempts = entry.get("attempts", 0) + 1
+    if attempts >= ITEM_MAX_ATTEMPTS:
+        queue_ref(firestore_db, entry["user_id"], entry["story_id"]).update({
+            "status": StoryStatus.DeadLetter,
+            "failed_status": STORY_REQUEST_QUEUE,
+            "last_error": error,
+            "attempts": attempts
+        })
+        return False
+    queue_ref(firestore_db, entry["user_id"], entry["story_id"]).update({
+        "run_at": datetime.datetime.utcnow().timestamp() + retry_delay(attempts),
+        "last_error": error,
+        "attempts": attempts
+    })
+    return True
+
+
+def requeue_dead_letters(firestore_db):
+    # Puts every dead-lettered story back where it failed with a fresh attempt count, e.g. after a fix is deployed
+    requeued = 0
+    for entry in list(iterate_pending_work(firestore_db, StoryStatus.DeadLetter)):
+        if entry.get("failed_status") == STORY_REQUEST_QUEUE:
+            enqueue_story(firestore_db, entry["user_id"], entry["story_id"], STORY_REQUEST_QUEUE)
+            requeued += 1
+            continue
+        story = get_story(firestore_db, entry["user_id"], entry["story_id"])
+        if story is None or story.get("status") != StoryStatus.DeadLetter:
+            resync_story_queue(firestore_db, entry, story)
+            continue
+        update_story(firestore_db, entry["user_id"], entry["story_id"], StoryStatus.DeadLetter, {
+            "status": story["failed_status"],
+            "error": ""
+        })
+        requeued += 1
+    return requeued
+
+
+if __name__ == "__main__":
+    import sys
+
+    from src.worker import initialize_firestore
+
+    # python -m src.functions.dead_letter lists dead letters, add "requeue" to retry them all
+    db = initialize_firestore()
+    if sys.argv[1:] == ["requeue"]:
+        print(f"Requeued {requeue_dead_letters(db)} stories")
+    else:
+        for dead_letter in iterate_pending_work(db, StoryStatus.DeadLetter):
+            print(dead_letter["user_id"], dead_letter["story_id"], dead_letter.get("failed_status", ""),
+                  dead_letter.get("last_error", ""))
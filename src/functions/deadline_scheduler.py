@@ -0,0 +1,45 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+from src.metrics import Histogram
+
+
+class DeadlineScheduler:
+    # Min-heap of items keyed on when they are due. next_due() sleeps until exactly the earliest deadline,
+    # or until something due earlier is scheduled. Clock and sleep can be swapped for simulated ones.
+    def __init__(self, clock=time.time, sleep=asyncio.sleep):
+        self._heap = []
+        self._counter = itertools.count()
+        self._changed = asyncio.Event()
+        self.clock = clock
+        self.sleep = sleep
+        # How late items were picked up compared to when they were due
+        self.pickup_delay = Histogram(buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 30, 60))
+
+    def schedule(self, due, item):
+        # Due in the past, e.g. run_at 0 for "now", counts as due when it was scheduled
+        heapq.heappush(self._heap, (due, next(self._counter), max(due, self.clock()), item))
+        self._changed.set()
+
+    def __len__(self):
+        return len(self._heap)
+
+    async def next_due(self):
+        while True:
+            self._changed.clear()
+            if not self._heap:
+                await self._changed.wait()
+                continue
+            due = self._heap[0][0]
+            delay = due - self.clock()
+            if delay <= 0:
+                _, _, due_from, item = heapq.heappop(self._heap)
+                self.pickup_delay.observe(self.clock() - due_from)
+                return item
+            sleeper = asyncio.ensure_future(self.sleep(delay))
+            changed = asyncio.ensure_future(self._changed.wait())
+            await asyncio.wait({sleeper, changed}, return_when=asyncio.FIRST_COMPLETED)
+            sleeper.cancel()
+            changed.cancel()
@@ -1,15 +1,75 @@
 import asyncio
 import datetime
+import hashlib
+import hmac
 import time
 
-from src.config import STABLE_DIFFUSION_API_KEY
+from src.config import (IMAGE_WEBHOOK_GRACE, PUBLIC_BASE_URL, STABLE_DIFFUSION_API_BASE, STABLE_DIFFUSION_API_KEY,
+                        STABLE_DIFFUSION_WEBHOOK_SECRET)
+from src.external_libs.generation_cache import generation_cache
+from src.external_libs.http_client import get_http_session
+from src.external_libs.rate_limiter import (PRIORITY_DEFAULT, RateLimited, stable_diffusion_limiter,
+                                            story_priority)
+from src.metrics import provider_latency, timed
 from src.models import StoryStatus
-import requests
+from src.functions.pipeline import run_stage
+from src.functions.story_store import get_story, update_story
+from src.functions.work_queue import resync_story_queue
+from src.tracing import span
 
-IMAGE_GENERATION_FREQUENCY = 60  # Every minute
+IMAGE_GENERATION_FREQUENCY = 600  # Recovery scan every 10 minutes, stories are handed over once their text is done
 
 
-def generate_image(prompt):
+def image_cache_key(prompt):
+    return generation_cache.make_key("image", prompt, model="midjourney", width=512, height=512)
+
+
+def image_track_id(user_id, story_id):
+    return f"{user_id}:{story_id}"
+
+
+def parse_track_id(track_id):
+    user_id, story_id = track_id.rsplit(":", 1)
+    return user_id, int(story_id)
+
+
+# The placeholder this setting used to default to, anyone could sign callbacks with it
+PLACEHOLDER_WEBHOOK_SECRET = "RANDOM-VALS"
+
+
+def webhook_enabled():
+    # Without a secret of our own a callback could be forged, pointing the image download anywhere
+    return bool(PUBLIC_BASE_URL) and STABLE_DIFFUSION_WEBHOOK_SECRET not in ("", PLACEHOLDER_WEBHOOK_SECRET)
+
+
+def webhook_token(track_id):
+    return hmac.new(STABLE_DIFFUSION_WEBHOOK_SECRET.encode(), track_id.encode(), hashlib.sha256).hexdigest()
+
+
+def is_valid_webhook_token(track_id, token):
+    return hmac.compare_digest(webhook_token(track_id), token or "")
+
+
+def image_webhook_url(track_id):
+    if not webhook_enabled():
+        return None
+    return f"{PUBLIC_BASE_URL.rstrip('/')}/webhooks/stable-diffusion/?token={webhook_token(track_id)}"
+
+
+def mark_image_ready(firestore_db, user_id, story_id, expected_status, image_url, writes=None):
+    return update_story(firestore_db, user_id, story_id, expected_status, {
+        "image_url": image_url,
+        "status": StoryStatus.StoryReady,
+        "timestamp": datetime.datetime.utcnow().timestamp()
+    }, writes)
+
+
+async def generate_image(prompt, track_id=None, priority=PRIORITY_DEFAULT):
+    # A cached image for the same prompt skips the provider, queued images are cached once fetched
+    cached = await generation_cache.lookup("image", image_cache_key(prompt))
+    if cached is not None:
+        return cached
+    started = time.monotonic()
     data = {
         "key": STABLE_DIFFUSION_API_KEY,
         "model_id": "midjourney",
@@ -23,57 +83,62 @@ def generate_image(prompt):
         "enhance_prompt": "yes",
         "seed": None,
         "guidance_scale": 7.5,
-        "webhook": None,
-        "track_id": None
+        # The provider calls the webhook once the image is done, saving the fetch round-trips
+        "webhook": image_webhook_url(track_id) if track_id else None,
+        "track_id": track_id if track_id and PUBLIC_BASE_URL else None
     }
-    response = requests.post("https://stablediffusionapi.com/api/v3/dreambooth", json=data)
-    if response.status_code == 200:
-        response_body = response.json()
-        if response_body['output'] is not None:
-            return response_body['output'][0]
-        else:
-            if response_body["status"] == 'processing' and response_body["eta"] is not None:
-                return {
-                    "eta": float(response_body["eta"]) + time.time(),
-                    "fetch_id": response_body["id"]
-                }
+
+    async def request():
+        async with get_http_session().post(f"{STABLE_DIFFUSION_API_BASE}/v3/dreambooth", json=data) as response:
+            stable_diffusion_limiter.record_headers(response.headers)
+            if response.status == 429:
+                raise RateLimited()
+            if response.status == 200:
+                response_body = await response.json(content_type=None)
+                if response_body['output'] is not None:
+                    await generation_cache.store("image", image_cache_key(prompt), response_body['output'][0],
+                                                 time.monotonic() - started)
+                    return response_body['output'][0]
+                else:
+                    if response_body["status"] == 'processing' and response_body["eta"] is not None:
+                        return {
+                            "eta": float(response_body["eta"]) + time.time(),
+                            "fetch_id": response_body["id"]
+                        }
+                    else:
+                        raise Exception("Unexpected result from api")
             else:
-                raise Exception("Unexpected result from api")
+                raise Exception(f"Request failed with status code: {response.status}")
+
+    with span("stable_diffusion.generate", priority=priority), \
+            timed(provider_latency.labels(provider="stable_diffusion", call="generate")):
+        return await stable_diffusion_limiter.run(request, priority=priority)
+
+
+async def process_image_generation(firestore_db, entry, writes=None):
+    story = await asyncio.to_thread(get_story, firestore_db, entry["user_id"], entry["story_id"])
+    if story is None or story.get("status") != StoryStatus.PendingImageGeneration:
+        resync_story_queue(firestore_db, entry, story, writes)
+        return
+    track_id = image_track_id(entry["user_id"], entry["story_id"])
+    priority = story_priority(story, datetime.datetime.utcnow().timestamp())
+    image_response = await generate_image(story.get("prompt"), track_id, priority)
+    if isinstance(image_response, dict):
+        # With a webhook registered, polling is only the fallback for a lost callback
+        fetch_at = image_response.get("eta") + (IMAGE_WEBHOOK_GRACE if image_webhook_url(track_id) else 0)
+        await asyncio.to_thread(update_story, firestore_db, entry["user_id"], entry["story_id"],
+                                StoryStatus.PendingImageGeneration, {
+                                    "fetch_image_timestamp": fetch_at,
+                                    "fetch_image_id": image_response.get("fetch_id"),
+                                    "status": StoryStatus.PendingImageFetch
+                                }, writes)
+    # If the image is ready, update the story
     else:
-        raise Exception(f"Request failed with status code: {response.status_code}")
+        await asyncio.to_thread(mark_image_ready, firestore_db, entry["user_id"], entry["story_id"],
+                                StoryStatus.PendingImageGeneration, image_response, writes)
 
 
 async def run_image_generation_service(firestore_db):
-    while True:
-        users_ref = firestore_db.collection("users")
-        users = users_ref.stream()
-
-        for user in users:
-            stories = user.get("stories")
-            if stories:
-                for index, story in enumerate(stories):
-                    if story.get("status") == "PendingImageGeneration":
-                        image_response = generate_image(story.get("prompt"))
-                        if "eta" in image_response:
-                            story["fetch_image_timestamp"] = image_response.get("eta")
-                            story["fetch_image_id"] = image_response.get("fetch_id")
-                            story["status"] = StoryStatus.PendingImageFetch
-                            stories[index] = story
-                            user_ref = users_ref.document(user.id)
-                            user_ref.update({
-                                "stories": stories
-                            })
-                        # If the image is ready, update the story
-                        else:
-                            image_url = image_response
-                            user_ref = users_ref.document(user.id)
-                            story = story.copy()
-                            story["image_url"] = image_url
-                            story["status"] = StoryStatus.StoryReady
-                            story["timestamp"] = datetime.datetime.utcnow().timestamp()
-                            stories[index] = story
-                            user_ref.update({
-                                "stories": stories
-                            })
-
-        await asyncio.sleep(IMAGE_GENERATION_FREQUENCY)
+    await run_stage(firestore_db, StoryStatus.PendingImageGeneration,
+                    lambda entry, writes: process_image_generation(firestore_db, entry, writes),
+                    IMAGE_GENERATION_FREQUENCY)
@@ -1,46 +1,81 @@
 import asyncio
 import datetime
+import random
 
-from src.config import STABLE_DIFFUSION_API_KEY
+from src.config import STABLE_DIFFUSION_API_BASE, STABLE_DIFFUSION_API_KEY
+from src.external_libs.generation_cache import generation_cache
+from src.external_libs.http_client import get_http_session
+from src.external_libs.rate_limiter import PRIORITY_DEFAULT, RateLimited, stable_diffusion_limiter, story_priority
+from src.metrics import provider_latency, timed
 from src.models import StoryStatus
-import requests
-import time
+from src.functions.image_generation import image_cache_key, mark_image_ready
+from src.functions.pipeline import RetryLater, run_stage
+from src.functions.story_store import get_story
+from src.functions.work_queue import resync_story_queue
+from src.tracing import span
 
-IMAGE_QUEUE_FREQUENCY = 30  # Every 30 secs
+IMAGE_QUEUE_FREQUENCY = 600  # Recovery scan every 10 minutes, queued images are fetched when their ETA is up
+IMAGE_FETCH_RETRY_BASE = 2
+IMAGE_FETCH_RETRY_MAX = 120
+IMAGE_FETCH_MAX_ATTEMPTS = 15
 
 
-def fetch_queued_image(id: str):
-    response = requests.post(f"https://stablediffusionapi.com/api/v4/dreambooth/fetch/{id}",
-                             json={"key": STABLE_DIFFUSION_API_KEY})
-    if response.status_code == 200:
-        response_body = response.json()
-        if response_body['output'] is not None:
-            return response_body['output'][0]
-        else:
-            raise Exception(f"Response does not have output")
-    else:
-        raise Exception(f"Request failed with status code: {response.status_code}")
+class ImageStillProcessing(Exception):
+    def __init__(self, eta=None):
+        super().__init__("Image is still processing")
+        self.eta = eta
+
+
+def fetch_retry_delay(attempt, eta=None):
+    # Exponential backoff with full jitter, never earlier than the ETA the provider gave
+    delay = random.uniform(0, min(IMAGE_FETCH_RETRY_BASE * 2 ** attempt, IMAGE_FETCH_RETRY_MAX))
+    return max(delay, eta or 0)
+
+
+async def fetch_queued_image(id: str, priority=PRIORITY_DEFAULT):
+    async def request():
+        async with get_http_session().post(f"{STABLE_DIFFUSION_API_BASE}/v4/dreambooth/fetch/{id}",
+                                           json={"key": STABLE_DIFFUSION_API_KEY}) as response:
+            stable_diffusion_limiter.record_headers(response.headers)
+            if response.status == 429:
+                raise RateLimited()
+            if response.status == 200:
+                response_body = await response.json(content_type=None)
+                if response_body.get('output'):
+                    return response_body['output'][0]
+                elif response_body.get("status") == 'processing':
+                    eta = response_body.get("eta")
+                    raise ImageStillProcessing(float(eta) if eta is not None else None)
+                else:
+                    raise Exception(f"Response does not have output")
+            else:
+                raise Exception(f"Request failed with status code: {response.status}")
+
+    with span("stable_diffusion.fetch", priority=priority), \
+            timed(provider_latency.labels(provider="stable_diffusion", call="fetch")):
+        return await stable_diffusion_limiter.run(request, priority=priority, cost=0)
+
+
+async def process_image_fetch(firestore_db, entry, writes=None):
+    story = await asyncio.to_thread(get_story, firestore_db, entry["user_id"], entry["story_id"])
+    if story is None or story.get("status") != StoryStatus.PendingImageFetch:
+        resync_story_queue(firestore_db, entry, story, writes)
+        return
+    try:
+        image_url = await fetch_queued_image(story.get("fetch_image_id"),
+                                             story_priority(story, datetime.datetime.utcnow().timestamp()))
+    except ImageStillProcessing as processing:
+        attempt = entry.get("attempt", 0)
+        if attempt >= IMAGE_FETCH_MAX_ATTEMPTS:
+            raise Exception(f"Image {story.get('fetch_image_id')} still processing after {attempt} attempts")
+        entry["attempt"] = attempt + 1
+        raise RetryLater(fetch_retry_delay(attempt, processing.eta))
+    await generation_cache.store("image", image_cache_key(story.get("prompt")), image_url)
+    await asyncio.to_thread(mark_image_ready, firestore_db, entry["user_id"], entry["story_id"],
+                            StoryStatus.PendingImageFetch, image_url, writes)
 
 
 async def run_image_queue_process_service(firestore_db):
-    while True:
-        users_ref = firestore_db.collection("users")
-        users = users_ref.stream()
-
-        for user in users:
-            stories = user.get("stories")
-            if stories:
-                for index, story in enumerate(stories):
-                    if story.get("status") == "PendingImageFetch" and story.get("fetch_image_timestamp") < time.time():
-                        image_url = fetch_queued_image(story.get("fetch_image_id"))
-                        user_ref = users_ref.document(user.id)
-                        story = story.copy()
-                        story["image_url"] = image_url
-                        story["status"] = StoryStatus.StoryReady
-                        story["timestamp"] = datetime.datetime.utcnow().timestamp()
-                        stories[index] = story
-                        user_ref.update({
-                            "stories": stories
-                        })
-
-        await asyncio.sleep(IMAGE_QUEUE_FREQUENCY)
+    await run_stage(firestore_db, StoryStatus.PendingImageFetch,
+                    lambda entry, writes: process_image_fetch(firestore_db, entry, writes),
+                    IMAGE_QUEUE_FREQUENCY)
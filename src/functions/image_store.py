@@ -0,0 +1,159 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import tempfile
+
+from src.config import IMAGE_STORE_PATH, IMAGE_THUMBNAIL_SIZE
+from src.events import story_events
+from src.external_libs.http_client import get_http_session
+from src.functions.story_store import update_story
+from src.functions.write_coalescer import WriteCoalescer
+from src.metrics import firestore_latency, timed
+from src.models import StoryStatus
+
+IMAGE_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+IMAGE_VARIANTS = ("original", "webp", "thumb")
+DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+# images/{digest} -> where the stored image was downloaded from, for processes that don't have it on disk
+IMAGES_COLLECTION = "images"
+
+logger = logging.getLogger(__name__)
+
+_download_tasks = set()
+# digest -> the download of an image missing from this process's disk, shared by the requests waiting on it
+_missing_images = {}
+
+
+def image_path(digest, variant="original"):
+    # Content addressed, the same image is only ever stored once
+    name = digest if variant == "original" else f"{digest}.{variant}.webp"
+    return os.path.join(IMAGE_STORE_PATH, digest[:2], name)
+
+
+def is_valid_digest(digest):
+    return bool(DIGEST_PATTERN.match(digest))
+
+
+def media_type(path, variant):
+    if variant != "original":
+        return "image/webp"
+    with open(path, "rb") as image_file:
+        signature = image_file.read(12)
+    if signature.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if signature[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/png"
+
+
+def make_variants(digest):
+    # Pillow is loaded by the first image stored, an API process serving images from disk never needs it
+    try:
+        from PIL import Image
+    except ImportError:
+        # Without Pillow only the original image is served
+        return
+    with Image.open(image_path(digest)) as image:
+        image.save(image_path(digest, "webp"), "WEBP", quality=85)
+        image.thumbnail((IMAGE_THUMBNAIL_SIZE, IMAGE_THUMBNAIL_SIZE))
+        image.save(image_path(digest, "thumb"), "WEBP", quality=80)
+
+
+def open_temp_file():
+    os.makedirs(IMAGE_STORE_PATH, exist_ok=True)
+    return tempfile.mkstemp(dir=IMAGE_STORE_PATH)
+
+
+def keep_image(temp_path, digest):
+    if os.path.exists(image_path(digest)):
+        os.remove(temp_path)
+        return
+    os.makedirs(os.path.dirname(image_path(digest)), exist_ok=True)
+    os.replace(temp_path, image_path(digest))
+
+
+def remove_temp_file(temp_path):
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+
+async def download_image(url):
+    # Streams the image to disk while hashing it, it is never held in memory whole. The disk is written on a
+    # thread, a slow volume holds up the download and not the event loop.
+    digest = hashlib.sha256()
+    handle, temp_path = await asyncio.to_thread(open_temp_file)
+    try:
+        with os.fdopen(handle, "wb", buffering=0) as temp_file:
+            async with get_http_session().get(url) as response:
+                if response.status != 200:
+                    raise Exception(f"Image download failed with status code: {response.status}")
+                async for chunk in response.content.iter_chunked(IMAGE_DOWNLOAD_CHUNK_SIZE):
+                    digest.update(chunk)
+                    await asyncio.to_thread(temp_file.write, chunk)
+        digest = digest.hexdigest()
+        await asyncio.to_thread(keep_image, temp_path, digest)
+    except Exception:
+        await asyncio.to_thread(remove_temp_file, temp_path)
+        raise
+    await asyncio.to_thread(make_variants, digest)
+    return digest
+
+
+def image_source_ref(firestore_db, digest):
+    return firestore_db.collection(IMAGES_COLLECTION).document(digest)
+
+
+def record_stored_image(firestore_db, user_id, story, digest):
+    # The source goes along with image_hash, whoever sees the hash can get the image
+    writes = WriteCoalescer(firestore_db)
+    writes.set(image_source_ref(firestore_db, digest), {"url": story["image_url"]})
+    update_story(firestore_db, user_id, story["story_id"], StoryStatus.StoryReady, {"image_hash": digest}, writes)
+    writes.commit()
+
+
+async def store_story_image(firestore_db, user_id, story):
+    try:
+        digest = await download_image(story["image_url"])
+    except Exception:
+        # The story keeps serving the provider URL
+        logger.exception("Could not store image for story %s of %s", story["story_id"], user_id)
+        return
+    await asyncio.to_thread(record_stored_image, firestore_db, user_id, story, digest)
+
+
+def image_source(firestore_db, digest):
+    with timed(firestore_latency.labels(operation="get_image_source")):
+        return image_source_ref(firestore_db, digest).get().to_dict()
+
+
+async def download_missing_image(firestore_db, digest):
+    source = await asyncio.to_thread(image_source, firestore_db, digest)
+    if source is None:
+        return False
+    return await download_image(source["url"]) == digest
+
+
+async def fetch_missing_image(firestore_db, digest):
+    # An image stored by a worker whose disk this process doesn't share is downloaded again from its source, once
+    # per process. Mounting the same volume at IMAGE_STORE_PATH everywhere saves the second download.
+    task = _missing_images.get(digest)
+    if task is None:
+        task = _missing_images[digest] = asyncio.ensure_future(download_missing_image(firestore_db, digest))
+        task.add_done_callback(lambda _: _missing_images.pop(digest, None))
+    try:
+        return await asyncio.shield(task)
+    except Exception:
+        logger.exception("Could not fetch missing image %s", digest)
+        return False
+
+
+def watch_ready_stories(firestore_db):
+    def on_story_change(user_id, story):
+        if story["status"] == StoryStatus.StoryReady and story.get("image_url") and not story.get("image_hash"):
+            task = asyncio.get_running_loop().create_task(store_story_image(firestore_db, user_id, story))
+            _download_tasks.add(task)
+            task.add_done_callback(_download_tasks.discard)
+
+    story_events.add_listener(on_story_change)
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from google.cloud import firestore
+
+from src.config import LEASE_DURATION, WORKER_ID
+from src.functions.work_queue import queue_ref
+from src.metrics import firestore_latency, timed
+
+# Unique per process, a restarted worker never mistakes an old lease for its own
+worker_id = WORKER_ID or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+logger = logging.getLogger(__name__)
+
+# (user_id, story_id) -> status of the queue entries this process holds a lease on
+held_leases = {}
+# Claims run on threads, a story is reserved in held_leases under this lock before its transaction
+_claims_lock = threading.Lock()
+
+
+def is_leased(entry, now=None):
+    # Leased by a live worker other than this one
+    now = now if now is not None else time.time()
+    return entry.get("lease_owner") not in (None, worker_id) and entry.get("lease_expires_at", 0) > now
+
+
+@firestore.transactional
+def _claim(transaction, ref, status, now, duration):
+    snapshot = ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return False
+    entry = snapshot.to_dict()
+    if entry.get("status") != status or is_leased(entry, now):
+        return False
+    transaction.update(ref, {"lease_owner": worker_id, "lease_expires_at": now + duration})
+    return True
+
+
+def claim_story(firestore_db, status, user_id, story_id, duration=LEASE_DURATION):
+    # Atomically take the queue entry for a story in `status`, False if another live worker has it. Leases are
+    # per process, so a story already held here for `status`, by its stage or for a reader, is not claimed twice.
+    # One still held for the status it just left is being forgotten, the next stage takes it over.
+    with _claims_lock:
+        if held_leases.get((user_id, story_id)) == status:
+            return False
+        held_leases[(user_id, story_id)] = status
+    claimed = False
+    try:
+        with timed(firestore_latency.labels(operation="lease")):
+            claimed = _claim(firestore_db.transaction(), queue_ref(firestore_db, user_id, story_id), status,
+                             time.time(), duration)
+    finally:
+        if not claimed:
+            _drop(user_id, story_id, status)
+    return claimed
+
+
+def _drop(user_id, story_id, status):
+    with _claims_lock:
+        if held_leases.get((user_id, story_id)) == status:
+            del held_leases[(user_id, story_id)]
+
+
+@firestore.transactional
+def _extend(transaction, ref, status, now, duration):
+    snapshot = ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return False
+    entry = snapshot.to_dict()
+    if entry.get("status") != status or entry.get("lease_owner") != worker_id:
+        return False
+    transaction.update(ref, {"lease_expires_at": now + duration})
+    return True
+
+
+def forget_lease(user_id, story_id, status):
+    # The entry moved on from `status` (or was removed), which dropped the lease with it
+    _drop(user_id, story_id, status)
+
+
+@firestore.transactional
+def _release(transaction, ref, status, run_at):
+    entry = ref.get(transaction=transaction).to_dict()
+    if entry is not None and entry.get("status") == status and entry.get("lease_owner") == worker_id:
+        fields = {"lease_owner": None, "lease_expires_at": 0}
+        if run_at is not None:
+            fields["run_at"] = run_at
+        transaction.update(ref, fields)
+
+
+def release_story(firestore_db, user_id, story_id, run_at=None):
+    # Hand the story back before the lease runs out. With `run_at` no worker, in any process, picks it up before
+    # then: a story released after a failure must not come straight back.
+    status = held_leases.pop((user_id, story_id), None)
+    if status is not None:
+        with timed(firestore_latency.labels(operation="lease")):
+            _release(firestore_db.transaction(), queue_ref(firestore_db, user_id, story_id), status, run_at)
+
+
+@firestore.transactional
+def _fail(transaction, ref, status, error, now, retry_delay):
+    entry = ref.get(transaction=transaction).to_dict()
+    if entry is None or entry.get("status") != status or entry.get("lease_owner") != worker_id:
+        return None, None
+    attempts = entry.get("attempts", 0) + 1
+    retry_at = now + retry_delay(attempts)
+    transaction.update(ref, {"lease_owner": None, "lease_expires_at": 0, "attempts": attempts, "last_error": error,
+                             "run_at": retry_at})
+    return attempts, retry_at
+
+
+def record_failure(firestore_db, user_id, story_id, error, retry_delay):
+    # Counts a failed attempt on the queue entry, which every worker sees, and hands the story back due again after
+    # retry_delay(attempts). (None, None) when the story is no longer ours.
+    status = held_leases.pop((user_id, story_id), None)
+    if status is None:
+        return None, None
+    with timed(firestore_latency.labels(operation="lease")):
+        return _fail(firestore_db.transaction(), queue_ref(firestore_db, user_id, story_id), status, error,
+                     time.time(), retry_delay)
+
+
+def extend_lease(firestore_db, user_id, story_id, status, duration=LEASE_DURATION):
+    with timed(firestore_latency.labels(operation="lease")):
+        return _extend(firestore_db.transaction(), queue_ref(firestore_db, user_id, story_id), status, time.time(),
+                       duration)
+
+
+async def run_lease_heartbeat(firestore_db, duration=LEASE_DURATION):
+    # One loop renews every lease this process holds, a dead process stops renewing and its work is reclaimed
+    while True:
+        await asyncio.sleep(duration / 3)
+        for (user_id, story_id), status in list(held_leases.items()):
+            try:
+                extended = await asyncio.to_thread(extend_lease, firestore_db, user_id, story_id, status, duration)
+                if not extended:
+                    _drop(user_id, story_id, status)
+            except Exception:
+                logger.exception("Could not renew lease on story %s for %s", story_id, user_id)
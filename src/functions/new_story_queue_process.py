@@ -1,50 +1,102 @@
 import asyncio
 import datetime
+import logging
 
-from external_libs.prompt_builder import build_prompt
-from models import StoryStatus, Story
+from google.cloud import firestore
+
+from src.events import story_events
+from src.external_libs.prompt_builder import build_prompt
+from src.models import StoryStatus, Story
+from src.functions.dead_letter import defer_story_request, error_message
+from src.functions.story_store import story_ref, user_story_fields
+from src.functions.work_queue import (STORY_REQUEST_DELAY, STORY_REQUEST_QUEUE, WORK_QUEUE_BATCH_SIZE,
+                                      dequeue_story, enqueue_story, fetch_pending_work)
+from src.tracing import span
 
 STORY_GENERATION_FREQUENCY = 300  # Every 5 minutes
 
+logger = logging.getLogger(__name__)
+
+
+@firestore.transactional
+def request_next_story(transaction, firestore_db, entry, pregenerate=False):
+    # Runs as a transaction so a concurrent /user/ or /read-story/ write is retried against, never overwritten.
+    # With `pregenerate` the story is requested before its 24 hours are up and kept hidden until then.
+    user_ref = firestore_db.collection(u'users').document(entry["user_id"])
+    user = user_ref.get(transaction=transaction)
+    last_story = story_ref(firestore_db, entry["user_id"], entry["story_id"]).get(transaction=transaction)
+    # Find the last story and if the story is unread and user has not requested a new story today
+    if not user.exists or not last_story.exists or user.get("story_count") != entry["story_id"] + 1:
+        # A newer story exists already, nothing left to request for this one
+        dequeue_story(firestore_db, entry["user_id"], entry["story_id"], transaction)
+        return None
+    user = user.to_dict()
+    last_story = last_story.to_dict()
+    if last_story["status"] != StoryStatus.StoryReady or last_story["read_status"] != "read":
+        dequeue_story(firestore_db, entry["user_id"], entry["story_id"], transaction)
+        return None
+    # Check if the user has requested a new story today
+    available_timestamp = 0
+    if pregenerate:
+        available_timestamp = user["last_story_generated_timestamp"] + STORY_REQUEST_DELAY
+    elif datetime.datetime.utcnow().timestamp() - user["last_story_generated_timestamp"] <= 24 * 60 * 60:
+        enqueue_story(firestore_db, entry["user_id"], entry["story_id"], STORY_REQUEST_QUEUE,
+                      user["last_story_generated_timestamp"] + STORY_REQUEST_DELAY, transaction)
+        return None
+    # Check if user subscription valid
+    subscription = user["subscription"]
+    if subscription['isActive'] == False or subscription[ "end_date_timestamp"] < datetime.datetime.utcnow().timestamp() and subscription["finished_free_story"]:
+        # Free tier ran out, looked at again tomorrow in case the subscription was renewed
+        enqueue_story(firestore_db, entry["user_id"], entry["story_id"], STORY_REQUEST_QUEUE,
+                      datetime.datetime.utcnow().timestamp() + STORY_REQUEST_DELAY, transaction)
+        return None
+    # Request a new story
+    story_id = last_story["story_id"] + 1
+    config = user["config"]
+    story = Story(
+        prompt=build_prompt(config["genre"], config["main_character_name"]),
+        status=StoryStatus.PendingTextGeneration,
+        timestamp=datetime.datetime.utcnow().timestamp(),
+        read_status='unread',
+        story_id=story_id,
+        available_timestamp=available_timestamp
+    ).dict()
+    transaction.set(story_ref(firestore_db, entry["user_id"], story_id), story)
+
+    # Only the fields that change are written
+    user_fields = user_story_fields(story)
+    # Update subscription if applicable
+    if subscription["end_date_timestamp"] < datetime.datetime.utcnow().timestamp() and not \
+            subscription["finished_free_story"]:
+        user_fields["subscription.finished_free_story"] = True
+    user_fields["last_story_generated_timestamp"] = max(datetime.datetime.utcnow().timestamp(), available_timestamp)
+    user_fields["story_count"] = story_id + 1
+    transaction.update(user_ref, user_fields)
+    dequeue_story(firestore_db, entry["user_id"], last_story["story_id"], transaction)
+    enqueue_story(firestore_db, entry["user_id"], story_id, story["status"], writes=transaction)
+    return story
+
 
 async def run_story_request_service(firestore_db):
     while True:
-        users_ref = firestore_db.collection("users")
-        users = users_ref.stream()
-
-        for user in users:
-            stories = user.get("stories")
-            # Find the last story and if the story is unread and user has not requested a new story today
-            if stories:
-                last_story = stories[-1]
-                if last_story["status"] == StoryStatus.StoryReady and last_story["read_status"] == "read":
-                    user = user.to_dict()
-                    # Check if the user has requested a new story today
-                    if datetime.datetime.utcnow().timestamp() - user["last_story_generated_timestamp"] > 24 * 60 * 60:
-                        # Check if user subscription valid
-                        subscription = user["subscription"]
-                        if subscription['isActive'] == False or subscription[ "end_date_timestamp"] < datetime.datetime.utcnow().timestamp() and subscription["finished_free_story"]:
-                            raise Exception("Free tier ran out")
-                        # Request a new story
-                        story_id = len(stories)
-                        config = user["config"]
-                        story = Story(
-                            prompt=build_prompt(config["genre"], config["main_character_name"]),
-                            status=StoryStatus.PendingTextGeneration,
-                            timestamp=datetime.datetime.utcnow().timestamp(),
-                            read_status='unread',
-                            story_id=story_id
-                        )
-                        if "stories" not in user:
-                            user["stories"] = []
-                        user["stories"].append(story.dict())
-
-                        # Update subscription if applicable
-                        if subscription["end_date_timestamp"] < datetime.datetime.utcnow().timestamp() and not \
-                                subscription["finished_free_story"]:
-                            user["subscription"]["finished_free_story"] = True
-                        user["last_story_generated_timestamp"] = datetime.datetime.utcnow().timestamp()
-                        user_ref = firestore_db.collection(u'users').document(user["user_id"])
-                        user_ref.set(user)
-
-        await asyncio.sleep(STORY_GENERATION_FREQUENCY)
+        # Read stories whose 24 hour wait has passed
+        pending = await asyncio.to_thread(fetch_pending_work, firestore_db, STORY_REQUEST_QUEUE,
+                                          due_before=datetime.datetime.utcnow().timestamp())
+
+        for entry in pending:
+            try:
+                # The span belongs to the trace of the story being requested
+                with span("story.request", entry["user_id"], entry["story_id"] + 1):
+                    story = await asyncio.to_thread(request_next_story, firestore_db.transaction(), firestore_db,
+                                                    entry)
+            except Exception as error:
+                # One user's bad data must not hold up everyone else's next story
+                logger.exception("Failed to request the next story after %s for %s", entry["story_id"],
+                                 entry["user_id"])
+                await asyncio.to_thread(defer_story_request, firestore_db, entry, error_message(error))
+                continue
+            if story is not None:
+                story_events.publish_story_change(entry["user_id"], story)
+
+        if len(pending) < WORK_QUEUE_BATCH_SIZE:
+            await asyncio.sleep(STORY_GENERATION_FREQUENCY)
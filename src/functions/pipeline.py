@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import time
+
+from src.config import GENERATION_CONCURRENCY
+from src.events import story_events
+from src.external_libs.rate_limiter import BudgetExceeded
+from src.functions.dead_letter import ITEM_MAX_ATTEMPTS, dead_letter_story, error_message, retry_delay
+from src.functions.deadline_scheduler import DeadlineScheduler
+from src.functions.leases import claim_story, forget_lease, held_leases, is_leased, record_failure, release_story
+from src.functions.supervisor import supervise
+from src.functions.work_queue import WORK_QUEUE_COLLECTION, iterate_pending_work
+from src.functions.write_coalescer import WriteCoalescer
+from src.metrics import registry, stage_item_duration, stage_scan_duration, status_duration, timed
+from src.models import StoryStatus
+from src.tracing import span
+
+# Stages a story is handed to as soon as it reaches their status, instead of waiting for the next scan
+PIPELINE_STAGES = (StoryStatus.PendingTextGeneration, StoryStatus.PendingImageGeneration,
+                   StoryStatus.PendingImageFetch)
+
+# Stories waiting on the daily provider budget are looked at again after this many seconds, without counting a failure
+BUDGET_RETRY_DELAY = 15 * 60
+
+logger = logging.getLogger(__name__)
+
+# Work for each stage ordered by when it is due, run_at 0 means now, queued images are due at their ETA
+stage_queues = {status: DeadlineScheduler() for status in PIPELINE_STAGES}
+# Stages with a consumer in this process, an API-only process hands nothing off
+_running_stages = set()
+# (status, user_id, story_id) handed off and not finished yet, so scans and events don't queue a story twice
+_handed_off = set()
+
+
+class RetryLater(Exception):
+    # Raised by a stage to look at the story again after `delay` seconds, it stays handed off meanwhile
+    def __init__(self, delay):
+        super().__init__(f"Retry in {delay:.1f}s")
+        self.delay = delay
+
+
+def running_stages():
+    return frozenset(_running_stages)
+
+
+def hand_off(status, entry):
+    key = (status, entry["user_id"], entry["story_id"])
+    if status not in _running_stages or key in _handed_off:
+        return False
+    _handed_off.add(key)
+    stage_queues[status].schedule(entry.get("run_at", 0), entry)
+    return True
+
+
+def on_story_change(user_id, story):
+    if story["status"] in stage_queues:
+        run_at = story.get("fetch_image_timestamp", 0) if story["status"] == StoryStatus.PendingImageFetch else 0
+        hand_off(story["status"], {"user_id": user_id, "story_id": story["story_id"], "run_at": run_at,
+                                   "updated_at": time.time()})
+
+
+story_events.add_listener(on_story_change)
+
+registry.gauge("stage_backlog", "Stories waiting in each stage's queue in this process",
+               lambda: {(("status", status),): len(queue) for status, queue in stage_queues.items()})
+registry.gauge("stage_in_flight", "Stories handed to a stage and not finished yet, queued or being processed",
+               lambda: {(("status", status),): sum(1 for key in _handed_off if key[0] == status)
+                        for status in PIPELINE_STAGES})
+registry.gauge("stage_running", "Stages with a worker loop in this process",
+               lambda: {(("status", status),): int(status in _running_stages) for status in PIPELINE_STAGES})
+stage_pickup_delay = registry.histogram("stage_pickup_delay_seconds",
+                                        "How late stories were picked up after they were due")
+for _status, _queue in stage_queues.items():
+    stage_pickup_delay.attach(_queue.pickup_delay, status=_status)
+
+
+def watch_stage(firestore_db, status, loop):
+    # Queue entries written by any process reach every worker, whoever claims the lease first does the work
+    def on_snapshot(snapshots, changes, read_time):
+        for change in changes:
+            if change.type.name == "REMOVED":
+                continue
+            entry = change.document.to_dict()
+            if not is_leased(entry):
+                loop.call_soon_threadsafe(hand_off, status, entry)
+
+    return firestore_db.collection(WORK_QUEUE_COLLECTION).where("status", "==", status).on_snapshot(on_snapshot)
+
+
+async def recover_stage(firestore_db, status, frequency):
+    # Picks up whatever was never handed over, e.g. work of a worker that died and whose lease ran out
+    while True:
+        with timed(stage_scan_duration.labels(status=status)):
+            entries = await asyncio.to_thread(lambda: list(iterate_pending_work(firestore_db, status)))
+        for entry in entries:
+            if not is_leased(entry):
+                hand_off(status, entry)
+        await asyncio.sleep(frequency)
+
+
+# Firestore calls are blocking round-trips, workers make them on a thread so the event loop keeps serving requests
+async def process_entry(firestore_db, status, entry, process, semaphore):
+    key = (status, entry["user_id"], entry["story_id"])
+    try:
+        # Retries come back with the lease this stage claimed still held
+        if not entry.get("claimed"):
+            if held_leases.get((entry["user_id"], entry["story_id"])) == status:
+                # Held by other work in this process, e.g. generating the story for a reader. Not ours to process,
+                # and not ours to forget the lease of either.
+                _handed_off.discard(key)
+                return
+            if not await asyncio.to_thread(claim_story, firestore_db, status, entry["user_id"], entry["story_id"]):
+                # Another worker has it
+                _handed_off.discard(key)
+                return
+            entry["claimed"] = True
+        # Each story commits on its own so the next stage can start on it straight away
+        with span(f"stage {status.value}", entry["user_id"], entry["story_id"]), \
+                timed(stage_item_duration.labels(status=status)):
+            writes = WriteCoalescer(firestore_db)
+            await process(entry, writes)
+            await asyncio.to_thread(writes.commit)
+        forget_lease(entry["user_id"], entry["story_id"], status)
+        _handed_off.discard(key)
+        if entry.get("updated_at"):
+            status_duration.labels(status=status).observe(time.time() - entry["updated_at"])
+    except RetryLater as retry:
+        queue = stage_queues[status]
+        queue.schedule(queue.clock() + retry.delay, entry)
+    except BudgetExceeded:
+        await defer_entry(firestore_db, status, entry, time.time() + BUDGET_RETRY_DELAY)
+    except asyncio.CancelledError:
+        # Shutting down, another worker picks the story up straight away instead of when the lease runs out
+        if entry.get("claimed"):
+            release_story(firestore_db, entry["user_id"], entry["story_id"])
+        _handed_off.discard(key)
+        raise
+    except Exception as error:
+        logger.exception("Failed to process %s story %s for %s", status, entry["story_id"], entry["user_id"])
+        await fail_entry(firestore_db, status, entry, error)
+    finally:
+        semaphore.release()
+
+
+def record_stage_failure(firestore_db, status, user_id, story_id, error):
+    # Counts a failed attempt on a story we hold the lease on. Returns when it is due again, or None when it was
+    # dead-lettered after ITEM_MAX_ATTEMPTS or is no longer ours.
+    message = error_message(error)
+    attempts, retry_at = record_failure(firestore_db, user_id, story_id, message, retry_delay)
+    if attempts is not None and attempts >= ITEM_MAX_ATTEMPTS:
+        logger.error("Dead-lettering %s story %s for %s after %d attempts", status, story_id, user_id, attempts)
+        dead_letter_story(firestore_db, user_id, story_id, status, message)
+        return None
+    return retry_at
+
+
+async def fail_entry(firestore_db, status, entry, error):
+    # One story failing never stops the stage, it is retried with backoff until it is dead-lettered
+    key = (status, entry["user_id"], entry["story_id"])
+    # Either way the lease is gone, the retry claims it again
+    entry["claimed"] = False
+    try:
+        retry_at = await asyncio.to_thread(record_stage_failure, firestore_db, status, entry["user_id"],
+                                           entry["story_id"], error)
+    except Exception:
+        logger.exception("Could not record failure of %s story %s for %s", status, entry["story_id"],
+                         entry["user_id"])
+        # Deferred like a counted failure, so neither this process nor another one picks it straight back up
+        retry_at = time.time() + retry_delay(entry.get("attempts", 0) + 1)
+        try:
+            await asyncio.to_thread(release_story, firestore_db, entry["user_id"], entry["story_id"], retry_at)
+        except Exception:
+            # Firestore is unreachable, the lease runs out on its own
+            logger.exception("Could not release %s story %s for %s", status, entry["story_id"], entry["user_id"])
+    if retry_at is None:
+        _handed_off.discard(key)
+        return
+    # Stays handed off until it is due, the watcher would otherwise hand the released entry straight back
+    entry["run_at"] = retry_at
+    stage_queues[status].schedule(retry_at, entry)
+
+
+async def defer_entry(firestore_db, status, entry, run_at):
+    # Not a failure, but nothing can be done before `run_at`: the lease goes back so this process doesn't sit on the
+    # story meanwhile, and whichever process is first once it is due claims it again
+    entry["claimed"] = False
+    try:
+        await asyncio.to_thread(release_story, firestore_db, entry["user_id"], entry["story_id"], run_at)
+    except Exception:
+        logger.exception("Could not release %s story %s for %s", status, entry["story_id"], entry["user_id"])
+    entry["run_at"] = run_at
+    stage_queues[status].schedule(run_at, entry)
+
+
+async def run_stage(firestore_db, status, process, recovery_frequency, concurrency=GENERATION_CONCURRENCY):
+    _running_stages.add(status)
+    watch = watch_stage(firestore_db, status, asyncio.get_running_loop())
+    recovery = asyncio.create_task(supervise(f"{status.value} recovery",
+                                             lambda: recover_stage(firestore_db, status, recovery_frequency)))
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = set()
+    try:
+        while True:
+            await semaphore.acquire()
+            entry = await stage_queues[status].next_due()
+            task = asyncio.create_task(process_entry(firestore_db, status, entry, process, semaphore))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        _running_stages.discard(status)
+        watch.unsubscribe()
+        recovery.cancel()
+        for task in tasks:
+            task.cancel()
+        # Stories being processed release their leases before the stage is done
+        await asyncio.gather(*tasks, return_exceptions=True)
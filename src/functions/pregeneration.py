@@ -0,0 +1,187 @@
+import asyncio
+import datetime
+import logging
+import math
+import time
+
+from src.config import (PREGENERATION_CONCURRENCY, PREGENERATION_HORIZON, PREGENERATION_OFF_PEAK_HOURS,
+                        PREGENERATION_RATE_PER_MINUTE)
+from src.events import story_events
+from src.functions.new_story_queue_process import request_next_story
+from src.functions.story_store import get_story, touch_user_stories
+from src.functions.work_queue import STORY_REQUEST_QUEUE, fetch_pending_work
+from src.metrics import Histogram
+from src.models import StoryStatus
+
+PREGENERATION_FREQUENCY = 600  # Every 10 minutes
+PREGENERATION_RELEASE_CHECK = 30  # Ready stories coming out are published within 30 secs
+PREGENERATION_CANDIDATES = 500
+# A requested story not seen ready in this process by then, e.g. one finished by another worker process, no longer
+# counts against the concurrency
+PREGENERATION_IN_FLIGHT_TTL = 2 * 60 * 60
+READ_HOURS_KEPT = 14
+
+logger = logging.getLogger(__name__)
+
+
+def parse_hours(hours):
+    start, end = hours.split("-")
+    return int(start), int(end)
+
+
+def is_off_peak(timestamp, off_peak_hours=PREGENERATION_OFF_PEAK_HOURS):
+    start, end = parse_hours(off_peak_hours)
+    hour = datetime.datetime.utcfromtimestamp(timestamp).hour
+    if start <= end:
+        return start <= hour < end
+    # Window wrapping midnight, e.g. 22-4
+    return hour >= start or hour < end
+
+
+def add_read_hour(read_hours, timestamp):
+    moment = datetime.datetime.utcfromtimestamp(timestamp)
+    return (list(read_hours or []) + [moment.hour + moment.minute / 60])[-READ_HOURS_KEPT:]
+
+
+def usual_read_hour(read_hours):
+    # Circular mean, so 23:30 and 00:30 average to midnight instead of noon
+    if not read_hours:
+        return None
+    angles = [hour / 24 * 2 * math.pi for hour in read_hours]
+    angle = math.atan2(sum(math.sin(a) for a in angles), sum(math.cos(a) for a in angles))
+    return (angle / (2 * math.pi) * 24) % 24
+
+
+def predict_next_read(read_hours, after):
+    # First time at or after `after` that matches the user's usual reading hour
+    hour = usual_read_hour(read_hours)
+    if hour is None:
+        return after
+    day_start = datetime.datetime.utcfromtimestamp(after).replace(hour=0, minute=0, second=0, microsecond=0)
+    candidate = day_start.replace(tzinfo=datetime.timezone.utc).timestamp() + hour * 60 * 60
+    return candidate if candidate >= after else candidate + 24 * 60 * 60
+
+
+class PregenerationScheduler:
+    # During off-peak hours, requests tomorrow's story early for users who have read today's, so it is ready before
+    # they open the app. The story stays hidden until its normal 24 hour mark.
+    def __init__(self, firestore_db, concurrency=PREGENERATION_CONCURRENCY, rate_per_minute=PREGENERATION_RATE_PER_MINUTE,
+                 horizon=PREGENERATION_HORIZON, off_peak_hours=PREGENERATION_OFF_PEAK_HOURS, clock=time.time,
+                 sleep=asyncio.sleep):
+        self.firestore_db = firestore_db
+        self.concurrency = concurrency
+        self.rate_per_minute = rate_per_minute
+        self.horizon = horizon
+        self.off_peak_hours = off_peak_hours
+        self.clock = clock
+        self.sleep = sleep
+        # (user_id, story_id) -> time requested, for pre-generated stories not ready yet
+        self.in_flight = {}
+        # (user_id, story_id) -> available_timestamp, for ready pre-generated stories the reader can't see yet
+        self.hidden = {}
+        self.queue_depth = 0
+        self.requested = 0
+        self.released = 0
+        self.lead_time = Histogram(buckets=(0, 60, 600, 1800, 3600, 3 * 3600, 6 * 3600, 12 * 3600, 24 * 3600))
+        self.generation_latency = Histogram()
+        story_events.add_listener(self.on_story_change)
+
+    def on_story_change(self, user_id, story):
+        if story["status"] != StoryStatus.StoryReady:
+            return
+        now = self.clock()
+        if story.get("available_timestamp", 0) > now:
+            self.hidden[(user_id, story["story_id"])] = story["available_timestamp"]
+        requested_at = self.in_flight.pop((user_id, story["story_id"]), None)
+        if requested_at is None:
+            return
+        self.generation_latency.observe(now - requested_at)
+        # How long before the story was due it was ready, negative would mean the reader was kept waiting
+        self.lead_time.observe(max(story.get("available_timestamp", 0) - now, 0))
+
+    def candidates(self, now):
+        # Read stories whose next story becomes due within the horizon, soonest expected reader first
+        entries = fetch_pending_work(self.firestore_db, STORY_REQUEST_QUEUE, due_before=now + self.horizon,
+                                     limit=PREGENERATION_CANDIDATES)
+        entries = [entry for entry in entries if entry["run_at"] > now]
+        users_ref = self.firestore_db.collection("users")
+        for entry in entries:
+            user = users_ref.document(entry["user_id"]).get(field_paths=["read_hours"])
+            read_hours = (user.to_dict() or {}).get("read_hours", [])
+            entry["expected_read"] = predict_next_read(read_hours, entry["run_at"])
+        return sorted(entries, key=lambda entry: entry["expected_read"])
+
+    def expire_in_flight(self, now):
+        for key, requested_at in list(self.in_flight.items()):
+            if now - requested_at > PREGENERATION_IN_FLIGHT_TTL:
+                del self.in_flight[key]
+
+    async def tick(self):
+        now = self.clock()
+        self.expire_in_flight(now)
+        # Checked before reading any candidates, outside the window a tick costs nothing
+        if not is_off_peak(now, self.off_peak_hours):
+            return 0
+        entries = await asyncio.to_thread(self.candidates, now)
+        self.queue_depth = len(entries)
+        budget = min(self.concurrency - len(self.in_flight),
+                     int(self.rate_per_minute * PREGENERATION_FREQUENCY / 60))
+        requested = 0
+        for entry in entries[:max(budget, 0)]:
+            try:
+                story = await asyncio.to_thread(request_next_story, self.firestore_db.transaction(), self.firestore_db,
+                                                entry, pregenerate=True)
+            except Exception:
+                logger.exception("Could not pre-generate story for %s", entry["user_id"])
+                continue
+            if story is not None:
+                self.in_flight[(entry["user_id"], story["story_id"])] = self.clock()
+                story_events.publish_story_change(entry["user_id"], story)
+                requested += 1
+                self.requested += 1
+                self.queue_depth -= 1
+            # Spread the requests out instead of dropping them on the providers all at once
+            await self.sleep(60 / self.rate_per_minute)
+        return requested
+
+    def release(self, user_id, story_id):
+        # Bumps the user's story version and publishes the change, so ETags, caches and /story/events/ readers
+        # see the story come out
+        story = get_story(self.firestore_db, user_id, story_id)
+        if story is None or story["status"] != StoryStatus.StoryReady:
+            return False
+        touch_user_stories(self.firestore_db, user_id, story)
+        return True
+
+    async def release_due(self):
+        now = self.clock()
+        due = [key for key, available_timestamp in self.hidden.items() if available_timestamp <= now]
+        released = 0
+        for user_id, story_id in due:
+            del self.hidden[(user_id, story_id)]
+            try:
+                released += await asyncio.to_thread(self.release, user_id, story_id)
+            except Exception:
+                logger.exception("Could not publish pre-generated story %s for %s", story_id, user_id)
+        self.released += released
+        return released
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth,
+            "in_flight": len(self.in_flight),
+            "hidden": len(self.hidden),
+            "requested": self.requested,
+            "released": self.released,
+            "lead_time": self.lead_time.snapshot(),
+            "generation_latency": self.generation_latency.snapshot()
+        }
+
+    async def run(self):
+        next_tick = self.clock()
+        while True:
+            if self.clock() >= next_tick:
+                await self.tick()
+                next_tick = self.clock() + PREGENERATION_FREQUENCY
+            await self.release_due()
+            await self.sleep(PREGENERATION_RELEASE_CHECK)
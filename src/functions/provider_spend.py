@@ -0,0 +1,60 @@
+import asyncio
+import logging
+
+from google.cloud import firestore
+
+from src.config import PROVIDER_SPEND_SYNC_INTERVAL
+from src.external_libs.rate_limiter import openai_limiter, stable_diffusion_limiter
+from src.metrics import firestore_latency, timed
+
+# provider_spend/{provider}-{YYYY-MM-DD} -> what every process estimated it spent with that provider that day
+PROVIDER_SPEND_COLLECTION = "provider_spend"
+
+logger = logging.getLogger(__name__)
+
+
+def spend_ref(firestore_db, name, day):
+    return firestore_db.collection(PROVIDER_SPEND_COLLECTION).document(f"{name}-{day.isoformat()}")
+
+
+def add_provider_spend(firestore_db, name, day, spent):
+    # Returns the day's total with `spent` added
+    ref = spend_ref(firestore_db, name, day)
+    with timed(firestore_latency.labels(operation="provider_spend")):
+        if spent:
+            ref.set({"provider": name, "day": day.isoformat(), "spent": firestore.Increment(spent)}, merge=True)
+        return (ref.get().to_dict() or {}).get("spent", 0.0)
+
+
+async def sync_provider_spend(firestore_db, limiter):
+    # Every process checks the one DAILY_PROVIDER_BUDGET: each adds its spend to the day's total and gets the
+    # total back, another process's spend is seen at most one sync interval late
+    day, spent = limiter.take_unsynced_spend()
+    try:
+        total = await asyncio.to_thread(add_provider_spend, firestore_db, limiter.name, day, spent)
+    except Exception:
+        limiter.return_unsynced_spend(day, spent)
+        raise
+    limiter.record_synced_spend(day, total)
+
+
+async def run_provider_spend_sync(firestore_db, limiters=(openai_limiter, stable_diffusion_limiter),
+                                  interval=PROVIDER_SPEND_SYNC_INTERVAL):
+    try:
+        while True:
+            for limiter in limiters:
+                try:
+                    await sync_provider_spend(firestore_db, limiter)
+                except Exception:
+                    logger.exception("Could not sync %s spend", limiter.name)
+            await asyncio.sleep(interval)
+    except asyncio.CancelledError:
+        # Shutting down, what was spent since the last sync still counts
+        for limiter in limiters:
+            day, spent = limiter.take_unsynced_spend()
+            if spent:
+                try:
+                    add_provider_spend(firestore_db, limiter.name, day, spent)
+                except Exception:
+                    logger.exception("Could not sync %s spend", limiter.name)
+        raise
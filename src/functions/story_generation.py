@@ -1,39 +1,157 @@
 import asyncio
-
-from google.cloud.firestore_v1.types import firestore
+import datetime
+import time
 
 from src.models import StoryStatus
 from src.external_libs.prompt_builder import build_summary_prompt
-from src.external_libs.text_completion import generate_text
+from src.external_libs.rate_limiter import PRIORITY_DEFAULT, BudgetExceeded, story_priority
+from src.external_libs.text_completion import generate_text, stream_text
+from src.functions.leases import claim_story, forget_lease, release_story
+from src.functions.pipeline import BUDGET_RETRY_DELAY, record_stage_failure, run_stage
+from src.functions.story_store import get_story, update_story
+from src.functions.work_queue import resync_story_queue
+from src.tracing import span
+
+STORY_GENERATION_FREQUENCY = 600  # Recovery scan every 10 minutes, new stories are handed over straight away
+REMOTE_GENERATION_POLL_INTERVAL = 2
+
+# Stories being generated in this process, keyed by (user_id, story_id), so readers can follow along
+_active_generations = {}
+_generation_tasks = set()
+
+
+class TextStream:
+    # Story text as it arrives, any number of readers can iterate it from the start
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+        # Why generation stopped, when it did not finish
+        self.error = None
+        self._changed = asyncio.Event()
+
+    def append(self, chunk):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def close(self):
+        self.closed = True
+        self._notify()
+
+    async def wait_started(self):
+        # Until there is text to send or there never will be
+        while not self.chunks and not self.closed:
+            await self._changed.wait()
 
-STORY_GENERATION_FREQUENCY = 60  # Every minute
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
 
+    async def iterate(self):
+        index = 0
+        while True:
+            changed = self._changed
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            if self.closed:
+                return
+            await changed.wait()
 
-def generate_story(prompt):
-    generated_text = generate_text(prompt, temperature=float(0.9), max_tokens=int(400))
-    generated_summary = generate_text(build_summary_prompt(generated_text), temperature=float(0.9), max_tokens=25)
+
+async def generate_story(prompt, text_stream=None, priority=PRIORITY_DEFAULT):
+    chunks = []
+    async for chunk in stream_text(prompt, temperature=float(0.9), max_tokens=int(400), priority=priority):
+        chunks.append(chunk)
+        if text_stream is not None:
+            text_stream.append(chunk)
+    generated_text = "".join(chunks)
+    generated_summary = await generate_text(build_summary_prompt(generated_text), temperature=float(0.9),
+                                            max_tokens=25, priority=priority)
     return [generated_text, generated_summary]
 
 
+async def process_story_generation(firestore_db, entry, text_stream=None, writes=None):
+    key = (entry["user_id"], entry["story_id"])
+    # A stream handed in means a reader is waiting on this story
+    interactive = text_stream is not None
+    if text_stream is None:
+        # The stage holds the lease. A reader who came in while it was claiming follows the text in their stream.
+        text_stream = _active_generations.get(key)
+        if text_stream is None:
+            text_stream = TextStream()
+            _active_generations[key] = text_stream
+    finished = False
+    try:
+        story = await asyncio.to_thread(get_story, firestore_db, entry["user_id"], entry["story_id"])
+        if story is None or story.get("status") != StoryStatus.PendingTextGeneration:
+            resync_story_queue(firestore_db, entry, story, writes)
+            return
+        priority = story_priority(story, datetime.datetime.utcnow().timestamp(), interactive)
+        [generated_text, generated_summary] = await generate_story(story.get("prompt"), text_stream, priority)
+        await asyncio.to_thread(update_story, firestore_db, entry["user_id"], entry["story_id"],
+                                StoryStatus.PendingTextGeneration, {
+                                    "generated_story": generated_text,
+                                    "generated_summary": generated_summary,
+                                    "status": StoryStatus.PendingImageGeneration
+                                }, writes)
+        finished = writes is not None
+    except Exception as error:
+        text_stream.error = error
+        raise
+    finally:
+        text_stream.close()
+        if finished:
+            # Readers keep getting the finished text from memory until the new status is committed
+            writes.after_commit(lambda: _active_generations.pop(key, None))
+        else:
+            _active_generations.pop(key, None)
+
+
+async def generate_for_reader(firestore_db, user_id, story_id, text_stream):
+    if await asyncio.to_thread(claim_story, firestore_db, StoryStatus.PendingTextGeneration, user_id, story_id):
+        try:
+            with span("stage PendingTextGeneration", user_id, story_id, reader=True):
+                await process_story_generation(firestore_db, {"user_id": user_id, "story_id": story_id}, text_stream)
+            forget_lease(user_id, story_id, StoryStatus.PendingTextGeneration)
+        except BudgetExceeded:
+            # Not the story's fault, it goes back like the stage defers it, due once the budget may allow it
+            await asyncio.to_thread(release_story, firestore_db, user_id, story_id, time.time() + BUDGET_RETRY_DELAY)
+            return
+        except Exception as error:
+            # Counted like a failure in the worker, a story that always fails is not retried for every reader
+            await asyncio.to_thread(record_stage_failure, firestore_db, StoryStatus.PendingTextGeneration, user_id,
+                                    story_id, error)
+            raise
+        return
+    # A worker is generating it. One in this process streams into text_stream, one in another process is only
+    # heard from once the text is saved.
+    try:
+        while True:
+            await asyncio.sleep(REMOTE_GENERATION_POLL_INTERVAL)
+            story = await asyncio.to_thread(get_story, firestore_db, user_id, story_id)
+            if story is None or story.get("status") != StoryStatus.PendingTextGeneration:
+                if story is not None and not text_stream.chunks:
+                    text_stream.append(story.get("generated_story", ""))
+                return
+    finally:
+        text_stream.close()
+        _active_generations.pop((user_id, story_id), None)
+
+
+def start_story_generation(firestore_db, user_id, story_id):
+    # Generate a story now for a waiting reader, or join the generation already running
+    key = (user_id, story_id)
+    text_stream = _active_generations.get(key)
+    if text_stream is None:
+        text_stream = TextStream()
+        _active_generations[key] = text_stream
+        task = asyncio.create_task(generate_for_reader(firestore_db, user_id, story_id, text_stream))
+        _generation_tasks.add(task)
+        task.add_done_callback(_generation_tasks.discard)
+    return text_stream
+
+
 async def run_story_generation_service(firestore_db):
-    while True:
-        users_ref = firestore_db.collection("users")
-        users = users_ref.stream()
-
-        for user in users:
-            stories = user.get("stories")
-            if stories:
-                for index, story in enumerate(stories):
-                    if story.get("status") == "PendingTextGeneration":
-                        [generated_text, generated_summary] = generate_story(story.get("prompt"))
-                        user_ref = users_ref.document(user.id)
-                        story = story.copy()
-                        story["generated_story"] = generated_text
-                        story["generated_summary"] = generated_summary
-                        story["status"] = StoryStatus.PendingImageGeneration
-                        stories[index] = story
-                        user_ref.update({
-                            "stories": stories
-                        })
-
-        await asyncio.sleep(STORY_GENERATION_FREQUENCY)
+    await run_stage(firestore_db, StoryStatus.PendingTextGeneration,
+                    lambda entry, writes: process_story_generation(firestore_db, entry, writes=writes),
+                    STORY_GENERATION_FREQUENCY)
@@ -0,0 +1,130 @@
+import time
+
+from google.cloud import firestore
+
+from src.events import story_events
+from src.functions.work_queue import update_story_queue
+from src.functions.write_coalescer import WriteCoalescer
+from src.metrics import firestore_latency, timed
+from src.models import StoryStatus
+from src.user_cache import user_write_fields
+
+# Stories live in users/{user_id}/stories/{story_id}, the /stories/ list only reads these fields
+STORY_SUMMARY_FIELDS = ["story_id", "status", "read_status", "timestamp", "generated_summary", "image_url",
+                        "image_hash", "available_timestamp"]
+STORY_PAGE_SIZE = 20
+
+
+def stories_collection(firestore_db, user_id):
+    return firestore_db.collection("users").document(user_id).collection("stories")
+
+
+def story_ref(firestore_db, user_id, story_id):
+    return stories_collection(firestore_db, user_id).document(str(story_id))
+
+
+def get_story(firestore_db, user_id, story_id):
+    with timed(firestore_latency.labels(operation="get_story")):
+        return story_ref(firestore_db, user_id, story_id).get().to_dict()
+
+
+def user_story_fields(story=None):
+    # Bump the per-user version that status polling and ETags are built on.
+    # Status changes also record which story changed last so /story/status/ never reads a story document.
+    fields = {"story_version": firestore.Increment(1)}
+    if story is not None:
+        fields["latest_story_id"] = story["story_id"]
+        fields["latest_story_status"] = story["status"]
+        fields["latest_story_available_timestamp"] = story.get("available_timestamp", 0)
+        # What relay_story_changes listens for
+        fields["latest_story_changed_at"] = time.time()
+    return fields
+
+
+def touch_user_stories(firestore_db, user_id, story=None, writes=None):
+    user_ref = firestore_db.collection("users").document(user_id)
+    if writes is None:
+        user_ref.update(user_story_fields(story))
+        if story is not None:
+            story_events.publish_story_change(user_id, story)
+    else:
+        writes.update(user_ref, user_story_fields(story))
+        if story is not None:
+            writes.after_commit(lambda: story_events.publish_story_change(user_id, story))
+
+
+def create_story(firestore_db, user_id, story, writes=None):
+    commit_now = writes is None
+    writes = writes or WriteCoalescer(firestore_db)
+    writes.set(story_ref(firestore_db, user_id, story["story_id"]), story)
+    update_story_queue(firestore_db, user_id, story["story_id"], story["status"], writes=writes)
+    touch_user_stories(firestore_db, user_id, story, writes)
+    if commit_now:
+        writes.commit()
+
+
+def mark_story_read(firestore_db, user_id, story_id, read_hours=None):
+    # Field level updates, nothing a worker writes at the same time can be overwritten
+    writes = WriteCoalescer(firestore_db)
+    writes.update(story_ref(firestore_db, user_id, story_id), {"read_status": "read"})
+    touch_user_stories(firestore_db, user_id, writes=writes)
+    if read_hours is not None:
+        user_ref = firestore_db.collection("users").document(user_id)
+        writes.update(user_ref, user_write_fields({"read_hours": read_hours}))
+    writes.commit()
+
+
+def update_story(firestore_db, user_id, story_id, expected_status, fields, writes=None):
+    # Only the changed fields of the one story document are written, along with its queue entry and the
+    # user's version in one commit. Pass `writes` to hold them until the end of a worker tick.
+    # `expected_status` can be a tuple when more than one status may move on, e.g. an early webhook
+    expected_statuses = expected_status if isinstance(expected_status, tuple) else (expected_status,)
+    ref = story_ref(firestore_db, user_id, story_id)
+    with timed(firestore_latency.labels(operation="get_story")):
+        story = ref.get().to_dict()
+    if story is None or story.get("status") not in expected_statuses:
+        return None
+    commit_now = writes is None
+    writes = writes or WriteCoalescer(firestore_db)
+    writes.update(ref, fields)
+    story.update(fields)
+    run_at = story.get("fetch_image_timestamp", 0) if story["status"] == StoryStatus.PendingImageFetch else 0
+    update_story_queue(firestore_db, user_id, story_id, story["status"], run_at, writes)
+    touch_user_stories(firestore_db, user_id, story if "status" in fields else None, writes)
+    if commit_now:
+        writes.commit()
+    return story
+
+
+def is_available(story, now):
+    return story.get("available_timestamp", 0) <= now
+
+
+def find_latest_story(firestore_db, user_id, status=None, available_at=None):
+    # With `available_at`, a pre-generated story that is not out yet is skipped. There is at most one of those,
+    # always the newest, so looking at two stories is enough.
+    query = stories_collection(firestore_db, user_id)
+    if status is not None:
+        query = query.where("status", "==", status)
+    query = query.order_by("story_id", direction=firestore.Query.DESCENDING).limit(1 if available_at is None else 2)
+    with timed(firestore_latency.labels(operation="latest_story")):
+        stories = [story.to_dict() for story in query.stream()]
+    for story in stories:
+        if available_at is None or is_available(story, available_at):
+            return story
+    return None
+
+
+def list_stories(firestore_db, user_id, limit=STORY_PAGE_SIZE, cursor=None, available_at=None):
+    # Newest first, `cursor` is the story_id of the last story on the previous page
+    query = stories_collection(firestore_db, user_id) \
+        .select(STORY_SUMMARY_FIELDS) \
+        .order_by("story_id", direction=firestore.Query.DESCENDING)
+    if cursor is not None:
+        query = query.start_after({"story_id": cursor})
+    with timed(firestore_latency.labels(operation="list_stories")):
+        stories = [story.to_dict() for story in query.limit(limit).stream()]
+    next_cursor = stories[-1]["story_id"] if len(stories) == limit else None
+    if available_at is not None:
+        stories = [story for story in stories if is_available(story, available_at)]
+    return stories, next_cursor
@@ -0,0 +1,40 @@
+import asyncio
+import logging
+import time
+
+from src.metrics import registry
+
+# Seconds before restarting a crashed loop, doubling on each crash up to the max. A loop that stayed up for
+# `healthy_after` seconds starts again from the base.
+SUPERVISOR_RESTART_BASE = 1
+SUPERVISOR_RESTART_MAX = 60
+SUPERVISOR_HEALTHY_AFTER = 60
+
+logger = logging.getLogger(__name__)
+
+# Loop name -> how many times it was restarted in this process
+worker_restarts = {}
+
+registry.gauge("worker_restarts", "Times each worker loop crashed and was restarted",
+               lambda: {(("loop", name),): count for name, count in worker_restarts.items()})
+
+
+async def supervise(name, run, restart_base=SUPERVISOR_RESTART_BASE, restart_max=SUPERVISOR_RESTART_MAX,
+                    healthy_after=SUPERVISOR_HEALTHY_AFTER):
+    # `run` returns a fresh coroutine for every start. Cancelling the supervisor cancels the loop and stops.
+    worker_restarts.setdefault(name, 0)
+    delay = restart_base
+    while True:
+        started = time.monotonic()
+        try:
+            await run()
+            logger.warning("Worker loop %s returned, restarting it", name)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Worker loop %s crashed, restarting it", name)
+        if time.monotonic() - started >= healthy_after:
+            delay = restart_base
+        worker_restarts[name] += 1
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, restart_max)
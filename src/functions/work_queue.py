@@ -0,0 +1,125 @@
+import datetime
+
+from src.metrics import firestore_latency, timed
+from src.models import StoryStatus
+
+# Pending work index, one document per story that still needs something done.
+# Workers query this collection by status instead of streaming every user.
+# Needs a composite index on (status ASC, run_at ASC).
+WORK_QUEUE_COLLECTION = "story_queue"
+WORK_QUEUE_BATCH_SIZE = 50
+
+# Not a story status, used for stories that were read and are waiting for the next one to be requested
+STORY_REQUEST_QUEUE = "PendingStoryRequest"
+STORY_REQUEST_DELAY = 24 * 60 * 60
+
+
+def queue_entry_id(user_id, story_id):
+    return f"{user_id}_{story_id}"
+
+
+def queue_ref(firestore_db, user_id, story_id):
+    return firestore_db.collection(WORK_QUEUE_COLLECTION).document(queue_entry_id(user_id, story_id))
+
+
+# `writes` can be a WriteCoalescer, batch or transaction to send the change along with others
+def enqueue_story(firestore_db, user_id, story_id, status, run_at=0, writes=None):
+    entry = {
+        "user_id": user_id,
+        "story_id": story_id,
+        "status": status,
+        "run_at": run_at,
+        "updated_at": datetime.datetime.utcnow().timestamp()
+    }
+    if writes is None:
+        queue_ref(firestore_db, user_id, story_id).set(entry)
+    else:
+        writes.set(queue_ref(firestore_db, user_id, story_id), entry)
+
+
+def dequeue_story(firestore_db, user_id, story_id, writes=None):
+    if writes is None:
+        queue_ref(firestore_db, user_id, story_id).delete()
+    else:
+        writes.delete(queue_ref(firestore_db, user_id, story_id))
+
+
+def update_story_queue(firestore_db, user_id, story_id, status, run_at=0, writes=None):
+    # Keep the index in step with a story status change, ready stories drop out of the queue
+    if status == StoryStatus.StoryReady:
+        dequeue_story(firestore_db, user_id, story_id, writes)
+    else:
+        enqueue_story(firestore_db, user_id, story_id, status, run_at, writes)
+
+
+def resync_story_queue(firestore_db, entry, story, writes=None):
+    # The story moved on or was removed without the index hearing about it
+    if story is None:
+        dequeue_story(firestore_db, entry["user_id"], entry["story_id"], writes)
+    elif story.get("status") == StoryStatus.PendingImageFetch:
+        update_story_queue(firestore_db, entry["user_id"], entry["story_id"], story["status"],
+                           story.get("fetch_image_timestamp", 0), writes)
+    else:
+        update_story_queue(firestore_db, entry["user_id"], entry["story_id"], story["status"], writes=writes)
+
+
+def fetch_pending_work(firestore_db, status, due_before=None, limit=WORK_QUEUE_BATCH_SIZE):
+    query = firestore_db.collection(WORK_QUEUE_COLLECTION).where("status", "==", status)
+    if due_before is not None:
+        query = query.where("run_at", "<=", due_before)
+    query = query.order_by("run_at").limit(limit)
+    with timed(firestore_latency.labels(operation="queue_scan")):
+        return [entry.to_dict() for entry in query.stream()]
+
+
+def iterate_pending_work(firestore_db, status, due_before=None, batch_size=WORK_QUEUE_BATCH_SIZE):
+    # Every pending entry for a status, read a batch at a time
+    last_entry = None
+    while True:
+        query = firestore_db.collection(WORK_QUEUE_COLLECTION).where("status", "==", status)
+        if due_before is not None:
+            query = query.where("run_at", "<=", due_before)
+        query = query.order_by("run_at").order_by("__name__").limit(batch_size)
+        if last_entry is not None:
+            query = query.start_after(last_entry)
+        with timed(firestore_latency.labels(operation="queue_scan")):
+            entries = list(query.stream())
+        for entry in entries:
+            yield entry.to_dict()
+        if len(entries) < batch_size:
+            return
+        last_entry = entries[-1]
+
+
+def rebuild_work_queue(firestore_db):
+    # One off full scan to build the index for users created before the queue existed
+    queued = 0
+    for user in firestore_db.collection("users").stream():
+        user_id = user.id
+        stories = sorted((story.to_dict() for story in user.reference.collection("stories").stream()),
+                         key=lambda story: story["story_id"])
+        if not stories:
+            continue
+        for story in stories:
+            status = story.get("status")
+            if status == StoryStatus.PendingImageFetch:
+                enqueue_story(firestore_db, user_id, story["story_id"], status, story.get("fetch_image_timestamp", 0))
+                queued += 1
+            elif status != StoryStatus.StoryReady:
+                enqueue_story(firestore_db, user_id, story["story_id"], status)
+                queued += 1
+        last_story = stories[-1]
+        if last_story["status"] == StoryStatus.StoryReady and last_story["read_status"] == "read":
+            enqueue_story(firestore_db, user_id, last_story["story_id"], STORY_REQUEST_QUEUE,
+                          user.get("last_story_generated_timestamp") + STORY_REQUEST_DELAY)
+            queued += 1
+    return queued
+
+
+if __name__ == "__main__":
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    cred = credentials.Certificate("goodnight-ai-firebase-service-account-key.json")
+    firebase_admin.initialize_app(cred)
+    print(f"Queued {rebuild_work_queue(firestore.client())} stories")
@@ -0,0 +1,87 @@
+from google.cloud import firestore
+
+from src.metrics import firestore_latency, registry, timed
+
+# Firestore allows at most 500 writes per batch
+FIRESTORE_BATCH_LIMIT = 500
+
+write_stats = {
+    "ticks": 0,
+    "operations": 0,
+    "commits": 0,
+    "round_trips_saved": 0,
+    "last_tick_round_trips_saved": 0
+}
+registry.stats("write_coalescer", lambda: write_stats)
+
+
+class WriteCoalescer:
+    # Collects the writes of one worker tick and sends them as a few batch commits instead of one call each.
+    # Has the same set/update/delete methods as a WriteBatch or Transaction so callers can pass any of them.
+    def __init__(self, firestore_db):
+        self._db = firestore_db
+        self._writes = {}
+        self._after_commit = []
+        self.operations = 0
+
+    def set(self, ref, data):
+        self.operations += 1
+        self._writes[ref.path] = ("set", ref, data)
+
+    def update(self, ref, fields):
+        self.operations += 1
+        previous = self._writes.get(ref.path)
+        if previous is not None and previous[0] == "update":
+            fields = merge_updates(previous[2], fields)
+        elif previous is not None and previous[0] == "set":
+            # Folding an update into a pending set keeps it one write
+            self._writes[ref.path] = ("set", ref, merge_updates(previous[2], fields))
+            return
+        self._writes[ref.path] = ("update", ref, fields)
+
+    def delete(self, ref):
+        self.operations += 1
+        self._writes[ref.path] = ("delete", ref, None)
+
+    def after_commit(self, callback):
+        self._after_commit.append(callback)
+
+    def commit(self):
+        writes = list(self._writes.values())
+        commits = 0
+        for start in range(0, len(writes), FIRESTORE_BATCH_LIMIT):
+            batch = self._db.batch()
+            for operation, ref, data in writes[start:start + FIRESTORE_BATCH_LIMIT]:
+                if operation == "set":
+                    batch.set(ref, data)
+                elif operation == "update":
+                    batch.update(ref, data)
+                else:
+                    batch.delete(ref)
+            with timed(firestore_latency.labels(operation="batch_commit")):
+                batch.commit()
+            commits += 1
+        callbacks = self._after_commit
+        self._writes = {}
+        self._after_commit = []
+
+        write_stats["ticks"] += 1
+        write_stats["operations"] += self.operations
+        write_stats["commits"] += commits
+        write_stats["round_trips_saved"] += self.operations - commits
+        write_stats["last_tick_round_trips_saved"] = self.operations - commits
+        self.operations = 0
+
+        for callback in callbacks:
+            callback()
+        return commits
+
+
+def merge_updates(previous, fields):
+    merged = dict(previous)
+    for key, value in fields.items():
+        old_value = merged.get(key)
+        if isinstance(value, firestore.Increment) and isinstance(old_value, firestore.Increment):
+            value = firestore.Increment(old_value.value + value.value)
+        merged[key] = value
+    return merged
@@ -0,0 +1,25 @@
+# What each role needs before it is warm. /readyz answers 503 until every check registered in this process passes,
+# /healthz only says the process is up and its event loop is answering.
+import time
+
+started_at = time.monotonic()
+
+# name -> callable returning whether that part of the process is ready
+_checks = {}
+
+
+def add_check(name, check):
+    _checks[name] = check
+
+
+def readiness():
+    checks = {name: bool(check()) for name, check in _checks.items()}
+    return {
+        "ready": bool(checks) and all(checks.values()),
+        "checks": checks,
+        "uptime_s": time.monotonic() - started_at
+    }
+
+
+def health():
+    return {"status": "ok", "uptime_s": time.monotonic() - started_at}
@@ -1,29 +1,49 @@
 import asyncio
+import datetime
+import hmac
+import os
 import sys
+import time
 import typing
 
-import firebase_admin
 import orjson
-import uvicorn
-from fastapi import FastAPI, HTTPException, Request, Header, Depends
+from fastapi import FastAPI, HTTPException, Request, Header, Depends, Query
 from fastapi.middleware.gzip import GZipMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.security import HTTPBearer
-from firebase_admin import auth, credentials, firestore
 from starlette.middleware.cors import CORSMiddleware
 
-from functions.image_queue_process import run_image_queue_process_service
-from functions.new_story_queue_process import run_story_request_service
-from src.functions.image_generation import run_image_generation_service
-from src.functions.story_generation import run_story_generation_service
+from src.external_libs.http_client import close_http_session
+from src.external_libs.rate_limiter import BudgetExceeded
+from src.functions.story_store import (STORY_PAGE_SIZE, find_latest_story, get_story, is_available, list_stories,
+                                       mark_story_read)
+from src.functions.work_queue import STORY_REQUEST_DELAY, STORY_REQUEST_QUEUE, enqueue_story
+from src.external_libs.generation_cache import generation_cache
+from src.functions.image_generation import (image_cache_key, is_valid_webhook_token, mark_image_ready,
+                                            parse_track_id, webhook_enabled)
+from src.functions.image_store import (IMAGE_VARIANTS, fetch_missing_image, image_path, is_valid_digest, media_type,
+                                      watch_ready_stories)
+from src.functions.leases import run_lease_heartbeat
+from src.functions.pipeline import BUDGET_RETRY_DELAY
+from src.functions.provider_spend import run_provider_spend_sync
+from src.functions.story_generation import start_story_generation
+from src.config import ADMIN_TOKEN, RUN_WORKERS
+from src.events import relay_story_changes, story_event_stream, story_events
+from src.health import add_check, health, readiness
+from src.metrics import registry, request_latency
+from src.functions.pregeneration import add_read_hour
+from src.profiler import profiler
+from src.token_cache import token_cache
+from src.tracing import span
+from src.user_cache import user_cache, user_write_fields, watch_user_changes
+from src.functions.supervisor import supervise
+from src.worker import initialize_firestore, start_workers, stop_tasks
 from src.models import (StoryStatus,
                         UserDbObject, UserPayload,
                         UserSubscriptionObject, ReadStoryPayload)
 
 sys.path.append("src")
 
-HTTP_PORT = 8000
-
 
 class ORJSONResponse(JSONResponse):
     media_type = "application/json"
@@ -32,8 +52,59 @@ class ORJSONResponse(JSONResponse):
         return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
 
 
+class StreamingAwareGZipMiddleware(GZipMiddleware):
+    # Compressing a stream buffers events and text inside zlib, leave those paths alone.
+    # Images are compressed already and need their byte ranges intact.
+    uncompressed_suffixes = ("/events/", "/stream/")
+    uncompressed_prefixes = ("/images/",)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and (scope["path"].endswith(self.uncompressed_suffixes) or
+                                        scope["path"].startswith(self.uncompressed_prefixes)):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+class MetricsMiddleware:
+    # Latency per route template, up to the response headers so long lived streams don't skew it
+    def __init__(self, app):
+        self.app = app
+        self._route_paths = None
+
+    def route_path(self, scope):
+        if self._route_paths is None:
+            self._route_paths = {route.endpoint: route.path for route in scope["app"].routes
+                                 if hasattr(route, "endpoint")}
+        return self._route_paths.get(scope.get("endpoint"), "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        observed = False
+
+        def observe(status_code):
+            nonlocal observed
+            observed = True
+            request_latency.labels(route=self.route_path(scope), method=scope["method"],
+                                   status=status_code).observe(time.perf_counter() - started)
+
+        async def send_observed(message):
+            if message["type"] == "http.response.start":
+                observe(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_observed)
+        finally:
+            if not observed:
+                observe(500)
+
+
 app = FastAPI(default_response_class=ORJSONResponse)
-app.add_middleware(GZipMiddleware, minimum_size=1000)
+app.add_middleware(StreamingAwareGZipMiddleware, minimum_size=1000)
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -41,51 +112,173 @@ app.add_middleware(
     allow_headers=["*"],
     allow_origins=["*"]
 )
+app.add_middleware(MetricsMiddleware)
+
+# Components register their own stats where they are created, so a worker-only /metrics has them too
+registry.gauge("sse_subscribers", "Open /story/events/ streams", story_events.backend.subscriber_count)
 
 db = None
 security = HTTPBearer()
 
 
-def get_auth_verified_user_id(authorization):
-    # Verify JWT token
+async def get_auth_verified_user_id(authorization):
+    # Verify JWT token, verified tokens are cached until they expire
     if not authorization:
         raise HTTPException(
             status_code=400, detail="Authorization header missing")
-    id_token = authorization.split("Bearer ")[1]
+    # HTTPBearer has already stripped the scheme, this is the token itself
     try:
-        decoded_token = firebase_admin.auth.verify_id_token(id_token)
-        return decoded_token["uid"]
+        return await token_cache.get_user_id(authorization)
     except Exception as e:
         raise HTTPException(status_code=400, detail="Invalid JWT token")
 
 
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+IMAGE_RANGE_CHUNK_SIZE = 64 * 1024
+
+
+def parse_range(range_header, size):
+    # Single "bytes=start-end" range, None when missing or not satisfiable
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    start, _, end = range_header[len("bytes="):].partition("-")
+    try:
+        if start == "":
+            start, end = max(size - int(end), 0), size - 1
+        else:
+            start, end = int(start), min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        return None
+    return start, end
+
+
+def read_file_range(path, start, end):
+    with open(path, "rb") as image_file:
+        image_file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = image_file.read(min(IMAGE_RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                return
+            remaining -= len(chunk)
+            yield chunk
+
+
+def story_etag(version, available=True):
+    # A pre-generated story coming out changes what the reader sees without a new version
+    return f'"stories-{version}"' if available else f'"stories-{version}-pending"'
+
+
+def visible_latest_story(user, now):
+    # The newest story as the reader should see it. A pre-generated story is only made after the one before it was
+    # ready and read, so until it is available that previous story is the latest.
+    story_id = user.get("latest_story_id")
+    status = user.get("latest_story_status")
+    if story_id is not None and user.get("latest_story_available_timestamp", 0) > now:
+        return story_id - 1, StoryStatus.StoryReady
+    return story_id, status
+
+
+def require_admin(admin_token):
+    # Admin endpoints don't exist unless ADMIN_TOKEN is set
+    if not ADMIN_TOKEN or not hmac.compare_digest(admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=404, detail="Not Found")
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+
+# Background tasks started with the app, cancelled when it shuts down
+worker_tasks = []
+service_tasks = []
+# Firestore listeners started with the app, unsubscribed when it shuts down
+watches = []
+
+
 @app.on_event("startup")
 async def setup():
     global db
-    # Initialize Firebase App
-    cred = credentials.Certificate(
-        "goodnight-ai-firebase-service-account-key.json")
-    firebase_admin.initialize_app(cred)
-    # Get a reference to the Firestore database
-    db = firestore.client()
-    asyncio.create_task(run_story_request_service(db))
-    asyncio.create_task(run_story_generation_service(db))
-    asyncio.create_task(run_image_generation_service(db))
-    asyncio.create_task(run_image_queue_process_service(db))
+    story_events.bind(asyncio.get_running_loop())
+    db = initialize_firestore()
+    add_check("firestore", lambda: db is not None)
+    add_check("signing_certs", lambda: token_cache.warm)
+    watch_ready_stories(db)
+    # /story/events/ hears of the changes workers in other processes make too
+    watches.append(relay_story_changes(db))
+    # So do the user caches of the other processes, of the config and subscription changes made here
+    watches.append(watch_user_changes(db))
+    service_tasks.append(asyncio.create_task(supervise("cert_refresh", token_cache.run_cert_refresh)))
+    # Leases taken by the stream endpoint need renewing even when workers run elsewhere
+    service_tasks.append(asyncio.create_task(supervise("lease_heartbeat", lambda: run_lease_heartbeat(db))))
+    # Stories generated for readers spend from the shared budget too
+    service_tasks.append(asyncio.create_task(supervise("provider_spend", lambda: run_provider_spend_sync(db))))
+    if RUN_WORKERS:
+        worker_tasks.extend(start_workers(db))
+
+
+@app.on_event("shutdown")
+async def teardown():
+    # Workers first, their stories release the leases the heartbeat is still renewing
+    await stop_tasks(worker_tasks)
+    await stop_tasks(service_tasks)
+    worker_tasks.clear()
+    service_tasks.clear()
+    for watch in watches:
+        watch.unsubscribe()
+    watches.clear()
+    story_events.relayed = False
+    user_cache.clear()
+    await close_http_session()
 
 
 @app.get("/")
 def read_root():
     return {"Status": "Active"}
 
+
+@app.get("/healthz")
+def get_health():
+    return health()
+
+
+@app.get("/readyz")
+def get_readiness():
+    # 503 until the role is warm: Firestore connected, signing certs fetched and, with RUN_WORKERS, every stage running
+    result = readiness()
+    return ORJSONResponse(result, status_code=200 if result["ready"] else 503)
+
+
+@app.get("/metrics")
+def get_metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.post("/admin/profiler/start")
+async def start_profiler(x_admin_token: str = Header(default="")):
+    require_admin(x_admin_token)
+    return {"started": profiler.start()}
+
+
+@app.post("/admin/profiler/stop")
+async def stop_profiler(x_admin_token: str = Header(default="")):
+    # Folded stacks with sample counts, ready for flamegraph.pl or speedscope
+    require_admin(x_admin_token)
+    return PlainTextResponse(await asyncio.to_thread(profiler.stop))
+
 @app.post("/user/")
 async def new_user(payload: UserPayload, authorization=Depends(security)):
-    verified_user_id = get_auth_verified_user_id(authorization.credentials)
+    verified_user_id = await get_auth_verified_user_id(authorization.credentials)
     # Check if the user already exists in the Firestore collection
     user_ref = db.collection(u'users').document(verified_user_id)
-    user = user_ref.get()
+    user = user_cache.get(db, verified_user_id)
 
-    if not user.exists:
+    if user is None:
         # If the user does not exist, store the information in the Firestore collection
         user_object = UserDbObject(
             name=payload.name,
@@ -100,9 +293,10 @@ async def new_user(payload: UserPayload, authorization=Depends(security)):
                 isActive = False
             ),
             config=payload.user_config,
-            stories=[]
+            story_count=0
         )
         user_ref.set(user_object.dict())
+        user_cache.invalidate(verified_user_id)
         return {"message": "User information stored successfully", "user_id": verified_user_id}, 201
     else:
         return "User already exists", 200
@@ -110,98 +304,212 @@ async def new_user(payload: UserPayload, authorization=Depends(security)):
 
 @app.post("/user/config/")
 async def edit_user_config(payload: UserPayload, authorization=Depends(security)):
-    verified_user_id = get_auth_verified_user_id(authorization.credentials)
+    verified_user_id = await get_auth_verified_user_id(authorization.credentials)
     # Check if the user already exists in the Firestore collection
     user_ref = db.collection(u'users').document(verified_user_id)
-    user = user_ref.get()
+    user = user_cache.get(db, verified_user_id)
 
-    if not user.exists:
+    if user is None:
         return "User does not exist", 400
     else:
         # Update only the config
-        user_ref.update({"config": payload.user_config})
+        user_ref.update(user_write_fields({"config": payload.user_config}))
+        user_cache.invalidate(verified_user_id)
         return {"message": "User information stored successfully", "user_id": verified_user_id}, 201
 
 @app.post("/user/subscription")
 async def update_user_subscription(payload: UserSubscriptionObject, authorization=Depends(security)):
-    verified_user_id = get_auth_verified_user_id(authorization.credentials)
+    verified_user_id = await get_auth_verified_user_id(authorization.credentials)
     # Check if the user already exists in the Firestore collection
     user_ref = db.collection(u'users').document(verified_user_id)
-    user = user_ref.get()
+    user = user_cache.get(db, verified_user_id)
 
-    if not user.exists:
+    if user is None:
         return "User does not exist", 400
     else:
         # Update only the subscription
-        user_ref.update({"subscription": payload})
+        user_ref.update(user_write_fields({"subscription": payload}))
+        user_cache.invalidate(verified_user_id)
         return {"message": "User information stored successfully", "user_id": verified_user_id}, 201
 
 @app.get("/user/")
 async def get_user(authorization=Depends(security)):
-    verified_user_id = get_auth_verified_user_id(authorization.credentials)
+    verified_user_id = await get_auth_verified_user_id(authorization.credentials)
     # Check if the user already exists in the Firestore collection
-    user_ref = db.collection(u'users').document(verified_user_id)
-    user = user_ref.get()
+    user = user_cache.get(db, verified_user_id)
 
-    if not user.exists:
+    if user is None:
         # If the user does not exist, store the information in the Firestore collection
         raise HTTPException(
             status_code=401, detail="User does not exist")
     else:
-        return user.to_dict()
+        return user
 
 
 @app.post("/read-story/")
 async def update_story_as_read(payload: ReadStoryPayload, authorization=Depends(security)):
-    verified_user_id = get_auth_verified_user_id(authorization.credentials)
+    verified_user_id = await get_auth_verified_user_id(authorization.credentials)
     # Check if user exists
-    user_ref = db.collection(u'users').document(verified_user_id)
-    user = user_ref.get().to_dict()
+    user = user_cache.get(db, verified_user_id)
     if user is None:
         raise HTTPException(status_code=400, detail="User not found")
 
     # Check if story exists
-    stories = user.get("stories")
-    if stories:
-        for index, story in enumerate(stories):
-            if story["story_id"] == payload.story_id:
-                stories[index]["read_status"] = "read"
-                user_ref.update({
-                    "stories": stories
-                })
-                return {"message": "Story updated successfully", "story_id": payload.story_id}
-    return {"message": "Story not found", "story_id": payload.story_id}
+    story = get_story(db, verified_user_id, payload.story_id)
+    if story is None:
+        return {"message": "Story not found", "story_id": payload.story_id}
+    mark_story_read(db, verified_user_id, payload.story_id,
+                    add_read_hour(user.get("read_hours"), datetime.datetime.utcnow().timestamp()))
+    user_cache.invalidate(verified_user_id)
+    # Reading the latest finished story makes the user due for the next one
+    if story["story_id"] == user.get("story_count", 0) - 1 and story["status"] == StoryStatus.StoryReady:
+        enqueue_story(db, verified_user_id, story["story_id"], STORY_REQUEST_QUEUE,
+                      user.get("last_story_generated_timestamp", 0) + STORY_REQUEST_DELAY)
+    return {"message": "Story updated successfully", "story_id": payload.story_id}
+
+
+@app.get("/story/status/")
+async def get_story_status(request: Request, authorization=Depends(security)):
+    verified_user_id = await get_auth_verified_user_id(authorization.credentials)
+    # Only the version fields of the user document are used, no story data
+    user = user_cache.get(db, verified_user_id)
+    if user is None:
+        raise HTTPException(status_code=400, detail="User not found")
+    now = datetime.datetime.utcnow().timestamp()
+    etag = story_etag(user.get("story_version", 0), user.get("latest_story_available_timestamp", 0) <= now)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    story_id, status = visible_latest_story(user, now)
+    return ORJSONResponse({
+        "story_id": story_id,
+        "status": status,
+        "version": user.get("story_version", 0)
+    }, headers={"ETag": etag})
+
+
+@app.get("/story/events/")
+async def stream_story_events(authorization=Depends(security)):
+    verified_user_id = await get_auth_verified_user_id(authorization.credentials)
+    user = user_cache.get(db, verified_user_id)
+    if user is None:
+        raise HTTPException(status_code=400, detail="User not found")
+    # Start with the current state so nothing that happened before connecting is missed
+    story_id, status = visible_latest_story(user, datetime.datetime.utcnow().timestamp())
+    initial_event = None
+    if story_id is not None:
+        initial_event = {"story_id": story_id, "status": status}
+    return StreamingResponse(story_event_stream(verified_user_id, initial_event),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.get("/story/")
-async def get_latest_story(authorization=Depends(security)):
-    verified_user_id = get_auth_verified_user_id(authorization.credentials)
+async def get_latest_story(request: Request, authorization=Depends(security)):
+    verified_user_id = await get_auth_verified_user_id(authorization.credentials)
     # Check if user exists
-    user_ref = db.collection(u'users').document(verified_user_id)
-    user = user_ref.get().to_dict()
+    user = user_cache.get(db, verified_user_id)
     if user is None:
         raise HTTPException(status_code=400, detail="User not found")
-    # Get latest story
-    stories = user.get("stories")
-    latest_story = None
-    if stories:
-        for index, story in enumerate(stories):
-            if story["status"] == StoryStatus.StoryReady:
-                latest_story = story
-    return latest_story, 200
+    # Nothing changed since the client's copy, skip the story query
+    now = datetime.datetime.utcnow().timestamp()
+    etag = story_etag(user.get("story_version", 0), user.get("latest_story_available_timestamp", 0) <= now)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    # Get latest story with a single indexed query, shared by every poll until the ETag changes
+    latest_story = user_cache.get_projection(
+        db, verified_user_id, ("latest_ready_story", etag),
+        lambda: find_latest_story(db, verified_user_id, StoryStatus.StoryReady, available_at=now))
+    return ORJSONResponse((latest_story, 200), headers={"ETag": etag})
+
+
+@app.get("/story/{story_id}/stream/")
+async def stream_story_text(story_id: int, authorization=Depends(security)):
+    verified_user_id = await get_auth_verified_user_id(authorization.credentials)
+    story = get_story(db, verified_user_id, story_id)
+    if story is None or not is_available(story, datetime.datetime.utcnow().timestamp()):
+        raise HTTPException(status_code=400, detail="Story not found")
+    # Text already generated, send it in one go
+    if story["status"] != StoryStatus.PendingTextGeneration:
+        return StreamingResponse(iter([story["generated_story"]]), media_type="text/plain; charset=utf-8")
+    # Otherwise generate it now and relay the text as it comes in, it is saved to the story once complete
+    text_stream = start_story_generation(db, verified_user_id, story_id)
+    # Headers wait for the first text, a generation that fails before any gets an error instead of an empty story
+    await text_stream.wait_started()
+    if not text_stream.chunks and text_stream.error is not None:
+        if isinstance(text_stream.error, BudgetExceeded):
+            raise HTTPException(status_code=429, detail="Story generation is paused, try again later",
+                                headers={"Retry-After": str(BUDGET_RETRY_DELAY)})
+        raise HTTPException(status_code=503, detail="Story generation failed, try again later")
+    return StreamingResponse(text_stream.iterate(), media_type="text/plain; charset=utf-8",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.get("/stories/")
-async def get_stories(authorization=Depends(security)):
-    verified_user_id = get_auth_verified_user_id(authorization.credentials)
+async def get_stories(limit: int = Query(STORY_PAGE_SIZE, ge=1, le=100), cursor: int = None,
+                      authorization=Depends(security)):
+    verified_user_id = await get_auth_verified_user_id(authorization.credentials)
     # Check if user exists
-    user_ref = db.collection(u'users').document(verified_user_id)
-    user = user_ref.get().to_dict()
-    if user is None:
+    if user_cache.get(db, verified_user_id) is None:
         raise HTTPException(status_code=400, detail="User not found")
-    stories = user.get("stories")
-    return stories, 200
+    stories, next_cursor = list_stories(db, verified_user_id, limit, cursor,
+                                        available_at=datetime.datetime.utcnow().timestamp())
+    return {"stories": stories, "next_cursor": next_cursor}, 200
+
+
+@app.get("/images/{digest}")
+async def get_image(digest: str, request: Request, variant: str = "original"):
+    # Content addressed so the bytes behind a URL never change, clients and CDNs can keep them for good
+    if not is_valid_digest(digest) or variant not in IMAGE_VARIANTS:
+        raise HTTPException(status_code=404, detail="Image not found")
+    path = image_path(digest, variant)
+    if not os.path.exists(path) and not (await fetch_missing_image(db, digest) and os.path.exists(path)):
+        raise HTTPException(status_code=404, detail="Image not found")
+    headers = {"ETag": f'"{digest}-{variant}"', "Cache-Control": IMAGE_CACHE_CONTROL, "Accept-Ranges": "bytes"}
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    content_type = media_type(path, variant)
+    size = os.path.getsize(path)
+    byte_range = parse_range(request.headers.get("range"), size)
+    if byte_range is not None:
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(read_file_range(path, start, end), status_code=206, media_type=content_type,
+                                 headers=headers)
+    if request.headers.get("range"):
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    # Sent from disk in chunks, never read into memory whole
+    return FileResponse(path, media_type=content_type, headers=headers)
+
+
+@app.post("/webhooks/stable-diffusion/")
+async def stable_diffusion_webhook(request: Request, token: str = ""):
+    # Called by Stable Diffusion when an image job finishes, authenticated by the token signed into the URL.
+    # Doesn't exist unless PUBLIC_BASE_URL and a webhook secret of our own are set.
+    if not webhook_enabled():
+        raise HTTPException(status_code=404, detail="Not Found")
+    payload = await request.json()
+    track_id = payload.get("track_id")
+    if not track_id or not is_valid_webhook_token(track_id, token):
+        raise HTTPException(status_code=401, detail="Invalid webhook token")
+    user_id, story_id = parse_track_id(track_id)
+    if payload.get("status") != "success" or not payload.get("output"):
+        # Still processing or failed, polling picks the story up
+        return {"message": "Ignored", "status": payload.get("status")}
+    # The callback can beat the response to the generate call, so the story may still be pending generation.
+    # Duplicate or late callbacks find the story ready already and change nothing.
+    with span("stable_diffusion.webhook", user_id, story_id):
+        story = await asyncio.to_thread(mark_image_ready, db, user_id, story_id,
+                                        (StoryStatus.PendingImageFetch, StoryStatus.PendingImageGeneration),
+                                        payload["output"][0])
+    if story is None:
+        return {"message": "Already handled", "story_id": story_id}
+    await generation_cache.store("image", image_cache_key(story.get("prompt")), payload["output"][0])
+    return {"message": "Story updated successfully", "story_id": story_id}
 
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=HTTP_PORT, reload=True)
+    # API and workers in one process as set by RUN_WORKERS, python -m src.api and python -m src.worker split them
+    import uvicorn
+
+    uvicorn.run(app, host="0.0.0.0", port=8000)
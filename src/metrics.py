@@ -0,0 +1,190 @@
+import asyncio
+import bisect
+import threading
+import time
+
+import orjson
+
+from src.health import health, readiness
+
+DEFAULT_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+class Histogram:
+    # Cumulative bucket counts in the Prometheus style, `buckets` are upper bounds
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            cumulative = []
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+                total += count
+                cumulative.append((bound, total))
+            return {"buckets": cumulative, "count": self.count, "sum": self.sum}
+
+
+# Request and round-trip latencies, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def escape_label(value):
+    # Enum members are labelled by their value
+    return str(getattr(value, "value", value)).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{escape_label(value)}"' for name, value in labels)
+    return "{" + pairs + "}"
+
+
+def format_bound(bound):
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+class HistogramFamily:
+    # Histograms of one metric told apart by labels, e.g. request latency per route
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, **labels):
+        key = tuple(sorted(labels.items()))
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, Histogram(self.buckets))
+        return child
+
+    def attach(self, histogram, **labels):
+        # Export a histogram a component already keeps, e.g. a scheduler's pickup delay
+        self._children[tuple(sorted(labels.items()))] = histogram
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, histogram in list(self._children.items()):
+            snapshot = histogram.snapshot()
+            for bound, count in snapshot["buckets"]:
+                lines.append(f"{self.name}_bucket{format_labels(labels + (('le', format_bound(bound)),))} {count}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {snapshot['sum']}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {snapshot['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self, prefix="goodnight"):
+        self.prefix = prefix
+        self._histograms = []
+        self._gauges = []
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        family = HistogramFamily(f"{self.prefix}_{name}", help, buckets)
+        self._histograms.append(family)
+        return family
+
+    def gauge(self, name, help, collect):
+        # `collect` returns a number, or a dict of label tuples to numbers, read at scrape time
+        self._gauges.append((f"{self.prefix}_{name}", help, collect))
+
+    def stats(self, name, collect):
+        # One gauge per numeric field of a component's stats() dict
+        def collect_field(field):
+            return lambda: collect().get(field)
+
+        for field, value in collect().items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.gauge(f"{name}_{field}", f"{name} stats() field {field}", collect_field(field))
+
+    def render(self):
+        lines = []
+        for family in self._histograms:
+            lines.extend(family.render())
+        for name, help, collect in self._gauges:
+            try:
+                values = collect()
+            except Exception:
+                continue
+            if values is None:
+                continue
+            lines.extend([f"# HELP {name} {help}", f"# TYPE {name} gauge"])
+            if not isinstance(values, dict):
+                values = {(): values}
+            for labels, value in values.items():
+                if value is not None:
+                    lines.append(f"{name}{format_labels(labels)} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class timed:
+    # Observes how long the block took, with or without an exception
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+        return False
+
+
+registry = MetricsRegistry()
+request_latency = registry.histogram("http_request_duration_seconds", "API request latency per route",
+                                     LATENCY_BUCKETS)
+provider_latency = registry.histogram("provider_call_duration_seconds",
+                                      "OpenAI and Stable Diffusion call latency, including rate limit waits",
+                                      LATENCY_BUCKETS)
+firestore_latency = registry.histogram("firestore_round_trip_seconds", "Firestore round-trips per operation",
+                                       LATENCY_BUCKETS)
+status_duration = registry.histogram("story_status_duration_seconds",
+                                     "Time a story spent in a status before its stage finished it")
+stage_item_duration = registry.histogram("stage_item_duration_seconds", "Time a stage spent on one story",
+                                         LATENCY_BUCKETS)
+stage_scan_duration = registry.histogram("stage_scan_duration_seconds", "Duration of a stage's recovery scan",
+                                         LATENCY_BUCKETS)
+
+
+async def serve_metrics(port):
+    # Bare HTTP endpoint for processes without the API, e.g. python -m src.worker. /healthz and /readyz answer
+    # like the API's, every other path gets the metrics.
+    async def respond(reader, writer):
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            path = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b"/"
+            status, content_type = b"200 OK", b"text/plain; version=0.0.4"
+            if path == b"/healthz":
+                body, content_type = orjson.dumps(health()), b"application/json"
+            elif path == b"/readyz":
+                result = readiness()
+                body, content_type = orjson.dumps(result), b"application/json"
+                status = b"200 OK" if result["ready"] else b"503 Service Unavailable"
+            else:
+                body = registry.render().encode()
+            writer.write(b"HTTP/1.1 " + status + b"\r\nContent-Type: " + content_type + b"\r\nContent-Length: " +
+                         str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(respond, port=port)
@@ -0,0 +1,71 @@
+import firebase_admin
+from firebase_admin import credentials, firestore
+
+from src.functions.story_store import stories_collection, user_story_fields
+from src.functions.work_queue import rebuild_work_queue
+
+# Firestore allows at most 500 writes per batch
+BATCH_LIMIT = 500
+
+
+def latest_story_fields(latest):
+    # The user fields /story/status/ and the ETags are built on, as the workers would have left them. A user
+    # without stories gets latest_story_id None so the backfill knows it is done.
+    fields = user_story_fields(latest)
+    fields.setdefault("latest_story_id", None)
+    return fields
+
+
+def migrate_user(firestore_db, user):
+    # Copy users/{id}.stories into users/{id}/stories/{story_id} and drop the array, safe to run twice
+    stories = user.to_dict().get("stories")
+    if stories is None:
+        return 0
+    user_ref = firestore_db.collection("users").document(user.id)
+    batch = firestore_db.batch()
+    writes = 0
+    for story in stories:
+        batch.set(user_ref.collection("stories").document(str(story["story_id"])), story)
+        writes += 1
+        if writes % (BATCH_LIMIT - 1) == 0:
+            batch.commit()
+            batch = firestore_db.batch()
+    latest = max(stories, key=lambda story: story["story_id"], default=None)
+    story_count = latest["story_id"] + 1 if latest is not None else 0
+    batch.update(user_ref, dict(latest_story_fields(latest), stories=firestore.DELETE_FIELD, story_count=story_count))
+    batch.commit()
+    return len(stories)
+
+
+def backfill_latest_story(firestore_db, user):
+    # For users moved by an earlier run of this migration, which left out latest_story_id, latest_story_status
+    # and story_version. Returns whether the user needed it.
+    data = user.to_dict()
+    if "stories" in data or "latest_story_id" in data:
+        return False
+    newest = list(stories_collection(firestore_db, user.id)
+                  .order_by("story_id", direction=firestore.Query.DESCENDING).limit(1).stream())
+    latest = newest[0].to_dict() if newest else None
+    firestore_db.collection("users").document(user.id).update(latest_story_fields(latest))
+    return True
+
+
+def migrate_all(firestore_db):
+    users = 0
+    stories = 0
+    backfilled = 0
+    for user in firestore_db.collection("users").stream():
+        backfilled += backfill_latest_story(firestore_db, user)
+        stories += migrate_user(firestore_db, user)
+        users += 1
+    return users, stories, backfilled
+
+
+if __name__ == "__main__":
+    cred = credentials.Certificate("goodnight-ai-firebase-service-account-key.json")
+    firebase_admin.initialize_app(cred)
+    db = firestore.client()
+    migrated_users, migrated_stories, backfilled_users = migrate_all(db)
+    print(f"Moved {migrated_stories} stories for {migrated_users} users")
+    print(f"Backfilled the latest story of {backfilled_users} users migrated before")
+    print(f"Queued {rebuild_work_queue(db)} stories")
@@ -41,6 +41,8 @@ class StoryStatus(str, Enum):
     PendingImageGeneration = 'PendingImageGeneration'
     PendingImageFetch = 'PendingImageFetch'
     StoryReady = 'StoryReady'
+    # Failed too many times, left for someone to look at, see functions/dead_letter.py
+    DeadLetter = 'DeadLetter'
 
 
 class Story(BaseModel):
@@ -48,12 +50,19 @@ class Story(BaseModel):
     generated_story: str = ''
     generated_summary: str = ''
     image_url: str = ''
+    # sha256 of the stored copy, served from /images/{image_hash}
+    image_hash: str = ''
     timestamp: int = 0
     fetch_image_timestamp: int = 0
     fetch_image_id: str = ''
     status: StoryStatus
     read_status: str = 'unread'
     story_id: int = 0
+    # Pre-generated stories are hidden from the reader until this time
+    available_timestamp: float = 0
+    # Set on dead-lettered stories, the last error and the status the story failed in
+    error: str = ''
+    failed_status: str = ''
 
 
 class NewStoryPayload(BaseModel):
@@ -71,5 +80,14 @@ class UserDbObject(BaseModel):
     user_id: str
     last_story_generated_timestamp: float
     subscription: UserSubscriptionObject
-    stories: List[Story]
+    # Stories are stored under users/{user_id}/stories/{story_id}
+    story_count: int = 0
+    # Bumped on every story change, clients poll this through /story/status/
+    story_version: int = 0
+    latest_story_id: int = None
+    latest_story_status: StoryStatus = None
+    latest_story_available_timestamp: float = 0
+    latest_story_changed_at: float = 0
+    # UTC hours of the day the user read their last stories, most recent last
+    read_hours: List[float] = []
     config: UserConfig
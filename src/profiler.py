@@ -0,0 +1,67 @@
+import collections
+import sys
+import threading
+import time
+
+from src.config import PROFILER_INTERVAL
+
+
+def folded_stack(frame):
+    # "file:function;file:function" from the outermost frame in, the format flame graph tools read
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_filename}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    # Samples the stack of every thread from a background thread, nothing runs on the sampled threads themselves.
+    # Off until an admin starts it, and stops by itself after `max_duration`.
+    def __init__(self, interval=PROFILER_INTERVAL, max_duration=300):
+        self.interval = interval
+        self.max_duration = max_duration
+        self.samples = collections.Counter()
+        self.sample_count = 0
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        with self._lock:
+            if self.running:
+                return False
+            self.samples = collections.Counter()
+            self.sample_count = 0
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        with self._lock:
+            self._stop.set()
+            if self._thread is not None:
+                self._thread.join()
+                self._thread = None
+        return self.report()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + self.max_duration
+        while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    self.samples[folded_stack(frame)] += 1
+            self.sample_count += 1
+
+    def report(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,113 @@
+import asyncio
+import base64
+import json
+import logging
+import os
+import time
+
+from cachetools import TLRUCache
+
+from src.config import SIGNING_CERT_REFRESH_INTERVAL, TOKEN_CACHE_MAX_TTL, TOKEN_CACHE_SIZE
+from src.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+
+# firebase_admin is only loaded once a token needs verifying or the certs are pre-warmed, not at import
+def verify_id_token(token):
+    from firebase_admin import auth
+
+    return auth.verify_id_token(token)
+
+
+def _unverified_token(header, payload):
+    def encode(part):
+        return base64.urlsafe_b64encode(json.dumps(part).encode()).rstrip(b"=").decode()
+
+    return f"{encode(header)}.{encode(payload)}.{encode('unsigned')}"
+
+
+def fetch_signing_certs():
+    # Verifies a token no key signed: firebase_admin downloads the signing certs through its own caching session to
+    # check it, so the next real token finds them warm. Returns False when there is nothing to warm.
+    import firebase_admin
+    from firebase_admin import auth
+
+    if os.getenv("FIREBASE_AUTH_EMULATOR_HOST"):
+        # Emulated tokens are not signed
+        return False
+    try:
+        app = firebase_admin.get_app()
+    except ValueError:
+        # No Firebase app in this process, e.g. against the Firestore emulator
+        return False
+    now = int(time.time())
+    token = _unverified_token({"alg": "RS256", "kid": "prewarm", "typ": "JWT"}, {
+        "aud": app.project_id, "iss": f"https://securetoken.google.com/{app.project_id}", "sub": "prewarm",
+        "iat": now, "exp": now + 60})
+    try:
+        auth.verify_id_token(token, app=app)
+    except auth.InvalidIdTokenError:
+        # Rejected once the certs were fetched, as it should be. A failed download raises CertificateFetchError.
+        pass
+    return True
+
+
+class VerifiedTokenCache:
+    def __init__(self, verify=verify_id_token, maxsize=TOKEN_CACHE_SIZE, max_ttl=TOKEN_CACHE_MAX_TTL,
+                 timer=time.time):
+        self._verify = verify
+        self._max_ttl = max_ttl
+        # Entries expire at the token's own exp, or max_ttl after being cached if that comes first
+        self._cache = TLRUCache(maxsize, ttu=self._expires_at, timer=timer)
+        self._in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        # Set once the first cert refresh has been tried, whether or not it worked
+        self.warm = False
+
+    def _expires_at(self, token, entry, now):
+        return min(entry["exp"], now + self._max_ttl)
+
+    async def get_user_id(self, token):
+        entry = self._cache.get(token)
+        if entry is not None:
+            self.hits += 1
+            return entry["uid"]
+        self.misses += 1
+        # Concurrent requests with the same new token share one verification
+        pending = self._in_flight.get(token)
+        if pending is None:
+            pending = asyncio.ensure_future(asyncio.to_thread(self._verify, token))
+            self._in_flight[token] = pending
+            pending.add_done_callback(lambda _: self._in_flight.pop(token, None))
+        decoded_token = await asyncio.shield(pending)
+        self._cache[token] = {"uid": decoded_token["uid"], "exp": decoded_token["exp"]}
+        return decoded_token["uid"]
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0,
+            "size": len(self._cache)
+        }
+
+    async def run_cert_refresh(self, interval=SIGNING_CERT_REFRESH_INTERVAL):
+        # Pre-warm on startup and keep refreshing so no request pays for the cert download
+        while True:
+            try:
+                if not await asyncio.to_thread(fetch_signing_certs):
+                    logger.debug("No Firebase signing certs to pre-warm in this process")
+            except Exception:
+                logger.exception("Could not refresh Firebase signing certs")
+            self.warm = True
+            await asyncio.sleep(interval)
+
+
+token_cache = VerifiedTokenCache()
+registry.stats("token_cache", token_cache.stats)
@@ -0,0 +1,86 @@
+import contextvars
+import hashlib
+import logging
+import time
+import uuid
+
+import orjson
+
+from src.config import TRACING_ENABLED
+
+logger = logging.getLogger(__name__)
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def story_trace_id(user_id, story_id):
+    # Every span of a story shares one trace, from the request through to StoryReady, whichever process runs it
+    return hashlib.sha256(f"{user_id}:{story_id}".encode()).hexdigest()[:32]
+
+
+class Span:
+    # Shaped after an OpenTelemetry span, finished spans are written to the log as one JSON line each
+    def __init__(self, name, trace_id, parent_id, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.status = "OK"
+        self._token = None
+        self._started = None
+
+    def set_attribute(self, name, value):
+        self.attributes[name] = value
+
+    def __enter__(self):
+        self._started = time.time_ns()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        _current_span.reset(self._token)
+        if exc is not None:
+            self.status = "ERROR"
+            self.attributes["exception.type"] = exc_type.__name__
+        logger.info(orjson.dumps({
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "name": self.name,
+            "startTimeUnixNano": self._started,
+            "endTimeUnixNano": time.time_ns(),
+            "attributes": self.attributes,
+            "status": self.status
+        }, default=str).decode())
+        return False
+
+
+class _NoopSpan:
+    def set_attribute(self, name, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def span(name, user_id=None, story_id=None, **attributes):
+    # Costs one flag check while tracing is off
+    if not TRACING_ENABLED:
+        return NOOP_SPAN
+    parent = _current_span.get()
+    if user_id is not None and story_id is not None:
+        trace_id = story_trace_id(user_id, story_id)
+        attributes.update({"user_id": user_id, "story_id": story_id})
+    elif parent is not None:
+        trace_id = parent.trace_id
+    else:
+        trace_id = uuid.uuid4().hex
+    parent_id = parent.span_id if parent is not None and parent.trace_id == trace_id else None
+    return Span(name, trace_id, parent_id, attributes)
@@ -0,0 +1,181 @@
+import logging
+import threading
+import time
+
+import orjson
+from cachetools import LRUCache
+from google.cloud import firestore
+
+from src.config import USER_CACHE_BYTES, USER_CACHE_TTL
+from src.events import RELAY_CLOCK_SKEW, story_events
+from src.metrics import firestore_latency, registry, timed
+
+logger = logging.getLogger(__name__)
+
+# Dict and bookkeeping per cached user, on top of the serialized document
+ENTRY_OVERHEAD = 256
+
+
+def user_write_fields(fields):
+    # Every change the API makes to a user document bumps its version, which watch_user_changes listens for
+    return dict(fields, user_version=firestore.Increment(1), user_changed_at=time.time())
+
+
+def is_older(doc, than):
+    # Both versions only ever go up, a document behind on either was read before the other was written
+    return any(doc.get(version, 0) < than.get(version, 0) for version in ("story_version", "user_version"))
+
+
+def entry_size(entry):
+    values = [entry["doc"], *entry["projections"].values()]
+    return sum(len(orjson.dumps(value, default=str)) for value in values) + ENTRY_OVERHEAD
+
+
+class _EvictingLRUCache(LRUCache):
+    def __init__(self, maxsize, on_evict):
+        super().__init__(maxsize, getsizeof=entry_size)
+        self._on_evict = on_evict
+
+    def popitem(self):
+        key, entry = super().popitem()
+        self._on_evict(entry)
+        return key, entry
+
+
+class UserDocumentCache:
+    # Read-through cache of users/{user_id}, bounded in bytes and evicted least recently used first. Nothing is
+    # held open per user: writes made by this process invalidate the entry straight away, story changes and API
+    # writes made by any process replace it through the listeners of relay_story_changes and watch_user_changes,
+    # and anything else another process changes is seen once the entry is `ttl` seconds old. Another process
+    # serves the old document until its listener hears of a write, or for up to `ttl` if the listener is down.
+    def __init__(self, maxsize=USER_CACHE_BYTES, ttl=USER_CACHE_TTL, clock=time.monotonic):
+        self._cache = _EvictingLRUCache(maxsize, self._evicted)
+        self._ttl = ttl
+        self._clock = clock
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.relay_updates = 0
+        story_events.add_listener(lambda user_id, story: self.invalidate(user_id))
+        story_events.add_relay_listener(self.refresh)
+
+    def _evicted(self, entry):
+        self.evictions += 1
+        entry["current"] = False
+
+    def _current(self, user_id):
+        # Called with the lock held, the entry unless it is older than the TTL
+        entry = self._cache.get(user_id)
+        if entry is not None and self._clock() - entry["loaded_at"] >= self._ttl:
+            self._cache.pop(user_id)
+            entry["current"] = False
+            self.expirations += 1
+            return None
+        return entry
+
+    def _store(self, user_id, entry):
+        try:
+            self._cache[user_id] = entry
+        except ValueError:
+            # Bigger than the whole cache, serve it uncached
+            self._cache.pop(user_id, None)
+            entry["current"] = False
+        if not entry["current"]:
+            # Growing an entry can evict the entry itself
+            self._cache.pop(user_id, None)
+
+    def get(self, firestore_db, user_id):
+        # The user document as a dict, None when the user does not exist
+        with self._lock:
+            entry = self._current(user_id)
+            if entry is not None:
+                self.hits += 1
+                return entry["doc"]
+            self.misses += 1
+        with timed(firestore_latency.labels(operation="get_user")):
+            doc = firestore_db.collection("users").document(user_id).get().to_dict()
+        if doc is None:
+            return None
+        with self._lock:
+            if self._current(user_id) is None:
+                self._store(user_id, {"doc": doc, "projections": {}, "current": True, "loaded_at": self._clock()})
+        return doc
+
+    def refresh(self, user_id, doc):
+        # A user document as a listener delivered it, only users already cached are replaced
+        with self._lock:
+            entry = self._cache.get(user_id)
+            if entry is None or is_older(doc, entry["doc"]):
+                return
+            self.relay_updates += 1
+            entry["doc"] = doc
+            entry["projections"] = {}
+            entry["loaded_at"] = self._clock()
+            self._store(user_id, entry)
+
+    def get_projection(self, firestore_db, user_id, key, load):
+        # Something derived from the user's stories, e.g. the latest ready story, cached along with the user and
+        # dropped whenever the user document changes. `key` should include the story version it was built from.
+        with self._lock:
+            entry = self._current(user_id)
+            if entry is not None and key in entry["projections"]:
+                self.hits += 1
+                return entry["projections"][key]
+            self.misses += 1
+        value = load()
+        with self._lock:
+            if entry is not None and entry["current"] and self._cache.get(user_id) is entry:
+                entry["projections"][key] = value
+                self._store(user_id, entry)
+        return value
+
+    def invalidate(self, user_id):
+        with self._lock:
+            entry = self._cache.pop(user_id, None)
+            if entry is not None:
+                entry["current"] = False
+
+    def clear(self):
+        with self._lock:
+            for entry in self._cache.values():
+                entry["current"] = False
+            self._cache.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0,
+                "users": len(self._cache),
+                "bytes": self._cache.currsize,
+                "max_bytes": self._cache.maxsize,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "relay_updates": self.relay_updates
+            }
+
+
+def watch_user_changes(firestore_db, cache=None):
+    # One listener per process on the users the API changed since it started, the writes of user_write_fields.
+    # Returns the watch to unsubscribe.
+    cache = cache or user_cache
+    started = {"initial": True}
+
+    def on_snapshot(snapshots, changes, read_time):
+        # Whatever was written before is read from Firestore on the first get
+        if started.pop("initial", False):
+            return
+        for change in changes:
+            if change.type.name != "REMOVED":
+                cache.refresh(change.document.id, change.document.to_dict())
+
+    query = firestore_db.collection("users").where("user_changed_at", ">", time.time() - RELAY_CLOCK_SKEW)
+    return query.on_snapshot(on_snapshot)
+
+
+user_cache = UserDocumentCache()
+registry.stats("user_cache", user_cache.stats)
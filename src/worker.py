@@ -0,0 +1,99 @@
+import asyncio
+import signal
+
+from src.config import (FIREBASE_CREDENTIALS, FIREBASE_PROJECT_ID, FIRESTORE_EMULATOR_HOST, PREGENERATION_ENABLED,
+                        WORKER_METRICS_PORT)
+from src.events import story_events
+from src.external_libs.http_client import close_http_session
+from src.external_libs.text_completion import load_openai
+from src.health import add_check
+from src.functions.image_generation import run_image_generation_service
+from src.functions.image_queue_process import run_image_queue_process_service
+from src.functions.image_store import watch_ready_stories
+from src.functions.leases import run_lease_heartbeat
+from src.functions.new_story_queue_process import run_story_request_service
+from src.functions.pipeline import PIPELINE_STAGES, running_stages
+from src.functions.pregeneration import PregenerationScheduler
+from src.functions.provider_spend import run_provider_spend_sync
+from src.functions.story_generation import run_story_generation_service
+from src.functions.supervisor import supervise
+from src.metrics import registry, serve_metrics
+
+
+def initialize_firestore():
+    if FIRESTORE_EMULATOR_HOST:
+        from google.cloud import firestore as google_firestore
+
+        # The client finds the emulator through the environment and needs no credentials for it
+        return google_firestore.Client(project=FIREBASE_PROJECT_ID)
+    # firebase_admin is only needed here and for verifying tokens, neither happens at import
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    # Initialize Firebase App
+    cred = credentials.Certificate(FIREBASE_CREDENTIALS)
+    firebase_admin.initialize_app(cred)
+    # Get a reference to the Firestore database
+    return firestore.client()
+
+
+def start_workers(db):
+    # Safe to run in any number of processes, stories are claimed with a lease before any work is done.
+    # Each loop is restarted if it crashes, a failing story is handled inside its loop and never gets this far.
+    tasks = [
+        asyncio.create_task(supervise("story_request", lambda: run_story_request_service(db))),
+        asyncio.create_task(supervise("story_generation", lambda: run_story_generation_service(db))),
+        asyncio.create_task(supervise("image_generation", lambda: run_image_generation_service(db))),
+        asyncio.create_task(supervise("image_queue", lambda: run_image_queue_process_service(db)))
+    ]
+    if PREGENERATION_ENABLED:
+        scheduler = PregenerationScheduler(db)
+        registry.stats("pregeneration", scheduler.stats)
+        pregeneration_lead_time = registry.histogram("pregeneration_lead_time_seconds",
+                                                     "How long before its reader a pre-generated story was ready")
+        pregeneration_lead_time.attach(scheduler.lead_time)
+        tasks.append(asyncio.create_task(supervise("pregeneration", scheduler.run)))
+    # The provider SDK loads lazily, load it now off the event loop so the first story doesn't wait on imports
+    warm_up = asyncio.ensure_future(asyncio.to_thread(load_openai))
+    tasks.append(warm_up)
+    add_check("workers", lambda: running_stages() == set(PIPELINE_STAGES) and not any(
+        task.done() for task in tasks if task is not warm_up))
+    add_check("provider_sdk", lambda: warm_up.done() and not warm_up.cancelled() and warm_up.exception() is None)
+    return tasks
+
+
+async def stop_tasks(tasks):
+    # Stories being worked on release their leases as they are cancelled, so another worker takes them at once
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def run_workers():
+    # Up first, so /healthz answers and /readyz reports progress while the rest starts
+    metrics_server = await serve_metrics(WORKER_METRICS_PORT) if WORKER_METRICS_PORT else None
+    story_events.bind(asyncio.get_running_loop())
+    db = await asyncio.to_thread(initialize_firestore)
+    add_check("firestore", lambda: db is not None)
+    watch_ready_stories(db)
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signal_number, stopping.set)
+    tasks = start_workers(db)
+    # The heartbeat stops last, leases are held until the stories using them are released
+    heartbeat = asyncio.create_task(supervise("lease_heartbeat", lambda: run_lease_heartbeat(db)))
+    spend_sync = asyncio.create_task(supervise("provider_spend", lambda: run_provider_spend_sync(db)))
+    try:
+        await stopping.wait()
+    finally:
+        await stop_tasks(tasks)
+        await stop_tasks([heartbeat, spend_sync])
+        if metrics_server is not None:
+            metrics_server.close()
+        await close_http_session()
+
+
+if __name__ == "__main__":
+    # Workers without the HTTP server: python -m src.worker
+    asyncio.run(run_workers())
@@ -0,0 +1,92 @@
+# Tests run from the repository root with python -m pytest. src.config is read once, on first import, so the
+# settings in-process tests rely on are set here before anything from src is imported.
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import httpx
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.update({
+    "RUN_WORKERS": "False",
+    "PREGENERATION_ENABLED": "False",
+    "GENERATION_CACHE_ENABLED": "False",
+    "PUBLIC_BASE_URL": "http://testserver",
+    "STABLE_DIFFUSION_WEBHOOK_SECRET": "test-webhook-secret",
+    "IMAGE_STORE_PATH": tempfile.mkdtemp(prefix="goodnight-test-images-")
+})
+
+ISOLATED_RUNNER = """
+import asyncio, json, runpy, sys
+namespace = runpy.run_path(sys.argv[1])
+result = asyncio.run(namespace[sys.argv[2]](**json.loads(sys.argv[3])))
+print(json.dumps(result, default=str))
+"""
+
+
+def run_isolated(path, function, timeout=300, **arguments):
+    # Runs `function` from the test file in a fresh interpreter and returns what it returned. For tests that boot
+    # the app: it keeps module level state and reads its configuration once, like python -m bench all does.
+    completed = subprocess.run([sys.executable, "-c", ISOLATED_RUNNER, path, function, json.dumps(arguments)],
+                               cwd=ROOT, capture_output=True, text=True, timeout=timeout)
+    assert completed.returncode == 0, completed.stderr[-5000:]
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+@pytest.fixture
+def isolated(request):
+    return lambda function, **arguments: run_isolated(str(request.path), function, **arguments)
+
+
+class AppClient:
+    # Calls the app in this process without running its lifespan, against whatever main.db is
+    def request(self, method, path, **kwargs):
+        from src import main
+
+        async def request():
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app),
+                                         base_url="http://testserver") as client:
+                return await client.request(method, path, **kwargs)
+
+        return asyncio.run(request())
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+
+@pytest.fixture
+def client(db, monkeypatch):
+    from src import main
+
+    monkeypatch.setattr(main, "db", db)
+    return AppClient()
+
+
+@pytest.fixture
+def db():
+    from bench.fake_firestore import FakeFirestore
+
+    return FakeFirestore()
+
+
+@pytest.fixture(params=["fake", "emulator"])
+def firestore_db(request):
+    # The in-memory fake, and the Firestore emulator too when FIRESTORE_EMULATOR_HOST points at one. Tests using
+    # it pick unique document ids, the emulator is not cleared between them.
+    if request.param == "fake":
+        from bench.fake_firestore import FakeFirestore
+
+        return FakeFirestore(latency=0.002)
+    if not os.getenv("FIRESTORE_EMULATOR_HOST"):
+        pytest.skip("FIRESTORE_EMULATOR_HOST is not set")
+    from src.worker import initialize_firestore
+
+    return initialize_firestore()
@@ -0,0 +1,35 @@
+# A benchmark run stops at the first 5xx instead of reporting numbers for a broken build
+import time
+
+
+async def polling_storm_against_a_broken_route(duration):
+    from bench.fake_providers import FakeOpenAI, FakeStableDiffusion
+    from bench.harness import Harness, ServerError
+    from bench.scenarios import polling_storm
+
+    class BrokenStoryHarness(Harness):
+        async def start(self, seed=None):
+            await super().start(seed)
+            from src import main
+
+            def find_latest_story(*args, **kwargs):
+                raise RuntimeError("Broken build")
+
+            main.find_latest_story = find_latest_story
+            return self
+
+    def harness_factory():
+        return BrokenStoryHarness(openai=FakeOpenAI(latency=0.01), stable_diffusion=FakeStableDiffusion(latency=0.01))
+
+    started = time.monotonic()
+    try:
+        await polling_storm(harness_factory, users=5, clients=2, duration=duration)
+    except ServerError as error:
+        return {"error": str(error), "elapsed": time.monotonic() - started}
+    return {"error": None, "elapsed": time.monotonic() - started}
+
+
+def test_a_5xx_aborts_the_run(isolated):
+    result = isolated("polling_storm_against_a_broken_route", duration=60)
+    assert result["error"].startswith("GET /story/ answered 500")
+    assert result["elapsed"] < 30
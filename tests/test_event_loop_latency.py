@@ -0,0 +1,52 @@
+# GET / must stay fast while the workers in the same process have many stories at the providers
+import asyncio
+import time
+
+GENERATIONS = 50
+
+
+async def root_latency_with_generations_in_flight(generations, firestore_latency):
+    from bench.fake_providers import FakeOpenAI, FakeStableDiffusion
+    from bench.harness import Harness, percentiles
+    from bench.scenarios import seed
+
+    harness = Harness(firestore_latency=firestore_latency,
+                      openai=FakeOpenAI(latency=1.0, token_delay=0.002),
+                      stable_diffusion=FakeStableDiffusion(latency=0.5, processing_rate=0),
+                      env={"GENERATION_CONCURRENCY": str(generations),
+                           "HTTP_CONNECTION_LIMIT_PER_HOST": str(2 * generations)})
+    user_ids = [f"loop-{index}" for index in range(generations)]
+    await harness.start(seed(user_ids, stories=1, latest_status="PendingTextGeneration"))
+
+    expected = [(user_id, 0) for user_id in user_ids]
+
+    async def sample(until):
+        latencies = []
+        while not until():
+            started = time.perf_counter()
+            status, _, _ = await harness.request("GET", "/")
+            assert status == 200
+            latencies.append(time.perf_counter() - started)
+            await asyncio.sleep(0.005)
+        return latencies
+
+    try:
+        # Polls from the first claim until every story is ready: claims, provider calls, commits and hand-offs
+        busy = await asyncio.wait_for(sample(lambda: all(key in harness.ready_at for key in expected)), 120)
+        peak = harness.openai.requests
+        idle_until = time.monotonic() + 1.5
+        idle = await sample(lambda: time.monotonic() > idle_until)
+    finally:
+        await harness.stop()
+    return {"busy": percentiles(busy, 1000), "idle": percentiles(idle, 1000),
+            "ready": sum(1 for key in expected if key in harness.ready_at), "openai_requests": peak}
+
+
+def test_root_p99_stays_flat_with_50_generations_in_flight(isolated):
+    result = isolated("root_latency_with_generations_in_flight", generations=GENERATIONS, firestore_latency=0.005)
+    # One streamed story and one summary per story
+    assert result["openai_requests"] == 2 * GENERATIONS
+    assert result["ready"] == GENERATIONS
+    # Every worker Firestore round-trip (5ms here) happens on a thread, none of them is paid for by GET /. What is left
+    # is the streamed tokens being read on the loop, with the round-trips on the loop p99 was ~95ms here.
+    assert result["busy"]["p99"] < result["idle"]["p99"] + 40
@@ -0,0 +1,50 @@
+import asyncio
+import sqlite3
+
+from src.external_libs.generation_cache import GenerationCache
+
+
+def make_cache(tmp_path, **options):
+    return GenerationCache(path=str(tmp_path / "cache.sqlite3"), enabled=True, **options)
+
+
+def stored_variants(tmp_path, key):
+    with sqlite3.connect(str(tmp_path / "cache.sqlite3")) as connection:
+        return connection.execute("SELECT COUNT(*) FROM variants WHERE key = ?", (key,)).fetchone()[0]
+
+
+def test_concurrent_misses_never_grow_a_pool_past_its_variants(tmp_path):
+    cache = make_cache(tmp_path, variants=3)
+    key = cache.make_key("text", "Write a story")
+
+    async def miss_then_store(index):
+        # Every request missed before any result was stored, then all of them come back
+        assert await cache.lookup("text", key) is None
+        await asyncio.sleep(0.01)
+        await cache.store("text", key, f"story {index}")
+
+    async def run():
+        await asyncio.gather(*(miss_then_store(index) for index in range(20)))
+        # The image fetch and the webhook store unconditionally too
+        await cache.store("text", key, "one more")
+        return await cache.lookup("text", key)
+
+    assert asyncio.run(run()) in {f"story {index}" for index in range(20)}
+    assert stored_variants(tmp_path, key) == 3
+    assert len(cache._load(key)) == 3
+
+
+def test_memory_is_bounded_by_bytes_not_keys(tmp_path):
+    cache = make_cache(tmp_path, variants=1, max_bytes=64 * 1024)
+    story = "Once upon a time. " * 1000
+
+    async def run():
+        for index in range(40):
+            await cache.store("text", cache.make_key("text", f"prompt {index}"), story)
+
+    asyncio.run(run())
+    stats = cache.stats()
+    assert stats["bytes_in_memory"] <= 64 * 1024
+    assert 0 < stats["keys_in_memory"] < 40
+    # Evicted pools are still served from SQLite
+    assert asyncio.run(cache.lookup("text", cache.make_key("text", "prompt 0"))) == story
@@ -0,0 +1,124 @@
+# Queued images are fetched when they are due and not before, on a simulated clock against a scripted Stable
+# Diffusion fetch endpoint
+import asyncio
+import time
+
+import pytest
+
+PROCESSING = {"status": "processing", "eta": None, "output": None}
+SUCCESS = {"status": "success", "output": ["http://images.invalid/ready.png"]}
+ERROR = {"status": "error", "message": "Injected failure", "output": None}
+
+
+def processing(eta=None):
+    return dict(PROCESSING, eta=eta)
+
+
+class SimulatedClock:
+    # Sleeping moves time forward at once, so hours of ETAs and backoff run in milliseconds
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, delay):
+        self.now += max(delay, 0)
+        await asyncio.sleep(0)
+
+
+async def fetch_until_done(responses):
+    from aiohttp import web
+
+    from bench.fake_firestore import FakeFirestore
+    from bench.fake_providers import free_port
+
+    clock = SimulatedClock(time.time())
+    # Leases, retry times and queue entries all read the wall clock
+    time.time = clock
+    from bench.scenarios import seed
+    from src.external_libs.http_client import close_http_session
+    from src.functions import image_queue_process, pipeline
+    from src.functions.deadline_scheduler import DeadlineScheduler
+    from src.functions.story_store import get_story
+    from src.models import StoryStatus
+
+    started = clock()
+    fetched_at = []
+    script = list(responses)
+
+    async def fetch(request):
+        fetched_at.append(clock() - started)
+        return web.json_response(script.pop(0))
+
+    app = web.Application()
+    app.router.add_post("/v4/dreambooth/fetch/{job_id}", fetch)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    port = free_port()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    image_queue_process.STABLE_DIFFUSION_API_BASE = f"http://127.0.0.1:{port}"
+
+    queue = pipeline.stage_queues[StoryStatus.PendingImageFetch] = DeadlineScheduler(clock=clock, sleep=clock.sleep)
+    pickup_delays = []
+    observe = queue.pickup_delay.observe
+    queue.pickup_delay.observe = lambda delay: (pickup_delays.append(delay), observe(delay))
+
+    db = FakeFirestore()
+    seed(["fetch"], stories=1, latest_status="PendingImageFetch")(db)
+    db.collection("users").document("fetch").collection("stories").document("0").update(
+        {"fetch_image_id": "job-1", "fetch_image_timestamp": started})
+    stage = asyncio.create_task(image_queue_process.run_image_queue_process_service(db))
+    try:
+        deadline = time.monotonic() + 20
+        while get_story(db, "fetch", 0)["status"] == StoryStatus.PendingImageFetch and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        status = get_story(db, "fetch", 0)["status"]
+    finally:
+        stage.cancel()
+        await asyncio.gather(stage, return_exceptions=True)
+        await close_http_session()
+        await runner.cleanup()
+    return {"status": status, "fetched_at": fetched_at, "pickup_delays": pickup_delays, "unused": len(script)}
+
+
+def assert_picked_up_on_time(result):
+    # Every fetch ran when it was due, never a polling interval later
+    assert result["pickup_delays"] and max(result["pickup_delays"]) < 0.01
+    assert result["unused"] == 0
+
+
+def gaps(times):
+    return [later - earlier for earlier, later in zip(times, times[1:])]
+
+
+def test_processing_images_are_fetched_at_their_eta(isolated):
+    result = isolated("fetch_until_done", responses=[processing(eta=30), processing(eta=10), SUCCESS])
+    assert result["status"] == "StoryReady"
+    assert_picked_up_on_time(result)
+    assert gaps(result["fetched_at"]) == pytest.approx([30, 10], abs=0.05)
+
+
+def test_processing_without_eta_backs_off(isolated):
+    result = isolated("fetch_until_done", responses=[processing(), processing(), processing(), SUCCESS])
+    assert result["status"] == "StoryReady"
+    assert_picked_up_on_time(result)
+    # Full jitter below 2s, 4s and 8s
+    assert all(0 <= gap <= limit + 0.05 for gap, limit in zip(gaps(result["fetched_at"]), (2, 4, 8)))
+
+
+def test_an_error_is_retried_with_backoff(isolated):
+    result = isolated("fetch_until_done", responses=[ERROR, processing(eta=20), SUCCESS])
+    assert result["status"] == "StoryReady"
+    assert_picked_up_on_time(result)
+    retry, eta = gaps(result["fetched_at"])
+    assert 5 <= retry <= 10.05
+    assert eta == pytest.approx(20, abs=0.05)
+
+
+def test_an_image_that_keeps_failing_is_dead_lettered(isolated):
+    result = isolated("fetch_until_done", responses=[ERROR] * 5)
+    assert result["status"] == "DeadLetter"
+    assert_picked_up_on_time(result)
+    assert len(result["fetched_at"]) == 5
+    assert all(gap >= 5 for gap in gaps(result["fetched_at"]))
@@ -0,0 +1,57 @@
+# Images stored by a worker are served by an API process that doesn't share its disk
+import asyncio
+
+import httpx
+
+from bench.fake_providers import FakeStableDiffusion
+from bench.scenarios import seed
+from src import main
+from src.external_libs.http_client import close_http_session
+from src.functions import image_store
+from src.functions.story_store import get_story, update_story
+from src.models import StoryStatus
+
+
+def test_api_without_the_worker_volume_serves_stored_images(db, monkeypatch, tmp_path):
+    seed(["images-reader"], stories=1, latest_status="PendingImageFetch")(db)
+    monkeypatch.setattr(main, "db", db)
+    downloads = []
+    download_image = image_store.download_image
+
+    async def counted_download(url):
+        downloads.append(url)
+        return await download_image(url)
+
+    monkeypatch.setattr(image_store, "download_image", counted_download)
+
+    async def run():
+        provider = await FakeStableDiffusion().start()
+        try:
+            image_url = provider.image_url(1)
+            story = update_story(db, "images-reader", 0, StoryStatus.PendingImageFetch,
+                                 {"status": StoryStatus.StoryReady, "image_url": image_url})
+            # The worker's disk
+            monkeypatch.setattr(image_store, "IMAGE_STORE_PATH", str(tmp_path / "worker"))
+            await image_store.store_story_image(db, "images-reader", story)
+            digest = get_story(db, "images-reader", 0)["image_hash"]
+
+            # The API's, empty
+            monkeypatch.setattr(image_store, "IMAGE_STORE_PATH", str(tmp_path / "api"))
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app),
+                                         base_url="http://testserver") as client:
+                responses = await asyncio.gather(*(client.get(f"/images/{digest}") for _ in range(5)))
+                missing = await client.get(f"/images/{'0' * 64}")
+            async with httpx.AsyncClient() as client:
+                original = (await client.get(image_url)).content
+            return responses, missing, original
+        finally:
+            await close_http_session()
+            await provider.stop()
+
+    responses, missing, original = asyncio.run(run())
+    assert [response.status_code for response in responses] == [200] * 5
+    assert all(response.content == original for response in responses)
+    assert missing.status_code == 404
+    # Once by the worker, once by the API for all five requests
+    assert len(downloads) == 2
+    assert (tmp_path / "api").is_dir()
@@ -0,0 +1,122 @@
+# A story is worked on once: by one process at a time, and within a process by the stage or a reader
+import asyncio
+import time
+import uuid
+
+from bench.scenarios import seed
+from src.events import InProcessEventBackend, StoryEventHub, relay_story_changes
+from src.functions import pipeline, story_generation
+from src.functions.leases import claim_story, forget_lease, held_leases, is_leased
+from src.functions.story_store import get_story, touch_user_stories
+from src.functions.work_queue import queue_ref, update_story_queue
+from src.models import StoryStatus
+
+
+def unique_user():
+    return f"lease-{uuid.uuid4().hex[:8]}"
+
+
+def queue_entry(db, user_id, story_id=0):
+    return queue_ref(db, user_id, story_id).get().to_dict()
+
+
+def test_stage_leaves_a_story_a_reader_is_generating(db, monkeypatch):
+    user_id = unique_user()
+    seed([user_id], stories=1, latest_status="PendingTextGeneration")(db)
+    prompts = []
+
+    async def run():
+        finish = asyncio.Event()
+
+        async def generate_story(prompt, text_stream=None, priority=None):
+            prompts.append(prompt)
+            text_stream.append("Once upon a time.")
+            await finish.wait()
+            return ["Once upon a time.", "Mia and the moon"]
+
+        monkeypatch.setattr(story_generation, "generate_story", generate_story)
+        text_stream = story_generation.start_story_generation(db, user_id, 0)
+        while not prompts:
+            await asyncio.sleep(0.001)
+
+        # The queue entry of the story the reader is waiting on reaches the stage of the same process
+        entry = {"user_id": user_id, "story_id": 0, "run_at": 0}
+        await pipeline.process_entry(
+            db, StoryStatus.PendingTextGeneration, entry,
+            lambda entry, writes: story_generation.process_story_generation(db, entry, writes=writes),
+            asyncio.Semaphore(0))
+        held_while_reading = (user_id, 0) in held_leases
+
+        finish.set()
+        await asyncio.gather(*story_generation._generation_tasks)
+        return held_while_reading, "".join(text_stream.chunks)
+
+    held_while_reading, text = asyncio.run(run())
+    assert held_while_reading
+    assert len(prompts) == 1
+    assert text == "Once upon a time."
+    assert (user_id, 0) not in held_leases
+    assert get_story(db, user_id, 0)["status"] == StoryStatus.PendingImageGeneration
+
+
+def test_a_process_claims_a_story_once(db):
+    user_id = unique_user()
+    seed([user_id], stories=1, latest_status="PendingTextGeneration")(db)
+
+    assert claim_story(db, StoryStatus.PendingTextGeneration, user_id, 0)
+    # Same worker id, but the lease is already held by other work here
+    assert not claim_story(db, StoryStatus.PendingTextGeneration, user_id, 0)
+    # The text is committed and the next stage hears of it before the text stage forgets its lease
+    update_story_queue(db, user_id, 0, StoryStatus.PendingImageGeneration)
+    assert claim_story(db, StoryStatus.PendingImageGeneration, user_id, 0)
+    forget_lease(user_id, 0, StoryStatus.PendingTextGeneration)
+    assert held_leases.pop((user_id, 0)) == StoryStatus.PendingImageGeneration
+
+
+def test_story_whose_failure_cannot_be_counted_is_released_until_its_retry(db, monkeypatch):
+    user_id = unique_user()
+    seed([user_id], stories=1, latest_status="PendingImageGeneration")(db)
+    status = StoryStatus.PendingImageGeneration
+
+    def record_stage_failure(*args):
+        raise RuntimeError("Firestore hiccup")
+
+    monkeypatch.setattr(pipeline, "record_stage_failure", record_stage_failure)
+    monkeypatch.setattr(pipeline, "stage_queues", {status: pipeline.DeadlineScheduler()})
+    assert claim_story(db, status, user_id, 0)
+    entry = {"user_id": user_id, "story_id": 0, "run_at": 0, "claimed": True}
+    asyncio.run(pipeline.fail_entry(db, status, entry, RuntimeError("provider down")))
+
+    released = queue_entry(db, user_id)
+    # Neither a watcher nor a recovery scan, here or in another process, hands it out before it is due again
+    assert not is_leased(released)
+    assert released["run_at"] >= time.time() + pipeline.retry_delay(1) / 2
+    assert (user_id, 0) not in held_leases
+    assert len(pipeline.stage_queues[status]) == 1
+
+
+def test_changes_made_by_another_process_reach_subscribers(db):
+    user_id, other_user_id = unique_user(), unique_user()
+    seed([user_id, other_user_id], stories=1, latest_status="PendingTextGeneration")(db)
+    hub = StoryEventHub(InProcessEventBackend())
+
+    async def run():
+        hub.bind(asyncio.get_running_loop())
+        queue = hub.subscribe(user_id)
+        watch = relay_story_changes(db, hub)
+        # Written the way a worker process writes it, this process's hub never hears of it directly
+        story = dict(get_story(db, user_id, 0), status=StoryStatus.PendingImageGeneration)
+        await asyncio.to_thread(touch_user_stories, db, user_id, story)
+        # Nobody here is subscribed to this one
+        other_story = dict(get_story(db, other_user_id, 0), status=StoryStatus.StoryReady)
+        await asyncio.to_thread(touch_user_stories, db, other_user_id, other_story)
+        # A user document change that is not a story change
+        await asyncio.to_thread(db.collection("users").document(user_id).update, {"read_hours": [20.0]})
+        event = await asyncio.wait_for(queue.get(), 5)
+        await asyncio.sleep(0.05)
+        watch.unsubscribe()
+        return event, queue.qsize()
+
+    event, queued = asyncio.run(run())
+    assert event == {"story_id": 0, "status": "PendingImageGeneration"}
+    assert queued == 0
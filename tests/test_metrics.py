@@ -0,0 +1,46 @@
+# /metrics covers every component in whichever process serves it, and a streamed call until its last chunk
+import sys
+
+
+async def worker_only_metrics():
+    from src import worker  # noqa: F401
+    from src.metrics import registry
+
+    return {"main_loaded": "src.main" in sys.modules, "metrics": registry.render()}
+
+
+def test_worker_only_metrics_have_every_component(isolated):
+    result = isolated("worker_only_metrics")
+    assert not result["main_loaded"]
+    for component in ("generation_cache", "write_coalescer", "openai_limiter", "stable_diffusion_limiter"):
+        assert f"goodnight_{component}_" in result["metrics"]
+
+
+async def streamed_call_duration(tokens, token_delay):
+    import time
+
+    from bench.fake_providers import FakeOpenAI
+    from src.external_libs import text_completion
+    from src.external_libs.http_client import close_http_session
+    from src.metrics import provider_latency
+
+    openai = await FakeOpenAI(latency=0.05, token_delay=token_delay).start()
+    text_completion.OPENAI_API_BASE = f"{openai.base_url}/v1"
+    started = time.perf_counter()
+    try:
+        chunks = [chunk async for chunk in text_completion.stream_text("Tell me about owls.", max_tokens=tokens)]
+    finally:
+        await close_http_session()
+        await openai.stop()
+    snapshot = provider_latency.labels(provider="openai", call="stream").snapshot()
+    return {"chunks": len(chunks), "elapsed": time.perf_counter() - started, "count": snapshot["count"],
+            "sum": snapshot["sum"]}
+
+
+def test_streamed_calls_are_timed_to_the_last_chunk(isolated):
+    result = isolated("streamed_call_duration", tokens=20, token_delay=0.02)
+    assert result["chunks"] == 20
+    assert result["count"] == 1
+    # Well past the first chunk, at 0.05s, with 19 more every 0.02s
+    assert result["sum"] >= 0.3
+    assert result["sum"] <= result["elapsed"]
@@ -0,0 +1,41 @@
+from src.migrations.stories_to_subcollection import migrate_all
+from src.main import visible_latest_story
+
+
+def user_doc(db, user_id):
+    return db.collection("users").document(user_id).get().to_dict()
+
+
+def test_migrated_users_carry_their_latest_story(db):
+    db.collection("users").document("with-stories").set({"user_id": "with-stories", "stories": [
+        {"story_id": 0, "status": "StoryReady", "read_status": "read"},
+        {"story_id": 1, "status": "PendingImageGeneration", "read_status": "unread"}]})
+    db.collection("users").document("without").set({"user_id": "without", "stories": []})
+
+    assert migrate_all(db) == (2, 2, 0)
+
+    user = user_doc(db, "with-stories")
+    assert "stories" not in user
+    assert (user["story_count"], user["latest_story_id"], user["latest_story_status"]) == (
+        2, 1, "PendingImageGeneration")
+    assert user["story_version"] == 1
+    assert visible_latest_story(user, 0) == (1, "PendingImageGeneration")
+    assert db.collection("users").document("with-stories").collection("stories").document("1").get().exists
+    assert user_doc(db, "without")["latest_story_id"] is None
+
+
+def test_users_moved_by_an_earlier_run_are_backfilled(db):
+    # What the migration used to leave behind: the subcollection and story_count, no latest story fields
+    user_ref = db.collection("users").document("earlier")
+    user_ref.set({"user_id": "earlier", "story_count": 3})
+    for story_id, status in ((0, "StoryReady"), (1, "StoryReady"), (2, "PendingTextGeneration")):
+        user_ref.collection("stories").document(str(story_id)).set({"story_id": story_id, "status": status})
+
+    assert migrate_all(db) == (1, 0, 1)
+    user = user_doc(db, "earlier")
+    assert (user["latest_story_id"], user["latest_story_status"], user["story_version"]) == (
+        2, "PendingTextGeneration", 1)
+
+    # Safe to run again
+    assert migrate_all(db) == (1, 0, 0)
+    assert user_doc(db, "earlier")["story_version"] == 1
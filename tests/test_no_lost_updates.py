@@ -0,0 +1,95 @@
+# Concurrent endpoint and worker writes to the same user and story must all land
+import threading
+import time
+import uuid
+
+from bench.scenarios import DAY, seed
+from src.functions.new_story_queue_process import request_next_story
+from src.functions.story_store import get_story, mark_story_read, update_story
+from src.models import StoryStatus
+
+ROUNDS = 20
+
+
+def unique_user():
+    return f"lost-update-{uuid.uuid4().hex[:8]}"
+
+
+def run_together(*functions):
+    # Starts them at the same moment on their own threads and returns what each returned
+    barrier = threading.Barrier(len(functions))
+    results = [None] * len(functions)
+
+    def run(index, function):
+        barrier.wait()
+        results[index] = function()
+
+    threads = [threading.Thread(target=run, args=(index, function)) for index, function in enumerate(functions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def user(firestore_db, user_id):
+    return firestore_db.collection("users").document(user_id).get().to_dict()
+
+
+def test_reader_and_worker_writes_to_one_story_both_land(firestore_db):
+    user_id = unique_user()
+    seed([user_id], stories=ROUNDS, latest_status="PendingImageGeneration")(firestore_db)
+    for story_id in range(ROUNDS):
+        firestore_db.collection("users").document(user_id).collection("stories").document(str(story_id)).update(
+            {"status": StoryStatus.PendingImageGeneration, "read_status": "unread"})
+    version = user(firestore_db, user_id)["story_version"]
+
+    for story_id in range(ROUNDS):
+        # /read-story/ and the image stage finishing the same story
+        run_together(lambda: mark_story_read(firestore_db, user_id, story_id, [21.0]),
+                     lambda: update_story(firestore_db, user_id, story_id, StoryStatus.PendingImageGeneration,
+                                          {"status": StoryStatus.StoryReady, "image_url": f"image-{story_id}"}))
+
+    for story_id in range(ROUNDS):
+        story = get_story(firestore_db, user_id, story_id)
+        assert (story["read_status"], story["status"], story["image_url"]) == (
+            "read", StoryStatus.StoryReady, f"image-{story_id}")
+    # Every bump of the version the ETags are built on counted
+    assert user(firestore_db, user_id)["story_version"] == version + 2 * ROUNDS
+
+
+def test_two_workers_request_the_next_story_once(firestore_db):
+    user_id = unique_user()
+    seed([user_id], stories=1, latest_read=True, last_generated=time.time() - 2 * DAY)(firestore_db)
+    entry = {"user_id": user_id, "story_id": 0}
+
+    requested = run_together(lambda: request_next_story(firestore_db.transaction(), firestore_db, entry),
+                             lambda: request_next_story(firestore_db.transaction(), firestore_db, entry))
+
+    assert sum(story is not None for story in requested) == 1
+    assert user(firestore_db, user_id)["story_count"] == 2
+
+
+def test_next_story_request_rereads_a_subscription_renewed_while_it_ran(db):
+    # The in-memory fake only: the emulator locks what a transaction read, so this interleaving cannot happen there
+    user_id = unique_user()
+    seed([user_id], stories=1, latest_read=True, last_generated=time.time() - 2 * DAY)(db)
+    user_ref = db.collection("users").document(user_id)
+    user_ref.update({"subscription.isActive": False, "subscription.end_date_timestamp": time.time() - DAY})
+    transaction = db.transaction()
+    commit = transaction._commit
+    renewals = []
+
+    def renewed_before_commit():
+        # /user/subscription lands after the transaction read the lapsed subscription, before it commits
+        if not renewals:
+            renewals.append(True)
+            user_ref.update({"subscription.isActive": True, "subscription.end_date_timestamp": time.time() + DAY})
+        return commit()
+
+    transaction._commit = renewed_before_commit
+    story = request_next_story(transaction, db, {"user_id": user_id, "story_id": 0})
+
+    # Retried against the renewed subscription rather than deferring the reader to tomorrow
+    assert story is not None and story["story_id"] == 1
+    assert user(db, user_id)["subscription"]["isActive"] is True
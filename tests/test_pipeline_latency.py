@@ -0,0 +1,44 @@
+# A new story reaches StoryReady in about the time the providers take, the stages hand it on without waiting for a
+# poll
+import time
+
+STORIES = 3
+
+
+async def request_to_ready(stories, openai_latency, stable_diffusion_latency):
+    from bench.fake_providers import FakeOpenAI, FakeStableDiffusion
+    from bench.harness import Harness
+    from bench.scenarios import seed
+
+    harness = Harness(openai=FakeOpenAI(latency=openai_latency, token_delay=0.001),
+                      stable_diffusion=FakeStableDiffusion(latency=stable_diffusion_latency, processing_rate=0))
+    await harness.start(seed(["e2e"], stories=1))
+    # Imported once the harness has configured the service
+    from src.functions.story_store import create_story
+    from src.models import Story, StoryStatus
+
+    providers = (harness.openai, harness.stable_diffusion)
+    timings = []
+    try:
+        for story_id in range(1, stories + 1):
+            busy = sum(provider.busy_seconds for provider in providers)
+            started = time.monotonic()
+            # What request_next_story commits, the text stage picks it up from the change event
+            create_story(harness.db, "e2e", Story(prompt="Write a short story about Mia.",
+                                                  status=StoryStatus.PendingTextGeneration, timestamp=time.time(),
+                                                  read_status="unread", story_id=story_id).dict())
+            assert await harness.wait_until_ready([("e2e", story_id)], 30) == 1
+            timings.append({"request_to_ready_s": harness.ready_at[("e2e", story_id)] - started,
+                            "providers_s": sum(provider.busy_seconds for provider in providers) - busy})
+    finally:
+        await harness.stop()
+    return timings
+
+
+def test_request_to_ready_is_the_sum_of_provider_latencies(isolated):
+    timings = isolated("request_to_ready", stories=STORIES, openai_latency=0.3, stable_diffusion_latency=0.3)
+    for timing in timings:
+        # Story text, summary and image calls, one after the other
+        assert timing["providers_s"] > 0.45
+        # Everything else, Firestore, hand-offs and scheduling, is small next to them and never a polling interval
+        assert timing["request_to_ready_s"] - timing["providers_s"] < 0.25, timings
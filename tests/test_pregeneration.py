@@ -0,0 +1,79 @@
+import asyncio
+import datetime
+import time
+
+from bench.scenarios import DAY, seed
+from src.events import story_events
+from src.functions import pregeneration
+from src.functions.pregeneration import PregenerationScheduler
+from src.functions.story_store import get_story
+from src.models import StoryStatus
+
+OFF_PEAK = datetime.datetime(2026, 1, 5, 2, tzinfo=datetime.timezone.utc).timestamp()
+PEAK = datetime.datetime(2026, 1, 5, 19, tzinfo=datetime.timezone.utc).timestamp()
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+async def no_sleep(seconds):
+    pass
+
+
+def scheduler(db, now, **options):
+    return PregenerationScheduler(db, clock=Clock(now), sleep=no_sleep, off_peak_hours="1-6", **options)
+
+
+def seed_due_readers(db, count, now):
+    # Read today's story, tomorrow's becomes due within the horizon
+    seed([f"reader-{index}" for index in range(count)], stories=1, latest_read=True, last_generated=now - DAY / 2,
+         story_request_due=now + DAY / 2)(db)
+
+
+def test_peak_hours_tick_reads_nothing(db):
+    seed_due_readers(db, 5, PEAK)
+    reads = db.reads
+
+    assert asyncio.run(scheduler(db, PEAK).tick()) == 0
+    assert db.reads == reads
+
+
+def test_stories_never_seen_ready_stop_counting_as_in_flight(db):
+    seed_due_readers(db, 4, OFF_PEAK)
+    pregen = scheduler(db, OFF_PEAK, concurrency=2)
+
+    assert asyncio.run(pregen.tick()) == 2
+    # Both finished in another process, this one never saw them become ready
+    assert asyncio.run(pregen.tick()) == 0
+
+    pregen.clock.now += pregeneration.PREGENERATION_IN_FLIGHT_TTL + 1
+    assert asyncio.run(pregen.tick()) == 2
+    assert pregen.stats()["in_flight"] == 2
+
+
+def test_hidden_story_is_published_when_it_comes_out(db):
+    now = time.time()
+    seed(["hidden"], stories=2, last_generated=now - DAY / 2)(db)
+    db.collection("users").document("hidden").collection("stories").document("1").update(
+        {"available_timestamp": now + 60})
+    story = get_story(db, "hidden", 1)
+    published = []
+    story_events.add_listener(lambda user_id, change: published.append((user_id, change["story_id"])))
+    pregen = PregenerationScheduler(db, clock=Clock(now), sleep=no_sleep)
+    pregen.on_story_change("hidden", story)
+    version = db.collection("users").document("hidden").get().to_dict()["story_version"]
+
+    assert asyncio.run(pregen.release_due()) == 0
+    pregen.clock.now = now + 61
+    assert asyncio.run(pregen.release_due()) == 1
+
+    assert ("hidden", 1) in published
+    user = db.collection("users").document("hidden").get().to_dict()
+    assert (user["story_version"], user["latest_story_id"], user["latest_story_status"]) == (
+        version + 1, 1, StoryStatus.StoryReady)
+    assert pregen.stats()["hidden"] == 0
@@ -0,0 +1,190 @@
+# Provider calls stay within the daily budget, however they queue, retry or spread over processes
+import asyncio
+
+import pytest
+
+from src.external_libs.rate_limiter import (PRIORITY_INTERACTIVE, PRIORITY_PREGENERATED, BudgetExceeded,
+                                            ProviderLimiter, RateLimited)
+from src.functions.provider_spend import sync_provider_spend
+
+
+def outcomes(results):
+    return sorted(type(result).__name__ if isinstance(result, Exception) else "admitted" for result in results)
+
+
+def test_calls_queued_within_budget_are_checked_again_when_admitted():
+    limiter = ProviderLimiter("test", 600, daily_budget=3.0)
+
+    async def run():
+        # Paused by the provider, every call queues while nothing is spent yet
+        limiter.record_rate_limited(retry_after=0.2)
+        return await asyncio.gather(*(limiter.acquire(cost=1.0) for _ in range(10)), return_exceptions=True)
+
+    assert outcomes(asyncio.run(run())) == ["BudgetExceeded"] * 7 + ["admitted"] * 3
+    assert limiter.spent_today == 3.0
+
+
+def test_a_call_is_paid_for_once_whatever_its_429s():
+    limiter = ProviderLimiter("test", 600, daily_budget=10.0)
+    answers = iter([RateLimited(0.01), RateLimited(0.01), "story"])
+
+    async def call():
+        answer = next(answers)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    assert asyncio.run(limiter.run(call, cost=2.0)) == "story"
+    assert limiter.spent_today == 2.0
+
+    async def always_limited():
+        raise RateLimited(0.01)
+
+    with pytest.raises(RateLimited):
+        asyncio.run(limiter.run(always_limited, cost=2.0, retries=1))
+    # Never got through, never billed
+    assert limiter.spent_today == 2.0
+
+
+def test_processes_share_one_budget(db):
+    first, second = (ProviderLimiter("shared", 600, daily_budget=5.0) for _ in range(2))
+
+    async def run():
+        await first.acquire(cost=2.0)
+        await second.acquire(cost=2.0)
+        for limiter in (first, second, first):
+            await sync_provider_spend(db, limiter)
+        with pytest.raises(BudgetExceeded):
+            await first.acquire(cost=2.0)
+        await first.acquire(cost=1.0)
+
+    asyncio.run(run())
+    assert (first.spent_today, second.spent_today) == (5.0, 4.0)
+
+
+def test_interactive_calls_are_admitted_before_pregenerated_ones():
+    limiter = ProviderLimiter("test", 600, daily_budget=None)
+    admitted = []
+
+    async def call(name, priority):
+        await limiter.acquire(priority=priority)
+        admitted.append(name)
+
+    async def run():
+        # Nothing left this minute, one call is admitted every tenth of a second
+        limiter.requests.tokens = 0
+        pregenerated = [asyncio.create_task(call(f"pregenerated-{number}", PRIORITY_PREGENERATED))
+                        for number in range(3)]
+        await asyncio.sleep(0.01)
+        interactive = [asyncio.create_task(call(f"interactive-{number}", PRIORITY_INTERACTIVE))
+                       for number in range(3)]
+        await asyncio.gather(*pregenerated, *interactive)
+
+    asyncio.run(run())
+    assert admitted == [f"interactive-{number}" for number in range(3)] + \
+        [f"pregenerated-{number}" for number in range(3)]
+
+
+def test_a_429_cuts_the_rate_and_successes_win_it_back():
+    limiter = ProviderLimiter("test", 600, 6000, daily_budget=None)
+    limiter.record_rate_limited()
+    assert (limiter.requests.rate, limiter.tokens.rate) == (300, 3000)
+    limiter.record_rate_limited()
+    assert (limiter.requests.rate, limiter.tokens.rate) == (150, 1500)
+
+    rates = []
+    for _ in range(20):
+        limiter.record_success()
+        rates.append(limiter.requests.rate)
+    assert rates == sorted(rates)
+    assert rates[14:] == [600] * 6
+    assert limiter.tokens.rate == 6000
+
+
+async def openai_calls_against_limits(calls, requests_per_minute=None, tokens_per_minute=None, spent_tokens=0,
+                                      first_alone=False, at_limit=False):
+    from bench.fake_providers import FakeOpenAI
+    from src.external_libs import text_completion
+    from src.external_libs.http_client import close_http_session
+    from src.external_libs.text_completion import generate_text
+
+    openai = await FakeOpenAI(latency=0.01, requests_per_minute=requests_per_minute,
+                              tokens_per_minute=tokens_per_minute).start()
+    # Used by other processes before this one started
+    openai.spend(tokens=spent_tokens)
+    text_completion.OPENAI_API_BASE = f"{openai.base_url}/v1"
+    limiter = text_completion.openai_limiter = ProviderLimiter("openai", requests_per_minute or 100000,
+                                                               tokens_per_minute, daily_budget=None)
+    if at_limit:
+        # Both sides agree the minute's worth is spent, every call waits for what the provider replenishes
+        openai.spend(requests=requests_per_minute or 0, tokens=tokens_per_minute or 0)
+        for bucket in (limiter.requests, limiter.tokens):
+            if bucket is not None:
+                bucket.tokens = 0
+    prompts = [f"Story {number} about the moon." for number in range(calls)]
+    started = asyncio.get_running_loop().time()
+    try:
+        results = []
+        if first_alone:
+            results.append(await generate_text(prompts.pop(0), max_tokens=50))
+        results.extend(await asyncio.gather(*(generate_text(prompt, max_tokens=50) for prompt in prompts),
+                                            return_exceptions=True))
+    finally:
+        await close_http_session()
+        await openai.stop()
+    return {"completed": sum(isinstance(result, str) for result in results),
+            "duration": asyncio.get_running_loop().time() - started, "over_limit": openai.over_limit,
+            "rate_limited": limiter.rate_limited}
+
+
+@pytest.mark.parametrize("limits", [{"requests_per_minute": 200}, {"tokens_per_minute": 200 * 56}])
+def test_openai_calls_stay_within_the_provider_limits(isolated, limits):
+    # Ten calls at once against a limit of one every 0.3s
+    result = isolated("openai_calls_against_limits", calls=10, at_limit=True, **limits)
+    assert result["completed"] == 10
+    assert result["over_limit"] == result["rate_limited"] == 0
+    assert result["duration"] > 2.5
+
+
+def test_openai_calls_slow_down_to_what_the_provider_says_is_left(isolated):
+    # Other processes used all but three calls' worth, only the rate limit headers tell this one
+    result = isolated("openai_calls_against_limits", calls=6, tokens_per_minute=200 * 56,
+                      spent_tokens=197 * 56, first_alone=True)
+    assert result["completed"] == 6
+    assert result["over_limit"] == result["rate_limited"] == 0
+
+
+async def openai_calls_within_budget(calls, budget):
+    import random
+
+    from bench.fake_providers import FakeOpenAI
+    from src.external_libs import text_completion
+    from src.external_libs.http_client import close_http_session
+    from src.external_libs.rate_limiter import openai_limiter
+    from src.external_libs.text_completion import estimate_tokens, generate_text
+
+    random.seed(7)
+    openai = await FakeOpenAI(latency=0.05, rate_limit_rate=0.3).start()
+    text_completion.OPENAI_API_BASE = f"{openai.base_url}/v1"
+
+    prompt = "Write a short story about the moon."
+    cost = estimate_tokens(prompt, 5) / 1000 * openai_limiter.cost_per_1k_tokens
+    openai_limiter.daily_budget = budget * cost
+    try:
+        results = await asyncio.gather(*(generate_text(prompt) for _ in range(calls)), return_exceptions=True)
+    finally:
+        await close_http_session()
+        await openai.stop()
+    return {"outcomes": [type(result).__name__ if isinstance(result, Exception) else "text" for result in results],
+            "spent_calls": round(openai_limiter.spent_today / cost, 6), "requests": openai.requests,
+            "faults": openai.faults}
+
+
+def test_openai_calls_past_the_budget_are_rejected(isolated):
+    result = isolated("openai_calls_within_budget", calls=12, budget=5)
+    completed = result["outcomes"].count("text")
+    assert completed + result["outcomes"].count("BudgetExceeded") + result["outcomes"].count("RateLimited") == 12
+    assert 0 < completed <= 5
+    # Paid once for each call that went through, none for the 429s the provider answered
+    assert result["spent_calls"] == completed
+    assert result["requests"] == completed + result["faults"]
@@ -0,0 +1,12 @@
+# Neither role loads a provider SDK before it is used, and the startup benchmark runs with its defaults
+from bench.startup import ROLES, parse_args, probe
+
+
+def test_startup_benchmark_measures_every_role_by_default():
+    assert parse_args([]).roles == sorted(ROLES)
+    assert parse_args(["worker"]).roles == ["worker"]
+
+
+def test_no_role_loads_a_lazy_sdk_at_import():
+    for role, (module, env) in ROLES.items():
+        assert probe(module, env)[0]["loaded"] == [], role
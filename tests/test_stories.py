@@ -0,0 +1,45 @@
+# /stories/ pages through a long history, and reads a fraction of what the story array on the user document cost
+import pytest
+
+from bench.scenarios import seed
+from bench.story_layout import compare
+from src import main
+
+USER_ID = "pages-0"
+
+
+@pytest.fixture
+def reader(client, db, monkeypatch):
+    seed([USER_ID], stories=45)(db)
+
+    async def verified_user_id(authorization):
+        return USER_ID
+
+    monkeypatch.setattr(main, "get_auth_verified_user_id", verified_user_id)
+    return lambda **params: client.get("/stories/", params=params, headers={"Authorization": "Bearer reader"})
+
+
+def test_pages_cover_the_history_newest_first(reader):
+    story_ids = []
+    cursor = None
+    while True:
+        body, status = reader(**({"limit": 20} if cursor is None else {"limit": 20, "cursor": cursor})).json()
+        assert status == 200
+        story_ids.extend(story["story_id"] for story in body["stories"])
+        assert all("generated_story" not in story for story in body["stories"])
+        cursor = body["next_cursor"]
+        if cursor is None:
+            break
+    assert story_ids == list(range(44, -1, -1))
+
+
+@pytest.mark.parametrize("limit", [0, -1, 101])
+def test_out_of_range_limits_are_rejected(reader, limit):
+    assert reader(limit=limit).status_code == 422
+
+
+def test_documents_read_less_than_the_story_array():
+    result = compare(stories=200, runs=2, latency_ms=0, bandwidth_mb=1000)
+    for operation in ("get_user", "latest_story", "list_stories"):
+        assert result["after"][operation]["bytes_read"] * 20 < result["before"][operation]["bytes_read"]
+    assert result["after"]["read_story"]["bytes_read"] == 0
@@ -0,0 +1,17 @@
+# Idle /story/events/ connections stay cheap, and a story change reaches all of them quickly, relayed or not
+import asyncio
+
+import pytest
+
+from bench.story_events import fan_out
+
+CONNECTIONS = 2000
+
+
+@pytest.mark.parametrize("relayed", [False, True], ids=["in_process", "relayed"])
+def test_story_changes_fan_out_to_thousands_of_idle_connections(relayed):
+    result = asyncio.run(fan_out(CONNECTIONS, relayed))
+    assert result["received"] == CONNECTIONS
+    # A task, a generator, a queue and a timer handle, about 5 KB here
+    assert result["memory_per_connection_bytes"] < 16 * 1024
+    assert result["fan_out_latency_ms"]["p99"] < 1000
@@ -0,0 +1,61 @@
+# Readers of a pending story get its text as the provider streams it, and the finished story is saved as usual
+import asyncio
+import time
+
+USER_ID = "stream-0"
+
+
+async def read_story_stream(session, headers, first_chunk=None):
+    started = time.perf_counter()
+    chunks = []
+    async with session.get("/story/0/stream/", headers=headers) as response:
+        assert response.status == 200, response.status
+        async for chunk in response.content.iter_any():
+            if not chunks:
+                if first_chunk is not None:
+                    first_chunk.set()
+                first_chunk_at = time.perf_counter() - started
+            chunks.append(chunk.decode())
+    return {"chunks": chunks, "first_chunk_s": first_chunk_at, "done_s": time.perf_counter() - started}
+
+
+async def stories_streamed_to_readers():
+    from bench.fake_providers import FakeOpenAI
+    from bench.harness import Harness
+    from bench.scenarios import seed
+
+    # No workers, the first reader starts the generation itself
+    harness = Harness(openai=FakeOpenAI(latency=0.2, token_delay=0.002), env={"RUN_WORKERS": "False"})
+    await harness.start(seed([USER_ID], stories=1, latest_status="PendingTextGeneration"))
+    from src.functions.story_generation import _generation_tasks
+    from src.functions.story_store import get_story
+
+    headers = {"Authorization": f"Bearer {harness.token(USER_ID)}"}
+    try:
+        first_chunk = asyncio.Event()
+        first = asyncio.create_task(read_story_stream(harness.session, headers, first_chunk))
+        await first_chunk.wait()
+        # Joins the generation the first reader started
+        second = await read_story_stream(harness.session, headers)
+        first = await first
+        await asyncio.gather(*_generation_tasks)
+        story = get_story(harness.db, USER_ID, 0)
+    finally:
+        await harness.stop()
+    return {"first": first, "second": second, "story": story, "openai_requests": harness.openai.requests}
+
+
+def test_readers_follow_the_story_as_it_is_generated(isolated):
+    result = isolated("stories_streamed_to_readers")
+    first, second, story = result["first"], result["second"], result["story"]
+    # One streamed story and one summary, however many readers
+    assert result["openai_requests"] == 2
+    # Token by token, in the order the provider sent them
+    assert len(first["chunks"]) > 10
+    assert "".join(first["chunks"]) == story["generated_story"]
+    assert first["first_chunk_s"] < 1
+    assert first["first_chunk_s"] < first["done_s"] / 2
+    # The second reader gets the text from the start
+    assert "".join(second["chunks"]) == story["generated_story"]
+    assert story["generated_summary"]
+    assert story["status"] == "PendingImageGeneration"
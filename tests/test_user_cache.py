@@ -0,0 +1,95 @@
+# Cached users hold nothing open, and still see what other processes change
+import threading
+
+from bench.scenarios import seed
+from src.events import relay_story_changes, story_events
+from src.functions.story_store import get_story, user_story_fields
+from src.models import StoryStatus
+from src.user_cache import UserDocumentCache, user_write_fields, watch_user_changes
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def users(count):
+    return [f"cached-{index}" for index in range(count)]
+
+
+def test_caching_users_opens_no_listeners(db):
+    seed(users(200), stories=1)(db)
+    cache = UserDocumentCache()
+    threads = threading.active_count()
+
+    for user_id in users(200):
+        assert cache.get(db, user_id)["user_id"] == user_id
+
+    assert db._watches == []
+    assert threading.active_count() == threads
+    assert cache.stats()["users"] == 200
+
+
+def test_story_changes_from_other_processes_replace_cached_users(db):
+    seed(users(2), stories=1, latest_status="PendingTextGeneration")(db)
+    cache = UserDocumentCache(clock=Clock())
+    for user_id in users(2):
+        cache.get(db, user_id)
+    watch = relay_story_changes(db)
+    try:
+        # As a worker in another process writes it, this process publishes nothing
+        story = dict(get_story(db, "cached-0", 0), status=StoryStatus.PendingImageGeneration)
+        db.collection("users").document("cached-0").update(user_story_fields(story))
+        reads = db.reads
+        assert cache.get(db, "cached-0")["latest_story_status"] == "PendingImageGeneration"
+        assert cache.get(db, "cached-1")["latest_story_status"] == "PendingTextGeneration"
+        assert db.reads == reads
+    finally:
+        watch.unsubscribe()
+        story_events.relayed = False
+
+
+def test_config_changes_from_other_processes_replace_cached_users(db):
+    seed(users(1), stories=1)(db)
+    cache = UserDocumentCache(clock=Clock())
+    cache.get(db, "cached-0")
+    watch = watch_user_changes(db, cache)
+    try:
+        # POST /user/config/ served by another process
+        db.collection("users").document("cached-0").update(user_write_fields({"config.genre": "fantasy"}))
+        reads = db.reads
+        assert cache.get(db, "cached-0")["config"]["genre"] == "fantasy"
+        assert db.reads == reads
+    finally:
+        watch.unsubscribe()
+
+
+def test_documents_older_than_the_cached_one_are_ignored(db):
+    seed(users(1), stories=1)(db)
+    cache = UserDocumentCache(clock=Clock())
+    user_ref = db.collection("users").document("cached-0")
+    older = user_ref.get().to_dict()
+    user_ref.update(user_write_fields({"config.genre": "fantasy"}))
+    cache.get(db, "cached-0")
+
+    # A listener delivering a change from before the cache read the user
+    cache.refresh("cached-0", older)
+    assert cache.get(db, "cached-0")["config"]["genre"] == "fantasy"
+    assert cache.stats()["relay_updates"] == 0
+
+
+def test_other_changes_are_seen_after_the_ttl(db):
+    seed(users(1), stories=1)(db)
+    clock = Clock()
+    cache = UserDocumentCache(ttl=60, clock=clock)
+    cache.get(db, "cached-0")
+    db.collection("users").document("cached-0").update({"config.genre": "fantasy"})
+
+    clock.now = 59
+    assert cache.get(db, "cached-0")["config"]["genre"] == "adventure"
+    clock.now = 60
+    assert cache.get(db, "cached-0")["config"]["genre"] == "fantasy"
+    assert cache.stats()["expirations"] == 1
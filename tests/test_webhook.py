@@ -0,0 +1,73 @@
+import pytest
+
+from bench.scenarios import seed
+from src.functions import image_generation
+from src.functions.image_generation import mark_image_ready, webhook_token
+from src.functions.story_store import get_story
+from src.models import StoryStatus
+
+TRACK_ID = "webhook:0"
+
+
+def seed_story(db, status):
+    seed(["webhook"], stories=1, latest_status=status)(db)
+
+
+def callback(client, status="success", output="https://images.invalid/first.png", token=None):
+    return client.post("/webhooks/stable-diffusion/", params={"token": token or webhook_token(TRACK_ID)},
+                       json={"status": status, "track_id": TRACK_ID, "output": [output] if output else None})
+
+
+def user_version(db):
+    return db.collection("users").document("webhook").get().to_dict()["story_version"]
+
+
+@pytest.mark.parametrize("setting, value", [("PUBLIC_BASE_URL", ""), ("STABLE_DIFFUSION_WEBHOOK_SECRET", ""),
+                                            ("STABLE_DIFFUSION_WEBHOOK_SECRET", "RANDOM-VALS")])
+def test_webhook_does_not_exist_unless_configured(client, db, monkeypatch, setting, value):
+    seed_story(db, "PendingImageFetch")
+    monkeypatch.setattr(image_generation, setting, value)
+    # Even with a token signed by the placeholder secret
+    assert callback(client).status_code == 404
+    assert image_generation.image_webhook_url(TRACK_ID) is None
+    assert get_story(db, "webhook", 0)["status"] == StoryStatus.PendingImageFetch
+
+
+def test_forged_token_is_rejected(client, db):
+    seed_story(db, "PendingImageFetch")
+    assert callback(client, token="0" * 64).status_code == 401
+    assert get_story(db, "webhook", 0)["status"] == StoryStatus.PendingImageFetch
+
+
+def test_duplicate_callbacks_change_nothing(client, db):
+    seed_story(db, "PendingImageFetch")
+    assert callback(client).json()["message"] == "Story updated successfully"
+    version = user_version(db)
+
+    second = callback(client, output="https://images.invalid/second.png")
+
+    assert second.status_code == 200 and second.json()["message"] == "Already handled"
+    story = get_story(db, "webhook", 0)
+    assert (story["status"], story["image_url"]) == (StoryStatus.StoryReady, "https://images.invalid/first.png")
+    assert user_version(db) == version
+
+
+def test_callback_before_the_generate_response(client, db):
+    # The job finished and called back before the generate call returned, the story is still pending generation
+    seed_story(db, "PendingImageGeneration")
+    assert callback(client).json()["message"] == "Story updated successfully"
+
+    # The generate response and a fetch arriving afterwards find the story ready and leave it alone
+    assert mark_image_ready(db, "webhook", 0, StoryStatus.PendingImageGeneration, "https://images.invalid/late.png") \
+        is None
+    assert mark_image_ready(db, "webhook", 0, StoryStatus.PendingImageFetch, "https://images.invalid/late.png") is None
+    assert get_story(db, "webhook", 0)["image_url"] == "https://images.invalid/first.png"
+
+
+def test_processing_callback_after_success_is_ignored(client, db):
+    seed_story(db, "PendingImageFetch")
+    callback(client)
+    late = callback(client, status="processing", output=None)
+
+    assert late.json()["message"] == "Ignored"
+    assert get_story(db, "webhook", 0)["status"] == StoryStatus.StoryReady
@@ -0,0 +1,12 @@
+# Finding pending work costs the same reads however many users there are
+from bench.work_queue import scan_costs
+
+
+def test_scans_read_the_same_documents_with_ten_times_the_users():
+    small, large = scan_costs(200, pending=20), scan_costs(2000, pending=20)
+    for scan in ("PendingTextGeneration", "PendingImageGeneration", "PendingStoryRequest"):
+        assert large[scan]["documents_read"] == small[scan]["documents_read"]
+        assert large[scan]["round_trips"] == small[scan]["round_trips"]
+    assert small["PendingTextGeneration"]["found"] == 10
+    # What a full scan of the users costs instead
+    assert large["full_users_scan"]["documents_read"] == 10 * small["full_users_scan"]["documents_read"]
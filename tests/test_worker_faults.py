@@ -0,0 +1,143 @@
+# Faults in one story or one loop never stop the pipeline, and nothing is held while it waits
+import asyncio
+import time
+
+USERS = 30
+POISONED = 3
+
+
+async def stories_through_faulty_providers(users, poisoned):
+    from bench.fake_providers import FakeOpenAI, FakeStableDiffusion
+    from bench.harness import Harness
+    from bench.scenarios import POISON_MARKER, STORY_PROMPT, seed
+
+    crashed = set()
+
+    class FaultyHarness(Harness):
+        def configure_environment(self):
+            super().configure_environment()
+            # Configured, and the workers not started yet
+            from src.functions import dead_letter, pipeline
+
+            # Retries within the test's time, and every stage's first recovery scan crashes
+            dead_letter.ITEM_RETRY_BASE = 0.01
+            scans = pipeline.iterate_pending_work
+
+            def iterate_pending_work(firestore_db, status, *args, **kwargs):
+                if status not in crashed:
+                    crashed.add(status)
+                    raise RuntimeError("Firestore unavailable")
+                return scans(firestore_db, status, *args, **kwargs)
+
+            pipeline.iterate_pending_work = iterate_pending_work
+
+    # Low enough that a healthy story failing ITEM_MAX_ATTEMPTS times in a row is all but impossible
+    harness = FaultyHarness(openai=FakeOpenAI(latency=0.05, failure_rate=0.1, poison_marker=POISON_MARKER),
+                            stable_diffusion=FakeStableDiffusion(latency=0.05, processing_rate=0, failure_rate=0.1,
+                                                                 malformed_rate=0.05))
+    user_ids = [f"faults-{index}" for index in range(users)]
+    await harness.start(seed(user_ids, stories=1, latest_status="PendingTextGeneration",
+                             prompt=lambda index: f"{POISON_MARKER} {STORY_PROMPT}" if index < poisoned
+                             else STORY_PROMPT))
+    from src.functions.supervisor import worker_restarts
+
+    healthy = [(user_id, 0) for user_id in user_ids[poisoned:]]
+    poisoned_keys = [(user_id, 0) for user_id in user_ids[:poisoned]]
+    try:
+        await harness.wait_until_ready(healthy, 120)
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline and not all(key in harness.dead_lettered for key in poisoned_keys):
+            await asyncio.sleep(0.05)
+        recoveries = {name: count for name, count in worker_restarts.items() if name.endswith(" recovery")}
+    finally:
+        await harness.stop()
+    return {"ready": sum(1 for key in healthy if key in harness.ready_at),
+            "dead_lettered": sorted(user_id for user_id, _ in harness.dead_lettered),
+            "faults": harness.openai.faults + harness.stable_diffusion.faults, "recoveries": recoveries}
+
+
+def test_poisoned_stories_are_dead_lettered_and_the_rest_finish(isolated):
+    result = isolated("stories_through_faulty_providers", users=USERS, poisoned=POISONED)
+    assert result["faults"] > 0
+    assert result["ready"] == USERS - POISONED
+    assert result["dead_lettered"] == [f"faults-{index}" for index in range(POISONED)]
+    # The crashed scans were restarted, once each
+    assert result["recoveries"] == {f"{status} recovery": 1 for status in
+                                    ("PendingTextGeneration", "PendingImageGeneration", "PendingImageFetch")}
+
+
+def test_story_over_the_budget_is_released_until_it_is_looked_at_again(db, monkeypatch):
+    # Imported here, the isolated test above must read the configuration it sets first
+    from bench.scenarios import seed
+    from src.external_libs.rate_limiter import BudgetExceeded
+    from src.functions import pipeline
+    from src.functions.leases import claim_story, held_leases, is_leased
+    from src.functions.work_queue import queue_ref
+    from src.models import StoryStatus
+
+    user_id = "faults-budget"
+    seed([user_id], stories=1, latest_status="PendingTextGeneration")(db)
+    status = StoryStatus.PendingTextGeneration
+    monkeypatch.setattr(pipeline, "stage_queues", {status: pipeline.DeadlineScheduler()})
+
+    async def process(entry, writes):
+        raise BudgetExceeded("Daily budget spent")
+
+    entry = {"user_id": user_id, "story_id": 0, "run_at": 0}
+    asyncio.run(pipeline.process_entry(db, status, entry, process, asyncio.Semaphore(0)))
+
+    released = queue_ref(db, user_id, 0).get().to_dict()
+    assert not is_leased(released)
+    assert released["run_at"] >= time.time() + pipeline.BUDGET_RETRY_DELAY - 60
+    assert released.get("attempts", 0) == 0
+    assert (user_id, 0) not in held_leases
+    assert len(pipeline.stage_queues[status]) == 1
+    # Any process can have it once it is due
+    assert claim_story(db, status, user_id, 0)
+
+
+def test_readers_of_a_story_over_the_budget_get_an_error_and_count_no_failure(db, monkeypatch):
+    import httpx
+
+    from bench.scenarios import seed
+    from src import main
+    from src.external_libs.rate_limiter import openai_limiter
+    from src.functions import story_generation
+    from src.functions.leases import held_leases, is_leased
+    from src.functions.pipeline import BUDGET_RETRY_DELAY
+    from src.functions.story_store import get_story
+    from src.functions.work_queue import queue_ref
+    from src.models import StoryStatus
+
+    user_id = "faults-budget-reader"
+    seed([user_id], stories=1, latest_status="PendingTextGeneration")(db)
+
+    async def verified_user_id(authorization):
+        return user_id
+
+    monkeypatch.setattr(main, "db", db)
+    monkeypatch.setattr(main, "get_auth_verified_user_id", verified_user_id)
+    monkeypatch.setattr(openai_limiter, "daily_budget", 0.0)
+
+    async def run():
+        responses = []
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app),
+                                     base_url="http://testserver") as client:
+            # More readers than it takes to dead-letter a story that fails
+            for _ in range(6):
+                responses.append(await client.get("/story/0/stream/", headers={"Authorization": "Bearer reader"}))
+                # Done releasing the story, as it would be in a server that keeps running
+                await asyncio.gather(*story_generation._generation_tasks)
+        return responses
+
+    responses = asyncio.run(run())
+
+    assert [response.status_code for response in responses] == [429] * 6
+    assert all(response.headers["Retry-After"] for response in responses)
+    entry = queue_ref(db, user_id, 0).get().to_dict()
+    assert entry.get("attempts", 0) == 0
+    assert not is_leased(entry)
+    assert entry["run_at"] >= time.time() + BUDGET_RETRY_DELAY - 60
+    assert (user_id, 0) not in held_leases
+    assert get_story(db, user_id, 0)["status"] == StoryStatus.PendingTextGeneration
+
@@ -0,0 +1,70 @@
+# Workers in separate processes against one database do every story's work exactly once
+import asyncio
+import os
+import signal
+import sys
+import tempfile
+import time
+
+STORIES = 30
+WORKERS = 3
+
+WORKER = """
+import asyncio, sys
+from bench.fake_firestore import SharedFakeFirestore
+from src import worker
+worker.initialize_firestore = lambda: SharedFakeFirestore(sys.argv[1])
+asyncio.run(worker.run_workers())
+"""
+
+
+async def stories_done_by_worker_processes(workers, stories, timeout=120):
+    from bench.fake_firestore import SharedFakeFirestore
+    from bench.fake_providers import FakeOpenAI, FakeStableDiffusion
+    from bench.scenarios import seed
+    from src.functions.story_store import get_story
+
+    openai = await FakeOpenAI(latency=0.2, token_delay=0.001).start()
+    stable_diffusion = await FakeStableDiffusion(latency=0.2, processing_rate=0).start()
+    directory = tempfile.mkdtemp(prefix="goodnight-test-workers-")
+    db = SharedFakeFirestore(os.path.join(directory, "firestore.sqlite3"))
+    user_ids = [f"process-{index}" for index in range(stories)]
+    seed(user_ids, stories=1, latest_status="PendingTextGeneration")(db)
+
+    env = dict(os.environ, OPENAI_API_BASE=f"{openai.base_url}/v1",
+               STABLE_DIFFUSION_API_BASE=stable_diffusion.base_url, STABLE_DIFFUSION_WEBHOOK_SECRET="",
+               IMAGE_STORE_PATH=os.path.join(directory, "images"), PREGENERATION_ENABLED="False",
+               WORKER_METRICS_PORT="0", OPENAI_REQUESTS_PER_MINUTE="1000000",
+               OPENAI_TOKENS_PER_MINUTE="1000000000", STABLE_DIFFUSION_REQUESTS_PER_MINUTE="1000000",
+               DAILY_PROVIDER_BUDGET="1e9")
+    processes = [await asyncio.create_subprocess_exec(sys.executable, "-c", WORKER, db_path, env=env)
+                 for db_path in [os.path.join(directory, "firestore.sqlite3")] * workers]
+
+    def statuses():
+        return [get_story(db, user_id, 0)["status"] for user_id in user_ids]
+
+    try:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and set(await asyncio.to_thread(statuses)) != {"StoryReady"}:
+            await asyncio.sleep(0.1)
+        # Anything still in flight anywhere would show up as a request too many
+        await asyncio.sleep(1)
+        final_statuses = await asyncio.to_thread(statuses)
+    finally:
+        for process in processes:
+            process.send_signal(signal.SIGTERM)
+        exit_codes = [await process.wait() for process in processes]
+        await openai.stop()
+        await stable_diffusion.stop()
+        db.close()
+    return {"statuses": final_statuses, "exit_codes": exit_codes, "openai_requests": openai.requests,
+            "stable_diffusion_requests": stable_diffusion.requests}
+
+
+def test_every_story_is_worked_on_once_across_processes(isolated):
+    result = isolated("stories_done_by_worker_processes", workers=WORKERS, stories=STORIES)
+    assert result["statuses"] == ["StoryReady"] * STORIES
+    assert result["exit_codes"] == [0] * WORKERS
+    # One streamed story and one summary per story, and one image
+    assert result["openai_requests"] == 2 * STORIES
+    assert result["stable_diffusion_requests"] == STORIES